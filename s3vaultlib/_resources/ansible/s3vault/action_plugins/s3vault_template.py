@@ -3,16 +3,17 @@ __metaclass__ = type
 
 import os
 import shutil
+import stat
 import tempfile
-import jinja2
+from contextlib import nullcontext
 from ansible.errors import AnsibleError, AnsibleFileNotFound
 from ansible.module_utils._text import to_bytes, to_text
 from ansible.module_utils.parsing.convert_bool import boolean
 from ansible.plugins.action import ActionBase
 from ansible.template import generate_ansible_template_vars
-from s3vaultlib.metadata.factory import MetadataFactory
-from s3vaultlib.connection.connectionmanager import ConnectionManager
-from s3vaultlib.s3vaultlib import S3Vault
+from ansible.utils.hashing import checksum_s
+from s3vaultlib.template.templaterenderer import disable_bytecode_cache
+from s3vaultlib.utils.vaultcache import get_vault_cache
 
 __author__ = "Giuseppe Chiesa"
 __copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
@@ -27,6 +28,13 @@ class ActionModule(ActionBase):
 
     TRANSFERS_FILES = True
     DEFAULT_NEWLINE_SEQUENCE = "\n"
+    # arguments consumed by the plugin and not supported by the copy and file modules
+    PLUGIN_ARGS = ('newline_sequence', 'block_start_string', 'block_end_string', 'variable_start_string',
+                   'variable_end_string', 'trim_blocks', 'bucket', 'kms_alias', 'path', 'snapshot', 'region',
+                   'profile', 'ec2', 'templates')
+    # arguments of the copy module not supported by the file module
+    COPY_ARGS = ('src', 'dest', 'content', 'backup', 'validate', 'force', 'remote_src', 'decrypt', 'local_follow',
+                 'checksum', 'directory_mode')
 
     def get_checksum(self, dest, all_vars, try_directory=False, source=None, tmp=None):
         try:
@@ -42,6 +50,68 @@ class ActionModule(ActionBase):
 
         return dest_stat['checksum']
 
+    def _get_module_args(self, item_args=None):
+        """ task args without the ones consumed by the plugin, updated with the args of a templates item """
+        module_args = self._task.args.copy()
+        for arg in self.PLUGIN_ARGS:
+            module_args.pop(arg, None)
+        module_args.update(item_args or {})
+        return module_args
+
+    def _transfer(self, src, dest, resultant, follow, task_vars, tmp=None, item_args=None):
+        """ copy the rendered content to dest, unless dest already has it """
+        result = dict()
+        module_args = self._get_module_args(item_args)
+        if module_args.get('mode') == 'preserve':
+            # the mode of the template, as the template module does: the rendered file is a temporary file
+            module_args['mode'] = '0%03o' % stat.S_IMODE(os.stat(src).st_mode)
+
+        # skip the staging and the transfer when the destination already has the rendered content
+        dest_file = dest
+        if dest.endswith(os.sep):
+            dest_file = os.path.join(dest, os.path.basename(src))
+        remote_checksum = self.get_checksum(dest_file, task_vars, tmp=tmp)
+        if isinstance(remote_checksum, dict):
+            result.update(remote_checksum)
+            return result
+        if remote_checksum == checksum_s(resultant):
+            # the file attributes (mode, owner, ...) are still enforced, by the file module
+            file_args = module_args.copy()
+            for arg in self.COPY_ARGS:
+                file_args.pop(arg, None)
+            file_args.update(dict(path=dest_file, follow=follow))
+            result.update(self._execute_module(module_name='file', module_args=file_args, task_vars=task_vars))
+            return result
+
+        new_task = self._task.copy()
+        # remove unsupported variables
+        new_task.args = module_args
+        tempdir = tempfile.mkdtemp()
+        try:
+            result_file = os.path.join(tempdir, os.path.basename(src))
+            with open(result_file, 'wb') as f:
+                f.write(to_bytes(resultant, errors='surrogate_or_strict'))
+
+            new_task.args.update(
+                dict(
+                    src=result_file,
+                    dest=dest,
+                    follow=follow,
+                ),
+            )
+            copy_action = self._shared_loader_obj.action_loader.get('copy',
+                                                                    task=new_task,
+                                                                    connection=self._connection,
+                                                                    play_context=self._play_context,
+                                                                    loader=self._loader,
+                                                                    templar=self._templar,
+                                                                    shared_loader_obj=self._shared_loader_obj)
+            result.update(copy_action.run(task_vars=task_vars))
+        finally:
+            shutil.rmtree(tempdir)
+
+        return result
+
     def run(self, tmp=None, task_vars=None):
         """ handler for template operations """
         if task_vars is None:
@@ -55,9 +125,11 @@ class ActionModule(ActionBase):
         region = self._task.args.get('region', None)
         profile = self._task.args.get('profile', None)
         ec2 = self._task.args.get('ec2', True)
+        snapshot = boolean(self._task.args.get('snapshot', False), strict=False)
 
         src = self._task.args.get('src', None)
         dest = self._task.args.get('dest', None)
+        templates = self._task.args.get('templates', None)
 
         # force = boolean(self._task.args.get('force', True), strict=False)
         follow = boolean(self._task.args.get('follow', False), strict=False)
@@ -79,7 +151,15 @@ class ActionModule(ActionBase):
         if state is not None:
             result['failed'] = True
             result['msg'] = "'state' cannot be specified on a template"
-        elif src is None or dest is None:
+        elif templates is not None and (src is not None or dest is not None):
+            result['failed'] = True
+            result['msg'] = "templates is mutually exclusive with src and dest"
+        elif templates is not None and not (isinstance(templates, list) and
+                                            all(isinstance(item, dict) and item.get('src') and item.get('dest')
+                                                for item in templates)):
+            result['failed'] = True
+            result['msg'] = "templates needs to be a list of dictionaries with src and dest"
+        elif templates is None and (src is None or dest is None):
             result['failed'] = True
             result['msg'] = "src and dest are required"
         elif bucket is None:
@@ -88,86 +168,80 @@ class ActionModule(ActionBase):
         elif newline_sequence not in allowed_sequences:
             result['failed'] = True
             result['msg'] = "newline_sequence needs to be one of: \n, \r or \r\n"
-        else:
-            try:
-                src = self._find_needle('templates', src)
-            except AnsibleError as e:
-                result['failed'] = True
-                result['msg'] = to_text(e)
 
         if 'failed' in result:
             return result
 
-        # Get vault decrypted tmp file
+        items = templates if templates is not None else [dict(src=src, dest=dest)]
         try:
-            tmp_source = self._loader.get_real_file(src)
+            sources = [self._find_needle('templates', item['src']) for item in items]
+        except AnsibleError as e:
+            result['failed'] = True
+            result['msg'] = to_text(e)
+            return result
+
+        # Get vault decrypted tmp files
+        tmp_sources = []
+        try:
+            for source in sources:
+                tmp_sources.append(self._loader.get_real_file(source))
         except AnsibleFileNotFound as e:
+            for tmp_source in tmp_sources:
+                self._loader.cleanup_tmp_file(tmp_source)
             result['failed'] = True
-            result['msg'] = "could not find src=%s, %s" % (src, e)
+            result['msg'] = "could not find src=%s, %s" % (source, e)
             self._remove_tmp_path(tmp)
             return result
 
         # template the source data locally & get ready to transfer
         try:
-            # with open(tmp_source, 'r') as f:
-            #     template_data = to_text(f.read())
-
-            # add ansible 'template' vars
-            temp_vars = task_vars.copy()
-            temp_vars.update(generate_ansible_template_vars(src))
-
-            # get the role
-            if ec2:
-                ec2_metadata = MetadataFactory().get_instance(is_ec2=True)
-                template = jinja2.Template(path)
-                vault_path = template.render({'role_name': ec2_metadata.role})
-            else:
-                vault_path = path
+            # connections, vault listings and object bodies are reused by the tasks run in this process
+            vault_cache = get_vault_cache()
 
-            conn_manager = ConnectionManager(region=region, profile_name=profile)
-            s3vault = S3Vault(bucket, vault_path, connection_factory=conn_manager)
+            # get the role, querying the instance metadata only when the path references it
+            vault_path = vault_cache.resolve_path(path, ec2=ec2)
 
-            resultant = s3vault.render_template(tmp_source, **temp_vars)
+            if snapshot:
+                # read from the encrypted snapshot materialized once and shared by all the forks
+                s3vault = vault_cache.get_snapshot_vault(bucket, vault_path, region=region, profile=profile)
+            else:
+                s3vault = vault_cache.get_vault(bucket, vault_path, region=region, profile=profile)
+
+            # the union of the files referenced by all the templates is fetched in one parallel batch
+            s3vault.prefetch_templates(tmp_sources)
+
+            resultants = []
+            for source, tmp_source in zip(sources, tmp_sources):
+                # add ansible 'template' vars
+                temp_vars = task_vars.copy()
+                temp_vars.update(generate_ansible_template_vars(source))
+                # a source decrypted from an ansible vault is never written to the template bytecode cache
+                with disable_bytecode_cache() if tmp_source != source else nullcontext():
+                    resultants.append(s3vault.render_template(tmp_source, **temp_vars))
         except Exception as e:
             result['failed'] = True
             result['msg'] = "%s: %s" % (type(e).__name__, to_text(e))
             return result
         finally:
-            self._loader.cleanup_tmp_file(tmp_source)
+            for tmp_source in tmp_sources:
+                self._loader.cleanup_tmp_file(tmp_source)
 
-        new_task = self._task.copy()
-        # remove unsupported variables
-        new_task.args.pop('newline_sequence', None)
-        new_task.args.pop('block_start_string', None)
-        new_task.args.pop('block_end_string', None)
-        new_task.args.pop('variable_start_string', None)
-        new_task.args.pop('variable_end_string', None)
-        new_task.args.pop('trim_blocks', None)
-        new_task.args.pop('bucket', None)
-        new_task.args.pop('kms_alias', None)
-        new_task.args.pop('path', None)
-        tempdir = tempfile.mkdtemp()
-        try:
-            result_file = os.path.join(tempdir, os.path.basename(src))
-            with open(result_file, 'wb') as f:
-                f.write(to_bytes(resultant, errors='surrogate_or_strict'))
-
-            new_task.args.update(
-                dict(
-                    src=result_file,
-                    dest=dest,
-                    follow=follow,
-                ),
-            )
-            copy_action = self._shared_loader_obj.action_loader.get('copy',
-                                                                    task=new_task,
-                                                                    connection=self._connection,
-                                                                    play_context=self._play_context,
-                                                                    loader=self._loader,
-                                                                    templar=self._templar,
-                                                                    shared_loader_obj=self._shared_loader_obj)
-            result.update(copy_action.run(task_vars=task_vars))
-        finally:
-            shutil.rmtree(tempdir)
+        if templates is None:
+            result.update(self._transfer(sources[0], dest, resultants[0], follow, task_vars, tmp=tmp))
+            return result
 
+        results = []
+        for item, source, resultant in zip(items, sources, resultants):
+            item_args = dict((k, v) for k, v in item.items() if k not in ('src', 'dest'))
+            item_follow = boolean(item.get('follow', follow), strict=False)
+            item_result = self._transfer(source, item['dest'], resultant, item_follow, task_vars, tmp=tmp,
+                                         item_args=item_args)
+            item_result['src'] = item['src']
+            item_result.setdefault('dest', item['dest'])
+            results.append(item_result)
+        result['results'] = results
+        result['changed'] = any(item_result.get('changed', False) for item_result in results)
+        if any(item_result.get('failed', False) for item_result in results):
+            result['failed'] = True
+            result['msg'] = "one or more templates failed"
         return result
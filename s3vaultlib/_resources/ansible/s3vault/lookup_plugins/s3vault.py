@@ -0,0 +1,92 @@
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+from ansible.errors import AnsibleError
+from ansible.module_utils._text import to_text
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.plugins.lookup import LookupBase
+from s3vaultlib.utils.vaultcache import get_vault_cache
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+DOCUMENTATION = """
+    lookup: s3vault
+    short_description: read files and configuration keys from a S3Vault
+    description:
+      - Each term is either C(config:key), with key as dotted path in the json configuration,
+        or C(file) to read the whole content of a file.
+      - The distinct files of all the terms are fetched in parallel, and the vault is cached by the process.
+    options:
+      _terms:
+        description: terms to look up
+        required: True
+      bucket:
+        description: S3 bucket of the vault
+        required: True
+      path:
+        description: vault path, role_name is rendered with the role of the EC2 instance
+        default: role/{{ role_name }}/encrypted
+      region:
+        description: aws region
+      profile:
+        description: aws profile
+      ec2:
+        description: True to render the path with the role of the EC2 instance
+        default: True
+      snapshot:
+        description: True to read from the encrypted snapshot shared by the forks
+        default: False
+"""
+
+EXAMPLES = """
+- debug:
+    msg: "{{ lookup('s3vault', 'config:db.password', 'config:db.user', bucket='mybucket', ec2=False,
+                    path='myapp') }}"
+"""
+
+
+class LookupModule(LookupBase):
+
+    def run(self, terms, variables=None, **kwargs):
+        bucket = kwargs.get('bucket', None)
+        path = kwargs.get('path', 'role/{{ role_name }}/encrypted')
+        region = kwargs.get('region', None)
+        profile = kwargs.get('profile', None)
+        ec2 = boolean(kwargs.get('ec2', True), strict=False)
+        snapshot = boolean(kwargs.get('snapshot', False), strict=False)
+        if bucket is None:
+            raise AnsibleError('bucket is required')
+
+        lookups = []
+        for term in terms:
+            name, _, key = to_text(term).partition(':')
+            if not name:
+                raise AnsibleError('invalid term: {t}'.format(t=term))
+            lookups.append((name, key))
+
+        try:
+            vault_cache = get_vault_cache()
+            vault_path = vault_cache.resolve_path(path, ec2=ec2)
+            if snapshot:
+                s3vault = vault_cache.get_snapshot_vault(bucket, vault_path, region=region, profile=profile)
+            else:
+                s3vault = vault_cache.get_vault(bucket, vault_path, region=region, profile=profile)
+            # one parallel batch for the distinct files of all the terms
+            s3vault.prefetch_files([name for name, _ in lookups])
+            results = []
+            for name, key in lookups:
+                if key:
+                    results.append(s3vault.get_property(name, key))
+                else:
+                    results.append(to_text(s3vault.get_file(name), errors='surrogate_or_strict'))
+        except KeyError as e:
+            raise AnsibleError('key not found in the vault: {e}'.format(e=to_text(e)))
+        except Exception as e:
+            raise AnsibleError('%s: %s' % (type(e).__name__, to_text(e)))
+        return results
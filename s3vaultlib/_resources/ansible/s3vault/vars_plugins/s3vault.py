@@ -0,0 +1,209 @@
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+import os
+import threading
+import time
+from collections.abc import Mapping
+
+from ansible.errors import AnsibleError, AnsibleParserError
+from ansible.inventory.group import Group
+from ansible.inventory.host import Host
+from ansible.module_utils._text import to_text
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.module_utils.six import string_types
+from ansible.plugins.vars import BaseVarsPlugin
+from ansible.utils.unsafe_proxy import wrap_var
+from ansible.utils.vars import combine_vars
+from s3vaultlib.utils.vaultcache import get_vault_cache
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+DOCUMENTATION = """
+    vars: s3vault
+    short_description: expose the json configurations of a S3Vault as host and group variables
+    description:
+      - Reads the mapping file s3vault_vars.yml next to the inventory, which maps groups and hosts to vault paths.
+      - Each configuration becomes a variable named after the file, with an optional prefix.
+      - The configurations of a path are fetched and parsed the first time one of them is accessed, and cached
+        for all the hosts and groups that share the path, until the ttl of the vault cache expires.
+"""
+
+EXAMPLES = """
+# s3vault_vars.yml
+bucket: mybucket
+region: eu-west-1
+ec2: false
+groups:
+  webservers:
+    path: myapp/web
+    prefix: vault_
+hosts:
+  db01:
+    path: myapp/db
+    configs: [conf_db]
+"""
+
+MAPPING_FILE = 's3vault_vars.yml'
+
+_CONFIGS = {}
+_CONFIGS_LOCK = threading.Lock()
+
+
+class VaultConfigs(object):
+    """
+    Json configurations of a vault path, shared by the hosts and groups mapped to it. The configurations are
+    fetched in one parallel batch and parsed on the first access to any of them
+    """
+
+    def __init__(self, vault_cache, bucket, path, region=None, profile=None, configs=()):
+        self._vault_cache = vault_cache
+        self._vault_args = (bucket, path, dict(region=region, profile=profile))
+        self._names = list(configs) or None
+        self._data = None
+        self._lock = threading.Lock()
+        self.timestamp = time.time()
+
+    def _get_vault(self):
+        bucket, path, kwargs = self._vault_args
+        return self._vault_cache.get_vault(bucket, path, **kwargs)
+
+    @property
+    def names(self):
+        """ names of the configurations, listing the path when they are not configured """
+        with self._lock:
+            if self._names is None:
+                self._names = [s3fsobj.name for s3fsobj in self._get_vault().iter_files()]
+            return self._names
+
+    def get(self, name):
+        """ return the parsed configuration, loading all the configurations of the path on first use """
+        names = self.names
+        with self._lock:
+            if self._data is None:
+                try:
+                    s3fsobjects = self._get_vault().prefetch_files(names)
+                except Exception as e:
+                    raise AnsibleError('%s: %s' % (type(e).__name__, to_text(e)))
+                data = {}
+                for s3fsobj in s3fsobjects:
+                    try:
+                        # vault values must never be templated by ansible
+                        data[s3fsobj.name] = wrap_var(json.loads(s3fsobj.raw()))
+                    except ValueError:
+                        # not a configuration
+                        continue
+                self._data = data
+        if not isinstance(self._data.get(name), Mapping):
+            raise AnsibleError('{n} is not a json configuration'.format(n=name))
+        return self._data[name]
+
+
+class VaultConfig(Mapping):
+    """
+    Variable holding a json configuration, loaded on first access
+    """
+
+    def __init__(self, configs, name):
+        self._configs = configs
+        self._name = name
+
+    def __getitem__(self, key):
+        return self._configs.get(self._name)[key]
+
+    def __iter__(self):
+        return iter(self._configs.get(self._name))
+
+    def __len__(self):
+        return len(self._configs.get(self._name))
+
+    def __repr__(self):
+        return 'VaultConfig({n})'.format(n=self._name)
+
+    # read-only view: the copies share the loaded configuration
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+class VarsModule(BaseVarsPlugin):
+
+    def __init__(self):
+        super(VarsModule, self).__init__()
+        self._mappings = {}
+
+    def _get_mapping(self, loader, path):
+        if path not in self._mappings:
+            mapping_file = os.path.join(path, MAPPING_FILE)
+            mapping = {}
+            if os.path.isfile(mapping_file):
+                mapping = loader.load_from_file(mapping_file, cache=True, unsafe=True) or {}
+            self._mappings[path] = mapping
+        return self._mappings[path]
+
+    @staticmethod
+    def _get_configs(mapping, entry):
+        """ return the configurations of a vault path, shared by the entries with the same path """
+        bucket = entry.get('bucket', mapping.get('bucket'))
+        region = entry.get('region', mapping.get('region'))
+        profile = entry.get('profile', mapping.get('profile'))
+        ec2 = boolean(entry.get('ec2', mapping.get('ec2', True)), strict=False)
+        configs = entry.get('configs', ())
+        if isinstance(configs, string_types):
+            configs = [configs]
+        configs = tuple(configs)
+        if not bucket or not entry.get('path'):
+            raise AnsibleParserError('bucket and path are required in {f}'.format(f=MAPPING_FILE))
+        vault_cache = get_vault_cache()
+        vault_path = vault_cache.resolve_path(entry['path'], ec2=ec2)
+        key = (bucket, vault_path, region, profile, configs)
+        with _CONFIGS_LOCK:
+            if key not in _CONFIGS or time.time() - _CONFIGS[key].timestamp > vault_cache.ttl:
+                _CONFIGS[key] = VaultConfigs(vault_cache, bucket, vault_path, region=region, profile=profile,
+                                             configs=configs)
+            return _CONFIGS[key]
+
+    def get_vars(self, loader, path, entities, cache=True):
+        if not isinstance(entities, list):
+            entities = [entities]
+
+        super(VarsModule, self).get_vars(loader, path, entities)
+
+        mapping = self._get_mapping(loader, path)
+        if not mapping:
+            return {}
+
+        data = {}
+        for entity in entities:
+            if isinstance(entity, Host):
+                section = mapping.get('hosts') or {}
+            elif isinstance(entity, Group):
+                section = mapping.get('groups') or {}
+            else:
+                raise AnsibleParserError('Supplied entity must be Host or Group, got %s instead' % (type(entity)))
+            entry = section.get(entity.name)
+            if not entry:
+                continue
+            try:
+                configs = self._get_configs(mapping, entry)
+                names = configs.names
+            except AnsibleParserError:
+                raise
+            except Exception as e:
+                raise AnsibleParserError('%s: %s' % (type(e).__name__, to_text(e)))
+            prefix = entry.get('prefix', '')
+            data = combine_vars(data, {'{p}{n}'.format(p=prefix, n=name): VaultConfig(configs, name)
+                                       for name in names})
+        return data
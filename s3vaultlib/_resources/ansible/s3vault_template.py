@@ -165,9 +165,7 @@ def run_module():
         module.fail_json(msg='Unable to read from the source file', **result)
 
     with open(dest_file, 'wb') as f_handler:
-        f_handler.write(s3vault.render_template(src_file,
-                                                ansible_env=ansible_env,
-                                                environment=environment).encode())
+        s3vault.stream_template(src_file, f_handler, ansible_env=ansible_env, environment=environment)
 
     file_args = module.load_file_common_arguments(module.params)
     # path is used for the s3 bucket so we will override with the dest file
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+import base64
+import json
+import logging
+import os
+import socket
+
+from .defaults import DEFAULT_AGENT_SOCKET, AGENT_SOCKET_ENV
+from .. import __application__
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+
+class AgentClientException(Exception):
+    pass
+
+
+class AgentObjectNotFoundException(AgentClientException):
+    pass
+
+
+def connection_identity(region=None, profile=None, token=None, is_ec2=False):
+    """
+    Return the identity of the connections used to access the vaults. A client uses the agent only when
+    its identity matches the one of the agent
+
+    :param region: aws region
+    :param profile: aws profile
+    :param token: session token, as returned by TokenManager
+    :param is_ec2: True when running on an EC2 instance
+    :return: json serializable identity
+    :rtype: dict
+    """
+    return {'region': region, 'profile': profile, 'token': token['AccessKeyId'] if token else None,
+            'ec2': is_ec2}
+
+
+class AgentClient(object):
+    """
+    Thin client that forwards the vault requests to a running agent
+    """
+
+    def __init__(self, socket_path=None, timeout=30, identity=None):
+        """
+
+        :param socket_path: path of the agent unix socket
+        :param timeout: timeout in seconds for the requests
+        :param identity: connection identity of the client, see connection_identity
+        :type identity: dict
+        """
+        self.logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=self.__class__.__name__))
+        self._socket_path = os.path.expanduser(socket_path or os.environ.get(AGENT_SOCKET_ENV, DEFAULT_AGENT_SOCKET))
+        self._timeout = timeout
+        self._identity = identity
+        self._socket = None
+        self._stream = None
+
+    def _connect(self):
+        if self._socket:
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self._timeout)
+        try:
+            sock.connect(self._socket_path)
+        except socket.error:
+            sock.close()
+            raise
+        self._socket = sock
+        self._stream = sock.makefile('rb')
+
+    def close(self):
+        if self._stream:
+            self._stream.close()
+        if self._socket:
+            self._socket.close()
+        self._socket = None
+        self._stream = None
+
+    def is_available(self):
+        """
+        Return true if an agent is listening on the socket and serves the identity of the client
+
+        :return: True or False
+        :rtype: bool
+        """
+        if not os.path.exists(self._socket_path):
+            return False
+        try:
+            response = self.request('ping')
+        except (socket.error, AgentClientException) as e:
+            self.logger.debug('Agent not available on socket: {s}. Error: {e}'.format(s=self._socket_path, e=str(e)))
+            self.close()
+            return False
+        if response.get('identity') != self._identity:
+            self.logger.debug('Agent on socket: {s} uses a different connection identity'.format(s=self._socket_path))
+            self.close()
+            return False
+        return True
+
+    def request(self, command, **params):
+        """
+        Send a request to the agent
+
+        :param command: command to execute
+        :param params: parameters of the command
+        :return: the response
+        :rtype: dict
+        """
+        self._connect()
+        params['command'] = command
+        params['identity'] = self._identity
+        self._socket.sendall(json.dumps(params).encode() + b'\n')
+        line = self._stream.readline()
+        if not line:
+            self.close()
+            raise AgentClientException('Connection closed by the agent')
+        response = json.loads(line.decode('utf-8'))
+        if response.get('status') == 'ok':
+            return response
+        if response.get('type') == 'not_found':
+            raise AgentObjectNotFoundException(response.get('error'))
+        if response.get('type') == 'key_error':
+            raise KeyError(response.get('error'))
+        raise AgentClientException('{t}: {e}'.format(t=response.get('type'), e=response.get('error')))
+
+    def get_file(self, bucket, path, name):
+        """
+        Get a file from S3Vault via the agent
+
+        :param bucket: bucket
+        :param path: path
+        :param name: filename
+        :return: file content
+        :rtype: bytes
+        """
+        return base64.b64decode(self.request('get', bucket=bucket, path=path, name=name)['data'])
+
+    def get_property(self, bucket, path, configfile, key):
+        """
+        Get a configuration property via the agent
+
+        :param bucket: bucket
+        :param path: path
+        :param configfile: configuration file
+        :param key: key to query
+        :return: value of the key
+        """
+        return self.request('get_property', bucket=bucket, path=path, config=configfile, key=key)['data']
+
+    def render_template(self, bucket, path, template_file, **kwargs):
+        """
+        Renders a template file via the agent
+
+        :param bucket: bucket
+        :param path: path
+        :param template_file: file name to use as template
+        :param kwargs: additional variables to use in the rendering, must be json serializable
+        :return: rendered content
+        :rtype: bytes
+        """
+        response = self.request('render', bucket=bucket, path=path, template=os.path.abspath(template_file),
+                                variables=kwargs)
+        return base64.b64decode(response['data'])
@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+DEFAULT_AGENT_SOCKET = '~/.s3vaultlib.agent.sock'
+DEFAULT_AGENT_TTL = 60
+AGENT_SOCKET_ENV = 'S3VAULTLIB_AGENT_SOCKET'
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+import base64
+import json
+import logging
+import os
+import socket
+import struct
+
+from six.moves import socketserver
+
+from .defaults import DEFAULT_AGENT_TTL
+from .. import __application__
+from ..s3vaultlib import S3VaultObjectNotFoundException
+from ..s3.s3fs import S3FsObjectNotFoundException
+from ..utils.vaultcache import VaultCache
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+
+class AgentServerException(Exception):
+    pass
+
+
+class AgentRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handles the json requests (one per line) sent by an agent client
+    """
+
+    def handle(self):
+        agent = self.server.agent  # type: AgentServer
+        if not agent.is_peer_allowed(self.request):
+            self.wfile.write(agent.encode_response(agent.error_response('permission_denied', 'Peer not allowed')))
+            return
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            self.wfile.write(agent.encode_response(agent.dispatch(line)))
+            self.wfile.flush()
+
+
+class ThreadingUnixStreamServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class AgentServer(object):
+    """
+    Local agent that keeps warm connections and cached vaults, and serves them over a Unix domain socket
+    """
+    PEERCRED_FORMAT = '3i'
+
+    def __init__(self, socket_path, connection_factory, ttl=DEFAULT_AGENT_TTL, allowed_uids=None, identity=None):
+        """
+
+        :param socket_path: path of the unix socket to listen on
+        :param connection_factory: connection factory
+        :type connection_factory: ConnectionManager
+        :param ttl: seconds after which the listing of a cached vault is refreshed
+        :param allowed_uids: uids allowed to connect (default: the uid running the agent)
+        :param identity: connection identity of the agent, the requests with a different identity are rejected
+        :type identity: dict
+        """
+        self.logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=self.__class__.__name__))
+        self._socket_path = os.path.expanduser(socket_path)
+        self._allowed_uids = set(allowed_uids or [os.getuid()])
+        self._identity = identity
+        # all the vaults are read with the connection of the agent
+        self._vault_cache = VaultCache(ttl=ttl, connection_factory=lambda region=None, profile=None: connection_factory)
+        self._server = None
+
+    def is_peer_allowed(self, connection):
+        """
+        Check the credentials of the process connected to the socket
+
+        :param connection: client socket
+        :return: True if the peer is allowed
+        :rtype: bool
+        """
+        if not hasattr(socket, 'SO_PEERCRED'):
+            # the access is restricted only by the permissions of the socket file
+            return True
+        creds = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize(self.PEERCRED_FORMAT))
+        pid, uid, _ = struct.unpack(self.PEERCRED_FORMAT, creds)
+        if uid not in self._allowed_uids:
+            self.logger.warning('Rejected connection from pid: {p}, uid: {u}'.format(p=pid, u=uid))
+            return False
+        return True
+
+    def get_vault(self, bucket, path):
+        """
+        Return the cached vault for bucket and path
+
+        :param bucket: bucket
+        :param path: path
+        :return: the vault
+        :rtype: S3Vault
+        """
+        return self._vault_cache.get_vault(bucket, path)
+
+    @staticmethod
+    def error_response(error_type, message):
+        return {'status': 'error', 'type': error_type, 'error': message}
+
+    @staticmethod
+    def encode_response(response):
+        return json.dumps(response).encode() + b'\n'
+
+    def _command_ping(self, request):
+        return {'pid': os.getpid(), 'identity': self._identity}
+
+    def _command_get(self, request):
+        s3vault = self.get_vault(request['bucket'], request['path'])
+        return {'data': base64.b64encode(s3vault.get_file(request['name'])).decode()}
+
+    def _command_get_property(self, request):
+        s3vault = self.get_vault(request['bucket'], request['path'])
+        return {'data': s3vault.get_property(request['config'], request['key'])}
+
+    def _command_render(self, request):
+        s3vault = self.get_vault(request['bucket'], request['path'])
+        data = s3vault.render_template(request['template'], **request.get('variables', {}))
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return {'data': base64.b64encode(data).decode()}
+
+    def dispatch(self, line):
+        """
+        Process a request
+
+        :param line: json encoded request
+        :return: the response
+        :rtype: dict
+        """
+        try:
+            request = json.loads(line.decode('utf-8'))
+            handler = getattr(self, '_command_{c}'.format(c=request['command']), None)
+            if not handler:
+                return self.error_response('invalid_request', 'Unknown command: {c}'.format(c=request['command']))
+            if request['command'] != 'ping' and request.get('identity') != self._identity:
+                # the vaults are read with the credentials of the agent
+                return self.error_response('permission_denied', 'Connection identity not served by the agent')
+            response = handler(request)
+        except (S3FsObjectNotFoundException, S3VaultObjectNotFoundException) as e:
+            return self.error_response('not_found', str(e))
+        except KeyError as e:
+            return self.error_response('key_error', str(e))
+        except (ValueError, TypeError) as e:
+            return self.error_response('invalid_request', str(e))
+        except Exception as e:
+            self.logger.exception('Error while processing the request')
+            return self.error_response('error', '{t}: {e}'.format(t=type(e).__name__, e=str(e)))
+        response['status'] = 'ok'
+        return response
+
+    def _bind(self):
+        if os.path.exists(self._socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self._socket_path)
+            except socket.error:
+                self.logger.info('Removing stale socket: {s}'.format(s=self._socket_path))
+                os.unlink(self._socket_path)
+            else:
+                raise AgentServerException('Agent already running on socket: {s}'.format(s=self._socket_path))
+            finally:
+                probe.close()
+        # the socket is created with owner only permissions
+        umask = os.umask(0o177)
+        try:
+            self._server = ThreadingUnixStreamServer(self._socket_path, AgentRequestHandler)
+        finally:
+            os.umask(umask)
+        self._server.agent = self
+
+    def serve_forever(self):
+        """
+        Serve the requests until shutdown is called
+        """
+        self._bind()
+        self.logger.info('Agent listening on socket: {s}'.format(s=self._socket_path))
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if os.path.exists(self._socket_path):
+                os.unlink(self._socket_path)
+
+    def shutdown(self):
+        if self._server:
+            self._server.shutdown()
@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 import argparse
 import logging.config
+import os
+import signal
 import sys
 
 from . import __application__
 from . import __version__
+from .agent.client import AgentClient, connection_identity
+from .agent.defaults import AGENT_SOCKET_ENV, DEFAULT_AGENT_SOCKET, DEFAULT_AGENT_TTL
 from .commands import (
+    command_agent,
     command_createcloudformation,
     command_ansiblepath,
     command_createconfig,
@@ -13,11 +18,16 @@ from .commands import (
     command_configedit,
     command_configset,
     command_get,
+    command_ls,
     command_push,
+    command_sync,
     command_template, is_ec2
 )
 from .connection.connectionmanager import ConnectionManager
 from .connection.tokenmanager import TokenManager
+from .s3.s3fs import MAX_PREFETCH_WORKERS
+from .sync.defaults import DEFAULT_SYNC_WORKERS
+from .sync.vaultsync import VaultSyncException, parse_s3_uri
 
 __author__ = "Giuseppe Chiesa"
 __copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
@@ -52,6 +62,13 @@ def check_args():
                         help='Identifies if the commands are issued in a ec2 instance or via external devices',
                         action='store_true',
                         default=False)
+    parser.add_argument('--agent-socket', dest='agent_socket', required=False,
+                        help='Unix socket of the s3vault agent (default: {})'.format(DEFAULT_AGENT_SOCKET),
+                        default=os.environ.get(AGENT_SOCKET_ENV, DEFAULT_AGENT_SOCKET))
+    parser.add_argument('--no-agent', dest='no_agent', required=False,
+                        help='Do not use the s3vault agent even if it is running',
+                        action='store_true',
+                        default=False)
 
     common_parser = argparse.ArgumentParser(add_help=False)
     common_parser.add_argument('-b', '--bucket', dest='bucket', required=False, default='',
@@ -77,8 +94,23 @@ def check_args():
                           help='Template to expand from Vault path (default: stdin)',
                           type=argparse.FileType('rb'), default='-')
     template.add_argument('-d', '--dest', dest='dest', required=False,
-                          help='Destination file  (default: stdout)',
-                          type=argparse.FileType('wb'), default='-')
+                          help='Destination file, written only when the content changes  (default: stdout)',
+                          default='-')
+    template.add_argument('--batch', dest='batch', required=False, action='append', default=[],
+                          metavar='TEMPLATE:DEST',
+                          help='Template and destination to expand in the same run. Can be repeated')
+    template.add_argument('--template-dir', dest='template_dir', required=False, default=None,
+                          help='Directory tree of templates to expand into --dest-dir')
+    template.add_argument('--dest-dir', dest='dest_dir', required=False, default=None,
+                          help='Destination directory for the templates in --template-dir')
+    template.add_argument('--template-suffix', dest='template_suffix', required=False, default='.j2',
+                          help='Suffix removed from the templates in --template-dir (default: .j2)')
+    template.add_argument('-w', '--watch', dest='watch', required=False, action='store_true', default=False,
+                          help='Keep polling the Vault and expand the template again when its inputs change')
+    template.add_argument('-i', '--interval', dest='interval', required=False, type=int, default=60,
+                          help='Seconds between the polls in watch mode (default: 60)')
+    template.add_argument('-r', '--reload-command', dest='reload_command', required=False, default=None,
+                          help='Shell command to run when the destination file changes')
 
     # push file
     pushfile = subparsers.add_parser('push', help='Push a file in the Vault',
@@ -89,6 +121,18 @@ def check_args():
     pushfile.add_argument('-d', '--dest', dest='dest', required=True,
                           help='Destination name')
 
+    # sync directory
+    syncdir = subparsers.add_parser('sync', help='Synchronize a local directory with a Vault path',
+                                    parents=[common_parser])  # type: argparse.ArgumentParser
+    syncdir.add_argument('src', help='Source: local directory or s3://<bucket>/<path>')
+    syncdir.add_argument('dst', help='Destination: local directory or s3://<bucket>/<path>')
+    syncdir.add_argument('--delete', dest='delete', required=False, action='store_true', default=False,
+                         help='Delete the destination files missing in the source')
+    syncdir.add_argument('-n', '--dry-run', dest='dry_run', required=False, action='store_true', default=False,
+                         help='Print the operations without executing them')
+    syncdir.add_argument('--workers', dest='workers', required=False, type=int, default=DEFAULT_SYNC_WORKERS,
+                         help='Concurrent uploads or downloads (default: {})'.format(DEFAULT_SYNC_WORKERS))
+
     # get file
     getfile = subparsers.add_parser('get', help='Get a file in the Vault',
                                     parents=[common_parser])  # type: argparse.ArgumentParser
@@ -98,6 +142,18 @@ def check_args():
                          help='Destination name  (default: stdout)',
                          type=argparse.FileType('wb'), default='-')
 
+    # list files
+    lsfiles = subparsers.add_parser('ls', help='List the files in the Vault',
+                                    parents=[common_parser])  # type: argparse.ArgumentParser
+    lsfiles.add_argument('pattern', nargs='?', default=None,
+                         help='Glob pattern to filter the file names (default: all files)')
+    lsfiles.add_argument('-l', '--long', dest='long', required=False, action='store_true', default=False,
+                         help='Include the server side encryption and KMS key of each file')
+    lsfiles.add_argument('--json', dest='json', required=False, action='store_true', default=False,
+                         help='Output one json document per line')
+    lsfiles.add_argument('--workers', dest='workers', required=False, type=int, default=MAX_PREFETCH_WORKERS,
+                         help='Concurrent requests used by --long (default: {})'.format(MAX_PREFETCH_WORKERS))
+
     # set property
     setproperty = subparsers.add_parser('configset', help='Set a property in a configuration file in the Vault',
                                         parents=[common_parser])  # type: argparse.ArgumentParser
@@ -111,6 +167,9 @@ def check_args():
                              choices=['int', 'string', 'list', 'dict', 'yaml', 'json'],
                              default='string',
                              help='Data type for the value')
+    setproperty.add_argument('--canonical-json', dest='canonical_json', required=False, action='store_true',
+                             default=False,
+                             help='Write the configuration as canonical json (sorted keys, compact separators)')
     # edit property
     editproperty = subparsers.add_parser('configedit', help='Edit a configuration file in the Vault',
                                          parents=[common_parser])  # type: argparse.ArgumentParser
@@ -120,6 +179,9 @@ def check_args():
                               choices=['yaml', 'json'],
                               default='yaml',
                               help='Editor type to use (yaml, json)')
+    editproperty.add_argument('--canonical-json', dest='canonical_json', required=False, action='store_true',
+                              default=False,
+                              help='Write the configuration as canonical json (sorted keys, compact separators)')
     # create session
     create_session = subparsers.add_parser('create_session', help='Create a new session with assume role')  # type: argparse.ArgumentParser
     create_session.add_argument('--no-eid', '--no-external-id', dest='no_external_id', action='store_true',
@@ -148,6 +210,12 @@ def check_args():
     cloudformation_generate.add_argument('-o', '--output', dest='output_file', required=True,
                                          type=argparse.FileType('wb'),
                                          help='CloudFormation output file')
+    # agent
+    agent = subparsers.add_parser('agent', help='Run a local agent that serves the Vault over a unix '
+                                                'socket')  # type: argparse.ArgumentParser
+    agent.add_argument('--ttl', dest='ttl', required=False, type=int, default=DEFAULT_AGENT_TTL,
+                       help='Seconds after which the cached listing of a vault is refreshed '
+                            '(default: {})'.format(DEFAULT_AGENT_TTL))
     # ansible path
     subparsers.add_parser('ansible_path', help='Resolve the ansible module path')  # type: argparse.ArgumentParser
 
@@ -163,7 +231,9 @@ def validate_args(parser):
         'create_session',
         'create_s3vault_config',
         'create_cloudformation',
-        'ansible_path'
+        'ansible_path',
+        'agent',
+        'sync'
     ]
     parser.set_defaults(uri='', bucket='', path='')
 
@@ -178,6 +248,24 @@ def validate_args(parser):
 
     if not args.bucket and not args.path and (args.command not in commands_no_bucket_required):
         parser.error('--bucket and --path required, or alternatively --uri')
+
+    if args.command == 'sync':
+        try:
+            src_uri, dst_uri = parse_s3_uri(args.src), parse_s3_uri(args.dst)
+        except VaultSyncException as e:
+            parser.error(str(e))
+        if bool(src_uri) == bool(dst_uri):
+            parser.error('sync requires one local directory and one s3://<bucket>/<path>')
+        args.bucket, args.path = src_uri or dst_uri
+
+    if args.command == 'template':
+        if bool(args.template_dir) != bool(args.dest_dir):
+            parser.error('--template-dir and --dest-dir must be used together')
+        if args.batch and args.template_dir:
+            parser.error('--batch and --template-dir are mutually exclusive')
+        is_single = not args.batch and not args.template_dir
+        if args.watch and is_single and (args.dest == '-' or args.template.name == '<stdin>'):
+            parser.error('--watch requires --template and --dest files')
     return args
 
 
@@ -249,6 +337,19 @@ def main():
             conn_manager = ConnectionManager(region=args.region, profile_name=args.profile, is_ec2=is_ec2(args))
         return conn_manager
 
+    def get_connection_identity():
+        return connection_identity(region=args.region, profile=args.profile,
+                                   token=TokenManager(is_ec2=is_ec2(args)).token, is_ec2=is_ec2(args))
+
+    def get_agent_client():
+        if args.no_agent:
+            return None
+        agent_client = AgentClient(args.agent_socket, identity=get_connection_identity())
+        if not agent_client.is_available():
+            return None
+        logger.debug('Using agent on socket: {s}'.format(s=args.agent_socket))
+        return agent_client
+
     args = check_args()
     configure_logging(args.log_level)
     logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=__name__))
@@ -257,13 +358,22 @@ def main():
     try:
         if args.command == 'template':
             exception_message = 'Error while expanding the template.'
-            command_template(args, get_connection())
+            # the watch mode polls the vault directly
+            agent_client = None if args.watch else get_agent_client()
+            command_template(args, None if agent_client else get_connection(), agent_client=agent_client)
         elif args.command == 'push':
             exception_message = 'Error while pushing file.'
             command_push(args, get_connection())
+        elif args.command == 'sync':
+            exception_message = 'Error while synchronizing.'
+            command_sync(args, get_connection())
         elif args.command == 'get':
             exception_message = 'Error while getting file.'
-            command_get(args, get_connection())
+            agent_client = get_agent_client()
+            command_get(args, None if agent_client else get_connection(), agent_client=agent_client)
+        elif args.command == 'ls':
+            exception_message = 'Error while listing files.'
+            command_ls(args, get_connection())
         elif args.command == 'configset':
             exception_message = 'Error while setting property.'
             command_configset(args, get_connection())
@@ -279,6 +389,10 @@ def main():
         elif args.command == 'create_cloudformation':
             exception_message = 'Exception while generating CloudFormation.'
             command_createcloudformation(args)
+        elif args.command == 'agent':
+            exception_message = 'Error while running the agent.'
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            command_agent(args, get_connection(), identity=get_connection_identity())
         elif args.command == 'ansible_path':
             exception_message = 'Error while retrieving ansible path'
             command_ansiblepath()
@@ -5,17 +5,25 @@ import json
 import logging
 import logging.config
 import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from getpass import getpass
 from io import BytesIO
 
-from humanfriendly import format_timespan
+from humanfriendly import format_size, format_timespan
 
 from . import __application__
+from .agent.server import AgentServer
 from .cloudformation.policymanager import PolicyManager
 from .config.configmanager import ConfigManager
 from .connection.tokenmanager import TokenManager
 from .editor.editor import Editor, EditorAbortException
+from .s3.s3fs import MAX_PREFETCH_WORKERS
+from .s3.s3fsobject import S3FsObject, dumps_json
 from .s3vaultlib import S3Vault, S3VaultObjectNotFoundException, S3VaultException
+from .sync.vaultsync import VaultSync, parse_s3_uri
 from .utils import yaml, io
 
 __author__ = "Giuseppe Chiesa"
@@ -28,6 +36,7 @@ __status__ = "PerpetualBeta"
 
 __all__ = [
     "is_ec2",
+    "command_agent",
     "command_ansiblepath",
     "command_configedit",
     "command_configset",
@@ -35,10 +44,14 @@ __all__ = [
     "command_createconfig",
     "command_createtoken",
     "command_get",
+    "command_ls",
     "command_push",
+    "command_sync",
     "command_template",
 ]
 
+MAX_WATCH_BACKOFF = 600
+
 
 def load_from_yaml(filename):
     if not os.path.expanduser(filename) or not os.access(filename, os.R_OK):
@@ -94,12 +107,133 @@ def convert_type(value, value_type):
     return converted_object
 
 
-def command_template(args, conn_manager):
-    s3vault = S3Vault(args.bucket, args.path, connection_factory=conn_manager)
+def get_template_pairs(args):
+    """
+    Return the list of (template, destination) to expand, from the template command arguments
+
+    :param args: arguments of the template command
+    :return: list of tuples (template file name, destination)
+    :rtype: list
+    """
+    if args.batch:
+        pairs = []
+        for pair in args.batch:
+            template_file, _, dest = pair.rpartition(':')
+            if not template_file or not dest:
+                raise S3VaultException('Invalid batch template: {p}. Expected TEMPLATE:DEST'.format(p=pair))
+            pairs.append((template_file, dest))
+        return pairs
+    if args.template_dir:
+        pairs = []
+        for root, _, files in os.walk(args.template_dir):
+            for filename in sorted(files):
+                template_file = os.path.join(root, filename)
+                dest = os.path.join(args.dest_dir, os.path.relpath(template_file, args.template_dir))
+                if args.template_suffix and dest.endswith(args.template_suffix):
+                    dest = dest[:-len(args.template_suffix)]
+                pairs.append((template_file, dest))
+        return sorted(pairs)
+    return [(args.template.name, args.dest)]
+
+
+def create_destination_dir(dest):
+    if dest != io.STDOUT and os.path.dirname(dest) and not os.path.isdir(os.path.dirname(dest)):
+        os.makedirs(os.path.dirname(dest))
+
+
+def write_template_destination(dest, data):
+    create_destination_dir(dest)
+    return io.write_to_destination(dest, data) and dest != io.STDOUT
+
+
+def stream_template_destination(s3vault, template_file, dest, **kwargs):
+    create_destination_dir(dest)
+    with io.open_destination(dest) as file_handler:
+        s3vault.stream_template(template_file, file_handler, **kwargs)
+    return file_handler.changed and dest != io.STDOUT
+
+
+def command_template(args, conn_manager, agent_client=None):
+    logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=__name__))
     ansible_env = copy.deepcopy(os.environ)
     environment = copy.deepcopy(os.environ)
-    data = s3vault.render_template(args.template.name, ansible_env=ansible_env, environment=environment)
-    io.write_with_modecheck(args.dest, data.encode())
+    pairs = get_template_pairs(args)
+    if agent_client and not args.watch:
+        changed = False
+        for template_file, dest in pairs:
+            data = agent_client.render_template(args.bucket, args.path, template_file,
+                                                ansible_env=dict(ansible_env), environment=dict(environment))
+            changed = write_template_destination(dest, data) or changed
+        if changed:
+            run_reload_command(args.reload_command)
+        return
+    s3vault = S3Vault(args.bucket, args.path, connection_factory=conn_manager)
+    fingerprints = {}
+    failures = 0
+    while True:
+        try:
+            if fingerprints or failures:
+                s3vault.refresh()
+            expand_outdated_templates(s3vault, pairs, fingerprints, args.reload_command,
+                                      ansible_env=ansible_env, environment=environment)
+        except Exception as e:
+            if not args.watch:
+                raise
+            # the destinations are replaced atomically, so they keep the last expanded content
+            failures += 1
+            logger.error('Error while expanding the templates, retrying. '
+                         'Error: {t} / {e}'.format(t=str(type(e)), e=str(e)))
+        else:
+            failures = 0
+        if not args.watch:
+            return
+        time.sleep(min(args.interval * 2 ** failures, MAX_WATCH_BACKOFF))
+
+
+def expand_outdated_templates(s3vault, pairs, fingerprints, reload_command, **kwargs):
+    """
+    Expand the templates whose inputs changed since the previous expansion and run the reload command
+    when a destination changed
+
+    :param s3vault: the vault
+    :type s3vault: S3Vault
+    :param pairs: list of tuples (template file name, destination)
+    :param fingerprints: fingerprints of the previous expansion, updated in place
+    :param reload_command: shell command to run when a destination changes
+    :param kwargs: additional variables to use in the rendering
+    """
+    logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=__name__))
+    current_fingerprints = {pair: s3vault.get_template_fingerprint(pair[0]) for pair in pairs}
+    outdated = [pair for pair in pairs if current_fingerprints[pair] != fingerprints.get(pair)]
+    if not outdated:
+        return
+    s3vault.prefetch_templates([template_file for template_file, _ in outdated])
+    with ThreadPoolExecutor(max_workers=min(MAX_PREFETCH_WORKERS, len(outdated))) as executor:
+        results = list(executor.map(lambda pair: stream_template_destination(s3vault, pair[0], pair[1], **kwargs),
+                                    outdated))
+    changed = False
+    for (template_file, dest), written in zip(outdated, results):
+        if written:
+            logger.info('Template: {t} expanded to: {d}'.format(t=template_file, d=dest))
+            changed = True
+    fingerprints.update(current_fingerprints)
+    if changed:
+        run_reload_command(reload_command)
+
+
+def run_reload_command(command):
+    """
+    Run the reload hook after the destination of a template changed
+
+    :param command: shell command to run
+    """
+    logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=__name__))
+    if not command:
+        return
+    logger.info('Running reload command: {c}'.format(c=command))
+    return_code = subprocess.call(command, shell=True)
+    if return_code != 0:
+        logger.error('Reload command exited with code: {r}'.format(r=return_code))
 
 
 def command_push(args, conn_manager):
@@ -113,18 +247,77 @@ def command_push(args, conn_manager):
     logger.debug('Metadata: {d}'.format(d=metadata))
 
 
-def command_get(args, conn_manager):
+def command_sync(args, conn_manager):
     logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=__name__))
     s3vault = S3Vault(args.bucket, args.path, connection_factory=conn_manager)
+    is_push = parse_s3_uri(args.dst) is not None
+    local_dir = args.src if is_push else args.dst
+    vault_sync = VaultSync(s3vault, local_dir, max_workers=args.workers, delete=args.delete, dry_run=args.dry_run)
+    if is_push:
+        logger.info('Synchronizing {d} to {b}/{p}'.format(d=local_dir, b=args.bucket, p=args.path))
+        operations = vault_sync.push(encryption_key_arn=args.kms_arn, key_alias=args.kms_alias)
+    else:
+        logger.info('Synchronizing {b}/{p} to {d}'.format(d=local_dir, b=args.bucket, p=args.path))
+        operations = vault_sync.pull()
+    for operation, name in operations:
+        sys.stdout.write('{d}{o}: {n}\n'.format(d='(dry run) ' if args.dry_run else '', o=operation, n=name))
+    logger.info('{n} files to synchronize'.format(n=len(operations)))
+
+
+def command_get(args, conn_manager, agent_client=None):
+    logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=__name__))
+    if agent_client:
+        logger.info('Retrieving file {s} via agent'.format(s=args.src))
+        io.write_with_modecheck(args.dest, agent_client.get_file(args.bucket, args.path, args.src))
+        logger.debug('File successfully created: {d}'.format(d=args.dest.name))
+        return
+    s3vault = S3Vault(args.bucket, args.path, connection_factory=conn_manager)
     logger.info('Retrieving file {s}'.format(s=args.src))
     logger.debug('Metadata: {m}'.format(m=s3vault.get_file_metadata(args.src)))
     io.write_with_modecheck(args.dest, s3vault.get_file(args.src))
     logger.debug('File successfully created: {d}'.format(d=args.dest.name))
 
 
+def format_ls_entry(s3fsobject, long_format=False, json_lines=False):
+    """
+    Format an entry for the ls command
+
+    :param s3fsobject: object to format
+    :param long_format: True to also include the encryption details
+    :param json_lines: True to format the entry as json
+    :return: formatted entry
+    :rtype: basestring
+    """
+    entry = {
+        'name': s3fsobject.name,
+        'size': s3fsobject.size,
+        'last_modified': s3fsobject.last_modified.isoformat() if s3fsobject.last_modified else None
+    }
+    if long_format:
+        metadata = s3fsobject.metadata
+        entry['server_side_encryption'] = metadata.get('ServerSideEncryption', '')
+        entry['kms_key_id'] = metadata.get('SSEKMSKeyId', '')
+    if json_lines:
+        return json.dumps(entry)
+    last_modified = s3fsobject.last_modified.strftime('%Y-%m-%d %H:%M:%S') if s3fsobject.last_modified else '-'
+    size = format_size(entry['size']) if entry['size'] is not None else '-'
+    if not long_format:
+        return '{m}  {s:>10}  {n}'.format(m=last_modified, s=size, n=entry['name'])
+    return '{m}  {s:>10}  {e:<8}  {k}  {n}'.format(m=last_modified, s=size,
+                                                   e=entry['server_side_encryption'] or '-',
+                                                   k=entry['kms_key_id'] or '-', n=entry['name'])
+
+
+def command_ls(args, conn_manager):
+    s3vault = S3Vault(args.bucket, args.path, connection_factory=conn_manager)
+    for s3fsobject in s3vault.iter_files(pattern=args.pattern, with_metadata=args.long, max_workers=args.workers):
+        sys.stdout.write(format_ls_entry(s3fsobject, long_format=args.long, json_lines=args.json) + '\n')
+        sys.stdout.flush()
+
+
 def command_configset(args, conn_manager):
     logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=__name__))
-    s3vault = S3Vault(args.bucket, args.path, connection_factory=conn_manager)
+    s3vault = S3Vault(args.bucket, args.path, connection_factory=conn_manager, canonical_json=args.canonical_json)
     metadata = s3vault.set_property(configfile=args.config,
                                     key=args.key,
                                     value=convert_type(args.value, args.value_type),
@@ -166,8 +359,15 @@ def command_configedit(args, conn_manager):
     except EditorAbortException:
         logger.warning('Config left unmodified.')
         return
+    result = editor.result.encode()
+    if args.canonical_json:
+        result = dumps_json(json.loads(result), canonical=True)
+    if remote_exists and (json_data == result or
+                          (not args.canonical_json and S3FsObject.json_equals(json_data, result))):
+        logger.info('Config: {c} unchanged, skipping the upload.'.format(c=args.config))
+        return
     # process the result
-    memoryfile = BytesIO(editor.result.encode())
+    memoryfile = BytesIO(result)
     metadata = s3vault.put_file(src=memoryfile,
                                 dest=args.config,
                                 key_alias=args.kms_alias,
@@ -176,6 +376,15 @@ def command_configedit(args, conn_manager):
     logger.debug('Metadata: {m}'.format(m=metadata))
 
 
+def command_agent(args, conn_manager, identity=None):
+    logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=__name__))
+    agent = AgentServer(args.agent_socket, conn_manager, ttl=args.ttl, identity=identity)
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Agent stopped.')
+
+
 def command_createtoken(args, conn_manager):
     logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=__name__))
     external_id = None
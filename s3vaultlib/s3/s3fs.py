@@ -1,11 +1,14 @@
 #!/usr/bin/env python
+import hashlib
 import logging
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
 from humanfriendly import format_size
 
-from .s3fsobject import S3FsObject
+from .s3fsobject import S3FsObject, CONTENT_HASH_METADATA
 from .. import __application__
 from ..connection.connectionmanager import ConnectionManager
 
@@ -19,6 +22,8 @@ __status__ = "PerpetualBeta"
 
 
 MAX_S3_RETURNED_OBJECTS = 999
+MAX_PREFETCH_WORKERS = 8
+GLOB_SPECIAL_CHARS = re.compile(r'[*?\[]')
 
 
 class S3FsException(Exception):
@@ -63,6 +68,14 @@ class S3Fs(object):
             return False
         return True
 
+    @property
+    def bucket(self):
+        return self._bucket
+
+    @property
+    def path(self):
+        return self._path
+
     @property
     def objects(self):
         """
@@ -70,6 +83,41 @@ class S3Fs(object):
         """
         return self._get_s3fsobjects()
 
+    @staticmethod
+    def glob_prefix(pattern):
+        """
+        Return the literal part of a glob pattern, usable as S3 prefix
+
+        :param pattern: glob pattern
+        :return: literal prefix
+        :rtype: basestring
+        """
+        match = GLOB_SPECIAL_CHARS.search(pattern)
+        if not match:
+            return pattern
+        return pattern[:match.start()]
+
+    def iter_objects(self, prefix=''):
+        """
+        Yield the s3fsobjects from the S3 path as the listing pages arrive. Only the direct children of the path
+        are listed: the sibling paths sharing its prefix and the nested keys are excluded
+
+        :param prefix: prefix of the object names to list
+        :return: generator of s3fsobjects
+        :rtype: collections.Iterable[S3FsObject]
+        """
+        path = self._path.strip('/')
+        key_prefix = '{p}/{n}'.format(p=path, n=prefix) if path else prefix
+        paginator = self.fs.get_paginator('list_objects_v2')
+        pages = paginator.paginate(Bucket=self._bucket,
+                                   Prefix=key_prefix,
+                                   Delimiter='/',
+                                   PaginationConfig={'PageSize': MAX_S3_RETURNED_OBJECTS})
+        for page in pages:
+            for elem in page.get('Contents', []):
+                if self.is_file(elem):
+                    yield S3FsObject(elem, self._bucket, self._path, self.fs)
+
     def _get_s3fsobjects(self, refresh=False):
         """
         load the s3fsobjects from an S3 path
@@ -80,18 +128,54 @@ class S3Fs(object):
         """
         if self._s3fs_objects and not refresh:
             return self._s3fs_objects
-        response = self.fs.list_objects_v2(Bucket=self._bucket,
-                                           Prefix=self._path,
-                                           MaxKeys=MAX_S3_RETURNED_OBJECTS)
-        if not response.get('Contents'):
-            self._s3fs_objects = []
-            return self._s3fs_objects
+        self._s3fs_objects = list(self.iter_objects())
+        return self._s3fs_objects
 
-        for elem in response.get('Contents'):
-            if self.is_file(elem):
-                self._s3fs_objects.append(S3FsObject(elem, self._bucket, self._path, self.fs))
+    def refresh(self):
+        """
+        Reload the listing of the S3 path. Objects whose ETag did not change keep their loaded content
+
+        :return: list of object
+        :rtype: list
+        """
+        loaded = {(s3fsobj.name, s3fsobj.etag): s3fsobj for s3fsobj in self._s3fs_objects}
+        self._s3fs_objects = [loaded.get((s3fsobj.name, s3fsobj.etag), s3fsobj) for s3fsobj in self.iter_objects()]
         return self._s3fs_objects
 
+    @staticmethod
+    def prefetch(s3fsobjects, max_workers=MAX_PREFETCH_WORKERS):
+        """
+        Load the content of the s3fsobjects concurrently
+
+        :param s3fsobjects: list of s3fsobjects to load
+        :param max_workers: maximum number of concurrent downloads
+        :return: the list of s3fsobjects
+        :rtype: list
+        """
+        pending = [s3fsobj for s3fsobj in s3fsobjects if not s3fsobj.is_loaded]
+        if not pending:
+            return s3fsobjects
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(pending))) as executor:
+            list(executor.map(S3FsObject.raw, pending))
+        return s3fsobjects
+
+    @staticmethod
+    def prefetch_headers(s3fsobjects, max_workers=MAX_PREFETCH_WORKERS):
+        """
+        Load the header of the s3fsobjects concurrently, without fetching their content
+
+        :param s3fsobjects: list of s3fsobjects to enrich
+        :param max_workers: maximum number of concurrent requests
+        :return: the list of s3fsobjects
+        :rtype: list
+        """
+        pending = [s3fsobj for s3fsobj in s3fsobjects if not s3fsobj.is_header_loaded]
+        if not pending:
+            return s3fsobjects
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(pending))) as executor:
+            list(executor.map(S3FsObject._load_header, pending))
+        return s3fsobjects
+
     def get_object(self, name):
         """
         Return a s3fsobject identified by name
@@ -105,15 +189,34 @@ class S3Fs(object):
             raise S3FsObjectNotFoundException('Object not found')
         return s3obj
 
-    def put_object(self, name, content, encryption_key_arn, force_dot_file=False):
+    def snapshot(self, names=None):
         """
-        Put an object in the S3 path by encrypting it with SSE
+        Return a picklable snapshot of the S3 path, that can be loaded without S3 access by S3FsSnapshot.
+        The snapshot contains the listing and the content already loaded of the objects
+
+        :param names: names of the objects whose content is included (default: all the loaded objects)
+        :return: snapshot
+        :rtype: dict
+        """
+        objects = []
+        for s3fsobj in self.objects:
+            snapshot = s3fsobj.snapshot()
+            if names is not None and s3fsobj.name not in names:
+                snapshot.update(header={}, raw=None)
+            objects.append(snapshot)
+        return {'bucket': self._bucket, 'path': self._path, 'objects': objects}
+
+    def put_object(self, name, content, encryption_key_arn, force_dot_file=False, refresh=True):
+        """
+        Put an object in the S3 path by encrypting it with SSE. The sha256 of the content is stored in the
+        user metadata, so the content can be compared without downloading it
 
         :param name: object name
         :param content: content of the object
         :param encryption_key_arn: key arn to use for encryption
         :param force_dot_file: if enabled it disable the check with dot in the file
-        :return: the created s3object
+        :param refresh: False to skip the reload of the listing, e.g. when putting several objects
+        :return: the created s3object, None when refresh is disabled
         :rtype: S3FsObject
         """
         if os.environ.get('S3VAULTLIB_FORCE_DOT_FILE', 'false').lower() == 'true':
@@ -132,16 +235,37 @@ class S3Fs(object):
                         ServerSideEncryption='aws:kms',
                         Body=object_body,
                         Key=os.path.join(self._path, name),
-                        SSEKMSKeyId=encryption_key_arn)
+                        SSEKMSKeyId=encryption_key_arn,
+                        Metadata={CONTENT_HASH_METADATA: hashlib.sha256(content).hexdigest()})
             self.logger.debug('Trying to put object in the vault with configuration: {c}'.format(c=args))
             self.fs.put_object(**args)
         except Exception as e:
             self.logger.error("Error during put_object operation. Type: {t}. Error: "
                               "{e}".format(t=str(type(e)), e=str(e)))
             raise
+        if not refresh:
+            return None
         s3obj = next(iter([s3fsobj for s3fsobj in self._get_s3fsobjects(refresh=True) if s3fsobj.name == name]), None)
         return s3obj
 
+    def delete_object(self, name, refresh=True):
+        """
+        Delete an object from the S3 path
+
+        :param name: object name
+        :param refresh: False to skip the reload of the listing, e.g. when deleting several objects
+        """
+        self.logger.info('Deleting object: {n}, from bucket: {b}, path: {p}'.format(n=name, b=self._bucket,
+                                                                                    p=self._path))
+        try:
+            self.fs.delete_object(Bucket=self._bucket, Key=os.path.join(self._path, name))
+        except Exception as e:
+            self.logger.error("Error during delete_object operation. Type: {t}. Error: "
+                              "{e}".format(t=str(type(e)), e=str(e)))
+            raise
+        if refresh:
+            self._get_s3fsobjects(refresh=True)
+
     def update_s3fsobject(self, s3fsobject):
         """
         Update an S3FSObject
@@ -154,3 +278,42 @@ class S3Fs(object):
         if not s3fsobject.is_encrypted:
             raise S3FsException('Unable to update unencrypted object')
         return self.put_object(s3fsobject.name, s3fsobject.raw(), s3fsobject.kms_arn)
+
+
+class S3FsSnapshot(object):
+    """
+    Offline, read-only S3Fs built from a snapshot created by S3Fs.snapshot
+    """
+    prefetch = staticmethod(S3Fs.prefetch)
+    prefetch_headers = staticmethod(S3Fs.prefetch_headers)
+
+    def __init__(self, snapshot, fs=None):
+        """
+
+        :param snapshot: snapshot created by S3Fs.snapshot
+        :param fs: client used to load the content not included in the snapshot (default: none, offline)
+        """
+        self._bucket = snapshot['bucket']
+        self._path = snapshot['path']
+        self._s3fs_objects = [S3FsObject.from_snapshot(obj, self._bucket, self._path, fs=fs)
+                              for obj in snapshot['objects']]
+
+    @property
+    def objects(self):
+        """
+        Return a list of s3fsobjects
+        """
+        return self._s3fs_objects
+
+    def get_object(self, name):
+        """
+        Return a s3fsobject identified by name
+
+        :param name: object name
+        :return: s3fsobject
+        :rtype: S3FsObject
+        """
+        s3obj = next(iter([s3fsobj for s3fsobj in self.objects if s3fsobj.name == name]), None)
+        if not s3obj:
+            raise S3FsObjectNotFoundException('Object not found')
+        return s3obj
@@ -1,8 +1,12 @@
 #!/usr/bin/env python
+import contextvars
 import copy
+import hashlib
 import json
 import logging
 import os
+import threading
+from contextlib import contextmanager
 
 from dpath.util import merge
 
@@ -16,6 +20,44 @@ __maintainer__ = "Giuseppe Chiesa"
 __email__ = "mail@giuseppechiesa.it"
 __status__ = "PerpetualBeta"
 
+STREAM_CHUNK_SIZE = 64 * 1024
+CONTENT_HASH_METADATA = 'sha256'
+
+_ACCESS_RECORDER = contextvars.ContextVar('s3fsobject_access_recorder', default=None)
+
+
+@contextmanager
+def record_access():
+    """
+    Record the names of the s3fsobjects whose content is accessed in the current context
+
+    :return: set filled with the names of the accessed objects
+    :rtype: set
+    """
+    accessed = set()
+    token = _ACCESS_RECORDER.set(accessed)
+    try:
+        yield accessed
+    finally:
+        _ACCESS_RECORDER.reset(token)
+
+
+def dumps_json(data, canonical=False):
+    """
+    Serialize a json document. The canonical serialization sorts the keys, uses compact separators and
+    utf-8 instead of escapes, so equal documents always produce the same bytes
+
+    :param data: json document
+    :param canonical: True for the canonical serialization
+    :return: serialized document
+    :rtype: bytes
+    """
+    if not canonical:
+        return json.dumps(data).encode()
+    # floats are serialized with the shortest repr that round-trips, NaN and Infinity are not valid json
+    return json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False,
+                      allow_nan=False).encode('utf-8')
+
 
 class S3FsObjectException(Exception):
     pass
@@ -42,10 +84,76 @@ class S3FsObject(object):
         self._is_json = False
         self._fs = fs
         """ :type : pyboto3.s3 """
+        self._lock = threading.RLock()
         if not self._data.get('Key'):
             raise S3FsObjectException('Not a valid object')
         self.name = self._data['Key'].rpartition('/')[-1]
 
+    def snapshot(self):
+        """
+        Return a picklable snapshot of the object: listing data, header and content (when loaded)
+
+        :rtype: dict
+        """
+        return {'data': self._data, 'header': self._header, 'raw': self._raw}
+
+    @classmethod
+    def from_snapshot(cls, snapshot, bucket, path, fs=None):
+        """
+        Create an object from a snapshot. Without fs, accessing content not included in the snapshot raises
+        S3FsObjectException
+
+        :param snapshot: snapshot returned by S3FsObject.snapshot
+        :param bucket: bucket
+        :param path: path
+        :param fs: client used to load the content not included in the snapshot
+        :rtype: S3FsObject
+        """
+        s3fsobject = cls(snapshot['data'], bucket, path, fs)
+        s3fsobject._header = snapshot['header']
+        s3fsobject._raw = snapshot['raw']
+        return s3fsobject
+
+    @property
+    def size(self):
+        """
+        Return the size of the object as reported by the listing
+
+        :return: size in bytes
+        :rtype: int
+        """
+        return self._data.get('Size')
+
+    @property
+    def last_modified(self):
+        """
+        Return the last modified date of the object as reported by the listing
+
+        :return: last modified date
+        :rtype: datetime.datetime
+        """
+        return self._data.get('LastModified')
+
+    @property
+    def etag(self):
+        """
+        Return the ETag of the object as reported by the listing
+
+        :return: etag
+        :rtype: basestring
+        """
+        return self._data.get('ETag', '')
+
+    @property
+    def is_loaded(self):
+        """
+        Return true if the content of the object has been already fetched
+
+        :return: True or False
+        :rtype: bool
+        """
+        return self._raw is not None
+
     @property
     def kms_arn(self):
         """
@@ -77,28 +185,107 @@ class S3FsObject(object):
         :rtype: dict
         """
         if not self._header:
-            self._load_content()
+            self._load_header()
         metadata = copy.deepcopy(self._header)
         return metadata
 
+    @property
+    def content_hash(self):
+        """
+        Return the sha256 of the plaintext content, as stored in the user metadata on upload. The hash is computed
+        when the content is already loaded, otherwise only the header is fetched
+
+        :return: sha256 hex digest, None for the objects uploaded without it
+        :rtype: basestring
+        """
+        content_hash = None
+        if self._header or self._raw is None:
+            content_hash = self.metadata.get('Metadata', {}).get(CONTENT_HASH_METADATA)
+        if not content_hash and self._raw is not None:
+            content_hash = hashlib.sha256(self._raw).hexdigest()
+        return content_hash
+
+    @property
+    def is_header_loaded(self):
+        """
+        Return true if the header of the object has been already fetched
+
+        :return: True or False
+        :rtype: bool
+        """
+        return bool(self._header)
+
+    def _load_header(self):
+        """
+        Load the header of the file pointed by S3FsObject, without fetching the content
+
+        :return: header of the file
+        :rtype: dict
+        """
+        object_path = os.path.join(self._path, self.name)
+        with self._lock:
+            if self._header:
+                return self._header
+            if self._fs is None:
+                raise S3FsObjectException('Object not available offline: {n}'.format(n=self.name))
+            try:
+                self._header = self._fs.head_object(Bucket=self._bucket, Key=object_path)
+            except Exception:
+                self.logger.exception('Exception while fetching header for key: {k}'.format(k=object_path))
+                raise
+        return self._header
+
+    def _record_access(self):
+        accessed = _ACCESS_RECORDER.get()
+        if accessed is not None:
+            accessed.add(self.name)
+
     def _load_content(self):
         """
         Load the content of the file pointed by S3FsObject
 
         :return: content of the file
         """
+        self._record_access()
         object_path = os.path.join(self._path, self.name)
-        try:
-            self._header = self._fs.head_object(Bucket=self._bucket, Key=object_path)
-        except Exception:
-            self.logger.exception('Exception while fetching header for key: {k}'.format(k=object_path))
-            raise
+        with self._lock:
+            if self._raw is not None:
+                return self._raw
+            if self._fs is None:
+                raise S3FsObjectException('Object not available offline: {n}'.format(n=self.name))
+            if not self._header:
+                self._load_header()
+
+            response = self._fs.get_object(Bucket=self._bucket, Key=object_path)
+            if not response.get('Body'):
+                raise S3FsObjectException('Unable to read the file content for key: {k}'.format(k=object_path))
+            self._raw = bytes(response['Body'].read())
+        return self._raw
+
+    def stream_to(self, file_handler, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Copy the content of the file to a file handler, chunk by chunk, without buffering it in memory
 
+        :param file_handler: binary file-like object to write to
+        :param chunk_size: size of the chunks to read from S3
+        :return: number of bytes written
+        :rtype: int
+        """
+        self._record_access()
+        if self._raw is not None:
+            file_handler.write(self._raw)
+            return len(self._raw)
+        if self._fs is None:
+            raise S3FsObjectException('Object not available offline: {n}'.format(n=self.name))
+        object_path = os.path.join(self._path, self.name)
         response = self._fs.get_object(Bucket=self._bucket, Key=object_path)
         if not response.get('Body'):
             raise S3FsObjectException('Unable to read the file content for key: {k}'.format(k=object_path))
-        self._raw = bytes(response['Body'].read())
-        return self._raw
+        size = 0
+        for chunk in iter(lambda: response['Body'].read(chunk_size), b''):
+            file_handler.write(chunk)
+            size += len(chunk)
+        return size
 
     @staticmethod
     def is_json(data):
@@ -115,6 +302,21 @@ class S3FsObject(object):
             return False
         return True
 
+    @staticmethod
+    def json_equals(data, other):
+        """
+        Return True if two json contents are semantically equal, regardless of the key order and the formatting
+
+        :param data: json content
+        :param other: json content to compare
+        :return: True or False
+        :rtype: bool
+        """
+        try:
+            return dumps_json(json.loads(data), canonical=True) == dumps_json(json.loads(other), canonical=True)
+        except ValueError:
+            return False
+
     def __getitem__(self, key):
         """
         Overrides the getitem method
@@ -122,8 +324,7 @@ class S3FsObject(object):
         :param key:
         :return:
         """
-        if not self._raw:
-            self._load_content()
+        self._load_content()
 
         if not self.is_json(self._raw):
             raise KeyError(key)
@@ -161,16 +362,39 @@ class S3FsObject(object):
         :param value:
         :return:
         """
+        self.set_value(key, value)
+
+    def set_value(self, key, value, canonical=False):
+        """
+        Set a key of the json content
+
+        :param key: key, nested keys are separated by .
+        :param value: value
+        :param canonical: True to serialize the content as canonical json
+        """
         if not self._raw:
             self._load_content()
+        self._raw = self.update_json(self._raw, key, value, canonical=canonical)
 
-        if not self.is_json(self._raw):
+    @staticmethod
+    def update_json(data, key, value, canonical=False):
+        """
+        Set a key of a json content
+
+        :param data: json content
+        :param key: key, nested keys are separated by .
+        :param value: value
+        :param canonical: True to serialize the content as canonical json
+        :return: the updated content
+        :rtype: bytes
+        """
+        if not S3FsObject.is_json(data):
             raise KeyError(key)
 
-        json_data = json.loads(self._raw)
+        json_data = json.loads(data)
         # if the key contains . separator then we assume the key is a nested key and we allocate the entire path
-        json_data = self._set_value(json_data, key, value)
-        self._raw = json.dumps(json_data).encode()
+        json_data = S3FsObject._set_value(json_data, key, value)
+        return dumps_json(json_data, canonical=canonical)
 
     def __getattr__(self, item):
         """
@@ -190,13 +414,8 @@ class S3FsObject(object):
 
         :return:
         """
-        if not self._raw:
-            self._load_content()
+        self._load_content()
         return self._raw.decode()
 
     def raw(self):
-        if not self._raw:
-            self._load_content()
-        return self._raw
-
-
+        return self._load_content()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+import base64
+import datetime
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+from io import BytesIO
+
+from .s3fs import S3FsSnapshot, MAX_PREFETCH_WORKERS
+from .. import __application__
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+    InvalidTag = ValueError
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+SNAPSHOT_MAGIC = b'S3VSNAP1'
+SNAPSHOT_NONCE_SIZE = 12
+DEFAULT_SNAPSHOT_DIR = '~/.s3vaultlib.cache/snapshots'
+DEFAULT_SNAPSHOT_TTL = 60
+
+_HEADER_LENGTH = struct.Struct('>I')
+
+
+class SnapshotFileException(Exception):
+    pass
+
+
+def _get_aesgcm(key):
+    if AESGCM is None:
+        raise SnapshotFileException('The vault snapshot requires the cryptography package')
+    return AESGCM(key)
+
+
+def _encode_json(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError('Object of type {t} is not JSON serializable'.format(t=type(value).__name__))
+
+
+def _decode_json(value):
+    if '__datetime__' in value:
+        return datetime.datetime.fromisoformat(value['__datetime__'])
+    return value
+
+
+def write_snapshot_file(filename, s3fs, kms_client, max_workers=MAX_PREFETCH_WORKERS):
+    """
+    Materialize all the objects of a S3Fs path in a snapshot file. The objects and the manifest are encrypted
+    with AES-GCM by a data key generated with the KMS key of the vault, stored encrypted in the file.
+    The snapshot of an empty path holds no secret: it has a plain manifest and no data key
+
+    :param filename: snapshot file name
+    :param s3fs: S3Fs object
+    :type s3fs: S3Fs
+    :param kms_client: kms client
+    :param max_workers: maximum number of concurrent downloads
+    """
+    s3fsobjects = s3fs.prefetch(s3fs.objects, max_workers=max_workers)
+    chunks = []
+    if not s3fsobjects:
+        manifest = json.dumps({'bucket': s3fs.bucket, 'path': s3fs.path, 'objects': []}).encode('utf-8')
+        header = json.dumps({'key': None, 'nonce': None, 'manifest_length': len(manifest)}).encode('utf-8')
+    else:
+        key_id = next(iter([s3fsobj.kms_arn for s3fsobj in s3fsobjects if s3fsobj.kms_arn]), None)
+        if not key_id:
+            raise SnapshotFileException('No KMS key available to encrypt the snapshot')
+        data_key = kms_client.generate_data_key(KeyId=key_id, KeySpec='AES_256')
+        aesgcm = _get_aesgcm(data_key['Plaintext'])
+
+        entries = []
+        offset = 0
+        for s3fsobj in s3fsobjects:
+            nonce = os.urandom(SNAPSHOT_NONCE_SIZE)
+            chunk = aesgcm.encrypt(nonce, s3fsobj.raw(), s3fsobj.name.encode('utf-8'))
+            snapshot = s3fsobj.snapshot()
+            header = {k: v for k, v in snapshot['header'].items() if k not in ('Body', 'ResponseMetadata')}
+            entries.append({'data': snapshot['data'], 'header': header, 'offset': offset, 'length': len(chunk),
+                            'nonce': base64.b64encode(nonce).decode()})
+            chunks.append(chunk)
+            offset += len(chunk)
+        manifest = json.dumps({'bucket': s3fs.bucket, 'path': s3fs.path, 'objects': entries},
+                              default=_encode_json).encode('utf-8')
+        nonce = os.urandom(SNAPSHOT_NONCE_SIZE)
+        manifest = aesgcm.encrypt(nonce, manifest, SNAPSHOT_MAGIC)
+        header = json.dumps({'key': base64.b64encode(data_key['CiphertextBlob']).decode(),
+                             'nonce': base64.b64encode(nonce).decode(),
+                             'manifest_length': len(manifest)}).encode('utf-8')
+
+    # mkstemp creates the file with owner only permissions
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                        prefix='.{}.'.format(os.path.basename(filename)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(SNAPSHOT_MAGIC + _HEADER_LENGTH.pack(len(header)) + header + manifest)
+            for chunk in chunks:
+                fh.write(chunk)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+
+
+class SnapshotFile(object):
+    """
+    Read-only view of a snapshot file. The file is memory mapped and each object is decrypted on first access.
+    It implements the head_object and get_object calls of the S3 client used by the S3FsObjects
+    """
+
+    def __init__(self, filename, kms_client):
+        """
+
+        :param filename: snapshot file name
+        :param kms_client: kms client used to decrypt the data key
+        """
+        self.logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=self.__class__.__name__))
+        self._filename = filename
+        self._mmap = None
+        try:
+            with open(filename, 'rb') as fh:
+                self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self._load(kms_client)
+        except (InvalidTag, KeyError, ValueError, TypeError, struct.error) as e:
+            self.close()
+            raise SnapshotFileException('Invalid snapshot file: {f}. Error: {e}'.format(f=filename, e=str(e)))
+        except Exception:
+            self.close()
+            raise
+
+    def _load(self, kms_client):
+        if self._mmap[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError('bad magic')
+        offset = len(SNAPSHOT_MAGIC)
+        header_length, = _HEADER_LENGTH.unpack(self._mmap[offset:offset + _HEADER_LENGTH.size])
+        offset += _HEADER_LENGTH.size
+        header = json.loads(self._mmap[offset:offset + header_length].decode('utf-8'))
+        offset += header_length
+        if header['key'] is None:
+            # snapshot of an empty path
+            self._aesgcm = None
+            manifest = self._mmap[offset:offset + header['manifest_length']]
+        else:
+            data_key = kms_client.decrypt(CiphertextBlob=base64.b64decode(header['key']))['Plaintext']
+            self._aesgcm = _get_aesgcm(data_key)
+            manifest = self._aesgcm.decrypt(base64.b64decode(header['nonce']),
+                                            self._mmap[offset:offset + header['manifest_length']], SNAPSHOT_MAGIC)
+        self._payload_offset = offset + header['manifest_length']
+        self._manifest = json.loads(manifest.decode('utf-8'), object_hook=_decode_json)
+        if self._aesgcm is None and self._manifest['objects']:
+            raise ValueError('objects in a snapshot without data key')
+        self._entries = {entry['data']['Key'].rpartition('/')[-1]: entry for entry in self._manifest['objects']}
+
+    @property
+    def etags(self):
+        """
+        Return the ETag of the objects in the snapshot
+
+        :return: dictionary name: etag
+        :rtype: dict
+        """
+        return {name: entry['data'].get('ETag') for name, entry in self._entries.items()}
+
+    def s3fs(self):
+        """
+        Return a read-only S3Fs whose objects are loaded from the snapshot
+
+        :rtype: S3FsSnapshot
+        """
+        snapshot = {'bucket': self._manifest['bucket'], 'path': self._manifest['path'],
+                    'objects': [{'data': entry['data'], 'header': entry['header'], 'raw': None}
+                                for entry in self._manifest['objects']]}
+        return S3FsSnapshot(snapshot, fs=self)
+
+    def _get_entry(self, key):
+        name = key.rpartition('/')[-1]
+        if name not in self._entries:
+            raise KeyError('Object not in the snapshot: {k}'.format(k=key))
+        return name, self._entries[name]
+
+    def head_object(self, Bucket, Key):
+        return dict(self._get_entry(Key)[1]['header'])
+
+    def get_object(self, Bucket, Key):
+        name, entry = self._get_entry(Key)
+        start = self._payload_offset + entry['offset']
+        data = self._aesgcm.decrypt(base64.b64decode(entry['nonce']), self._mmap[start:start + entry['length']],
+                                    name.encode('utf-8'))
+        return {'Body': BytesIO(data)}
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+
+
+class SnapshotStore(object):
+    """
+    Directory of snapshot files shared by the processes of the same user. The first process that finds a
+    snapshot missing or stale materializes it while holding a lock, the others wait and then map it.
+    A snapshot older than the ttl is validated against the ETags of the S3 listing and rebuilt only when they change
+    """
+
+    def __init__(self, snapshot_dir=DEFAULT_SNAPSHOT_DIR, ttl=DEFAULT_SNAPSHOT_TTL, max_workers=MAX_PREFETCH_WORKERS):
+        """
+
+        :param snapshot_dir: directory of the snapshot files
+        :param ttl: seconds after which a snapshot is validated against the S3 listing
+        :param max_workers: maximum number of concurrent downloads when materializing a snapshot
+        """
+        self.logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=self.__class__.__name__))
+        self._snapshot_dir = os.path.expanduser(snapshot_dir)
+        self._ttl = ttl
+        self._max_workers = max_workers
+
+    def get_filename(self, key):
+        """
+        Return the snapshot file name of a vault
+
+        :param key: identifier of the vault, e.g. (bucket, path, region, profile)
+        :return: file name
+        """
+        digest = hashlib.sha256(json.dumps(list(key)).encode('utf-8')).hexdigest()
+        return os.path.join(self._snapshot_dir, '{d}.snapshot'.format(d=digest))
+
+    def open(self, key, s3fs_factory, kms_client):
+        """
+        Return the snapshot of a vault, materializing it when missing or when the ETags changed
+
+        :param key: identifier of the vault, e.g. (bucket, path, region, profile)
+        :param s3fs_factory: callable returning the S3Fs of the vault, used to list and fetch the objects
+        :param kms_client: kms client
+        :return: the snapshot
+        :rtype: SnapshotFile
+        """
+        if not os.path.isdir(self._snapshot_dir):
+            os.makedirs(self._snapshot_dir, 0o700)
+        filename = self.get_filename(key)
+        with open('{f}.lock'.format(f=filename), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if os.path.exists(filename) and time.time() - os.path.getmtime(filename) < self._ttl:
+                return SnapshotFile(filename, kms_client)
+            s3fs = s3fs_factory()
+            if os.path.exists(filename):
+                try:
+                    snapshot = SnapshotFile(filename, kms_client)
+                except SnapshotFileException as e:
+                    self.logger.warning(str(e))
+                else:
+                    if snapshot.etags == {s3fsobj.name: s3fsobj.etag for s3fsobj in s3fs.objects}:
+                        os.utime(filename)
+                        return snapshot
+                    snapshot.close()
+            self.logger.debug('Materializing the snapshot: {f}'.format(f=filename))
+            write_snapshot_file(filename, s3fs, kms_client, max_workers=self._max_workers)
+            return SnapshotFile(filename, kms_client)
@@ -1,5 +1,15 @@
 #!/usr/bin/env python
+import asyncio
+import hashlib
+import json
 import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from fnmatch import fnmatchcase
+from io import BytesIO
+from itertools import islice
 
 import six
 from botocore.client import Config
@@ -7,8 +17,11 @@ from botocore.client import Config
 from . import __application__
 from .connection.connectionmanager import ConnectionManager
 from .kms.kmsresolver import KMSResolver
-from .s3.s3fs import S3Fs, S3FsObjectNotFoundException
-from .template.templatefile import TemplateFile
+from .s3.s3fs import S3Fs, S3FsObjectNotFoundException, S3FsSnapshot, MAX_PREFETCH_WORKERS
+from .s3.s3fsobject import S3FsObject, record_access
+from .template.accesslog import AccessLog
+from .template.asyncobject import AsyncObjectLoader
+from .template.templatefile import TemplateFile, find_undeclared_variables, find_referenced_templates
 from .template.templaterenderer import TemplateRenderer
 
 __author__ = "Giuseppe Chiesa"
@@ -19,6 +32,9 @@ __maintainer__ = "Giuseppe Chiesa"
 __email__ = "mail@giuseppechiesa.it"
 __status__ = "PerpetualBeta"
 
+ITER_FILES_BATCH_SIZE = 32
+RENDER_CACHE_SIZE = 128
+
 
 class S3VaultException(Exception):
     pass
@@ -28,18 +44,172 @@ class S3VaultObjectNotFoundException(Exception):
     pass
 
 
+def render_template_snapshot(template_file, snapshot, variables):
+    """
+    Renders a template file against a snapshot of the S3Vault, without any S3 access.
+    Used by the workers of a process pool
+
+    :param template_file: file name to use as template
+    :param snapshot: snapshot created by S3Fs.snapshot
+    :param variables: additional variables to use in the rendering
+    :return: rendered content
+    :rtype: basestring
+    """
+    s3fs = S3FsSnapshot(snapshot)
+    tpl = TemplateFile(template_file)
+    if tpl.is_raw_copy(s3fs.objects):
+        return s3fs.get_object(tpl.get_raw_copy_src()).raw()
+    return TemplateRenderer(tpl.filename, s3fs).render(**variables)
+
+
+class S3VaultBatch(object):
+    """
+    Buffers the writes to a S3Vault path and flushes them together: the mutations of the same file are merged,
+    the changed files are uploaded concurrently, one PUT each, and the listing is reloaded once.
+    Reads do not see the buffered writes until the batch is flushed
+    """
+
+    def __init__(self, s3fs, key_resolver, canonical_json=False, max_workers=MAX_PREFETCH_WORKERS):
+        """
+
+        :param s3fs: S3Fs of the vault
+        :type s3fs: S3Fs
+        :param key_resolver: callable resolving (encryption_key_arn, key_alias, role_name) to a KMS key arn
+        :param canonical_json: True to write the configuration files as canonical json
+        :param max_workers: maximum number of concurrent requests on flush
+        """
+        self.logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=self.__class__.__name__))
+        self._s3fs = s3fs
+        self._key_resolver = key_resolver
+        self._canonical_json = canonical_json
+        self._max_workers = max_workers
+        self._pending = OrderedDict()
+
+    def _get_entry(self, name, encryption_key_arn, key_alias, role_name):
+        entry = self._pending.setdefault(name, {'content': None, 'properties': []})
+        entry['key'] = (encryption_key_arn, key_alias, role_name)
+        return entry
+
+    def put_file(self, src, dest, encryption_key_arn='', key_alias='', role_name=''):
+        """
+        Buffer the upload of a file, replacing the previous writes to the same file
+
+        :param src: source file name or file object
+        :param dest: destination file name
+        :param encryption_key_arn: KMS Key arn to use
+        :param key_alias: KMS Key alias to use
+        :param role_name: Role from which resolve the key
+        """
+        if isinstance(src, six.string_types):
+            with open(src, 'rb') as src_file:
+                content = src_file.read()
+        else:
+            content = src.read()
+            src.close()
+        entry = self._get_entry(dest, encryption_key_arn, key_alias, role_name)
+        entry['content'] = content
+        entry['properties'] = []
+
+    def create_config_property(self, configfile, encryption_key_arn='', key_alias='', role_name=''):
+        """
+        Buffer the creation of an empty configuration file
+
+        :param configfile: configuration file name
+        :param encryption_key_arn: KMS Arn to use
+        :param key_alias: KMS Alias to use
+        :param role_name: Role to use to resolve the KMS Key
+        """
+        self.put_file(BytesIO(b'{}'), configfile, encryption_key_arn, key_alias, role_name)
+
+    def set_property(self, configfile, key, value, encryption_key_arn='', key_alias='', role_name=''):
+        """
+        Buffer the update of a property in a configuration file. The key is used only when the file is created
+
+        :param configfile: configfile name
+        :param key: key
+        :param value: value
+        :param encryption_key_arn: KMS Key to use
+        :param key_alias: KMS alias to use
+        :param role_name: Role to use to resolve the KMS Key
+        """
+        entry = self._pending.get(configfile)
+        if entry is None:
+            entry = self._get_entry(configfile, encryption_key_arn, key_alias, role_name)
+        entry['properties'].append((key, value))
+
+    def _is_unchanged(self, s3fsobject, content, key_arn, in_place):
+        if s3fsobject is None or s3fsobject.kms_arn != key_arn:
+            return False
+        if s3fsobject.content_hash == hashlib.sha256(content).hexdigest():
+            return True
+        return in_place and not self._canonical_json and S3FsObject.json_equals(s3fsobject.raw(), content)
+
+    def flush(self):
+        """
+        Upload the buffered writes
+
+        :return: names of the uploaded files
+        :rtype: list
+        """
+        pending, self._pending = self._pending, OrderedDict()
+        s3fsobjects = {}
+        for name in pending:
+            try:
+                s3fsobjects[name] = self._s3fs.get_object(name)
+            except S3FsObjectNotFoundException:
+                pass
+        # the configs updated in place need their content, the replaced files only the header
+        self._s3fs.prefetch([s3fsobjects[name] for name, entry in pending.items()
+                             if name in s3fsobjects and entry['content'] is None], max_workers=self._max_workers)
+        self._s3fs.prefetch_headers(list(s3fsobjects.values()), max_workers=self._max_workers)
+
+        key_arns = {}
+        uploads = []
+        for name, entry in pending.items():
+            s3fsobject = s3fsobjects.get(name)
+            in_place = entry['content'] is None and s3fsobject is not None
+            if in_place:
+                content = s3fsobject.raw()
+                key_arn = s3fsobject.kms_arn
+            else:
+                content = b'{}' if entry['content'] is None else entry['content']
+                if entry['key'] not in key_arns:
+                    key_arns[entry['key']] = self._key_resolver(*entry['key'])
+                key_arn = key_arns[entry['key']]
+            for key, value in entry['properties']:
+                content = S3FsObject.update_json(content, key, value, canonical=self._canonical_json)
+            if self._is_unchanged(s3fsobject, content, key_arn, in_place):
+                self.logger.debug('File {n} unchanged, skipping the upload'.format(n=name))
+                continue
+            uploads.append((name, content, key_arn))
+        if not uploads:
+            return []
+
+        self.logger.info('Uploading {n} files'.format(n=len(uploads)))
+        with ThreadPoolExecutor(max_workers=min(self._max_workers, len(uploads))) as executor:
+            list(executor.map(lambda upload: self._s3fs.put_object(*upload, refresh=False), uploads))
+        self._s3fs.refresh()
+        return [name for name, _, _ in uploads]
+
+
 class S3Vault(object):
     """
     Implements a Vault by using S3 as backend and KMS as way to protect the data
     """
 
-    def __init__(self, bucket, path, connection_factory=None, is_ec2=False):
+    def __init__(self, bucket, path, connection_factory=None, is_ec2=False, access_log=None, s3fs=None,
+                 canonical_json=False):
         """
 
         :param bucket: bucket
         :param path: path
         :param connection_factory: connection factory
         :type connection_factory: ConnectionManager
+        :param access_log: log of the objects accessed by the templates (default: the one in the local cache)
+        :type access_log: AccessLog
+        :param s3fs: S3Fs to read the files from, e.g. a read-only S3FsSnapshot (default: a S3Fs of bucket and path)
+        :param canonical_json: True to write the configuration files as canonical json (sorted keys, compact
+                               separators), so equal configurations have the same content hash
         """
         self.logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=self.__class__.__name__))
         self._bucket = bucket
@@ -47,9 +217,46 @@ class S3Vault(object):
         self._connection_manager = connection_factory
         if not self._connection_manager:
             self._connection_manager = ConnectionManager(config=Config(signature_version='s3v4'), is_ec2=is_ec2)
-        self._s3fs = S3Fs(self._connection_manager, self._bucket, self._path)
+        self._s3fs = s3fs or S3Fs(self._connection_manager, self._bucket, self._path)
+        self._render_cache = OrderedDict()
+        self._render_cache_lock = threading.Lock()
+        self._access_log = access_log or AccessLog()
+        self._canonical_json = canonical_json
 
-    def put_file(self, src, dest, encryption_key_arn='', key_alias='', role_name=''):
+    def refresh(self):
+        """
+        Reload the listing of the S3Vault, keeping the content of the unchanged files
+
+        :return: list of s3fsobjects
+        :rtype: list
+        """
+        return self._s3fs.refresh()
+
+    @property
+    def bucket(self):
+        return self._bucket
+
+    @property
+    def path(self):
+        return self._path
+
+    def resolve_key_arn(self, encryption_key_arn='', key_alias='', role_name=''):
+        """
+        Return the arn of the KMS key to use for the uploads
+
+        :param encryption_key_arn: KMS Key arn to use
+        :param key_alias: KMS Key alias to use
+        :param role_name: Role from which resolve the key
+        :return: KMS key arn
+        :rtype: basestring
+        """
+        if encryption_key_arn:
+            return encryption_key_arn
+        kms_resolver = KMSResolver(self._connection_manager, keyalias=key_alias, role_name=role_name)
+        return kms_resolver.retrieve_key_arn()
+
+    def put_file(self, src, dest, encryption_key_arn='', key_alias='', role_name='', refresh=True,
+                 skip_unchanged=True):
         """
         Upload a file to the S3Vault
 
@@ -58,22 +265,52 @@ class S3Vault(object):
         :param encryption_key_arn: KMS Key arn to use
         :param key_alias: KMS Key alias to use
         :param role_name: Role from which resolve the key
-        :return: metadata of the uploaded object
+        :param refresh: False to skip the reload of the listing, e.g. when uploading several files
+        :param skip_unchanged: True to skip the upload when the file in the vault has the same content and key
+        :return: metadata of the uploaded object, None when refresh is disabled
         :rtype: dict
         """
-        kms_resolver = KMSResolver(self._connection_manager, keyalias=key_alias, role_name=role_name)
-        key_arn = encryption_key_arn
-        if not encryption_key_arn:
-            key_arn = kms_resolver.retrieve_key_arn()
+        key_arn = self.resolve_key_arn(encryption_key_arn, key_alias=key_alias, role_name=role_name)
 
         if isinstance(src, six.string_types):
             src_file = open(src, 'rb')
         else:
             src_file = src
-        s3fsobj = self._s3fs.put_object(dest, src_file.read(), key_arn)  # type: s3fsobject.S3FsObject
+        content = src_file.read()
         src_file.close()
+        if skip_unchanged and self._is_unchanged(dest, content, key_arn):
+            self.logger.info('File {d} unchanged, skipping the upload'.format(d=dest))
+            return self._s3fs.get_object(dest).metadata if refresh else None
+        s3fsobj = self._s3fs.put_object(dest, content, key_arn, refresh=refresh)  # type: s3fsobject.S3FsObject
+        if not refresh:
+            return None
         return s3fsobj.metadata
 
+    def _is_unchanged(self, name, content, key_arn):
+        """
+        Return True if the vault file has the same content, compared by the sha256 stored in its metadata,
+        and is encrypted with the same key
+        """
+        try:
+            s3fsobject = self._s3fs.get_object(name)
+        except S3FsObjectNotFoundException:
+            return False
+        return (s3fsobject.content_hash == hashlib.sha256(content).hexdigest() and
+                s3fsobject.metadata.get('SSEKMSKeyId') == key_arn)
+
+    def delete_file(self, name, refresh=True):
+        """
+        Delete a file from the S3Vault
+
+        :param name: file name
+        :param refresh: False to skip the reload of the listing, e.g. when deleting several files
+        """
+        try:
+            self._s3fs.get_object(name)
+        except S3FsObjectNotFoundException:
+            raise S3VaultObjectNotFoundException('File not found: {n}'.format(n=name))
+        self._s3fs.delete_object(name, refresh=refresh)
+
     def get_file(self, name):
         """
         Get a file from S3Vault
@@ -85,6 +322,53 @@ class S3Vault(object):
         s3fsobject = self._s3fs.get_object(name)  # type: s3fsobject.S3FsObject
         return s3fsobject.raw()
 
+    def iter_files(self, pattern=None, with_content=False, with_metadata=False, batch_size=ITER_FILES_BATCH_SIZE,
+                   max_workers=MAX_PREFETCH_WORKERS):
+        """
+        Iterate lazily over the files in the S3Vault
+
+        The literal part of the glob pattern is used as S3 prefix, so only the matching
+        listing pages are fetched. The content of the files is loaded on first access,
+        or prefetched concurrently in bounded batches when with_content is enabled.
+
+        :param pattern: glob pattern to filter the file names
+        :param with_content: True to prefetch the content of the files
+        :param with_metadata: True to prefetch only the metadata (headers) of the files
+        :param batch_size: number of files to prefetch per batch
+        :param max_workers: maximum number of concurrent requests
+        :return: generator of s3fsobjects
+        :rtype: collections.Iterable[S3FsObject]
+        """
+        prefix = S3Fs.glob_prefix(pattern) if pattern else ''
+        s3fsobjects = (s3fsobj for s3fsobj in self._s3fs.iter_objects(prefix)
+                       if not pattern or fnmatchcase(s3fsobj.name, pattern))
+        if not with_content and not with_metadata:
+            for s3fsobj in s3fsobjects:
+                yield s3fsobj
+            return
+        prefetch = self._s3fs.prefetch if with_content else self._s3fs.prefetch_headers
+        while True:
+            batch = list(islice(s3fsobjects, batch_size))
+            if not batch:
+                return
+            for s3fsobj in prefetch(batch, max_workers=max_workers):
+                yield s3fsobj
+
+    def prefetch_files(self, names, max_workers=MAX_PREFETCH_WORKERS):
+        """
+        Fetch in parallel the content of the distinct files in names
+
+        :param names: file names
+        :param max_workers: maximum number of concurrent downloads
+        :return: list of the prefetched s3fsobjects
+        :rtype: list
+        """
+        objects = {s3fsobj.name: s3fsobj for s3fsobj in self._s3fs.objects}
+        missing = set(names) - set(objects)
+        if missing:
+            raise S3VaultObjectNotFoundException('Files not found: {m}'.format(m=', '.join(sorted(missing))))
+        return self._s3fs.prefetch([objects[name] for name in set(names)], max_workers=max_workers)
+
     def get_file_metadata(self, name):
         """
         Get a file from S3Vault
@@ -111,12 +395,225 @@ class S3Vault(object):
         tpl = TemplateFile(template_file)
         if tpl.is_raw_copy(self._s3fs.objects):
             s3fsobject = self._s3fs.get_object(tpl.get_raw_copy_src())
-            data = s3fsobject.raw()
-        else:
-            template_renderer = TemplateRenderer(tpl.filename, self._s3fs)
+            return s3fsobject.raw()
+        referenced_objects, referenced = self._get_template_references(tpl)
+        cache_key = self._get_render_cache_key(tpl, referenced_objects, referenced, kwargs)
+        with self._render_cache_lock:
+            if cache_key in self._render_cache:
+                self._render_cache.move_to_end(cache_key)
+                return self._render_cache[cache_key]
+        self._s3fs.prefetch(referenced_objects)
+        template_renderer = TemplateRenderer(tpl.filename, self._s3fs)
+        with self._recording_access(tpl):
             data = template_renderer.render(**kwargs)
+        if cache_key is not None:
+            with self._render_cache_lock:
+                self._render_cache[cache_key] = data
+                if len(self._render_cache) > RENDER_CACHE_SIZE:
+                    self._render_cache.popitem(last=False)
         return data
 
+    @staticmethod
+    def _get_render_cache_key(tpl, referenced_objects, referenced, variables):
+        """
+        Return the key of a rendering in the render cache: the hash of the template, the ETags of the
+        referenced files and the hash of the variables used by the template
+
+        :param tpl: template
+        :type tpl: TemplateFile
+        :param referenced_objects: s3fsobjects referenced by the template
+        :param referenced: names of the variables referenced by the template
+        :param variables: variables passed to the rendering
+        :return: cache key, or None if the variables cannot be hashed
+        :rtype: tuple
+        """
+        objects = tuple(sorted((s3fsobj.name, s3fsobj.etag) for s3fsobj in referenced_objects))
+        used_variables = {name: variables[name] for name in referenced if name in variables}
+        try:
+            serialized = json.dumps(used_variables, sort_keys=True, default=repr)
+        except (TypeError, ValueError):
+            return None
+        return tpl.content_hash, objects, hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def render_templates(self, template_files, max_workers=MAX_PREFETCH_WORKERS, enable_async=False, executor=None,
+                         **kwargs):
+        """
+        Renders several template files sharing the same S3Vault. The union of the files referenced
+        by the templates is prefetched in parallel, then the templates are rendered concurrently
+
+        :param template_files: list of file names to use as templates
+        :param max_workers: maximum number of concurrent downloads and renderings
+        :param enable_async: True to render the templates on an event loop, with the vault objects as
+                             awaitable proxies. The loads that static analysis cannot predict then overlap
+        :param executor: executor used for the rendering. With a ProcessPoolExecutor each worker receives
+                         a picklable snapshot of the files referenced by its template and performs no S3 calls.
+                         The variables must be picklable. Not supported with enable_async
+        :type executor: concurrent.futures.Executor
+        :param kwargs: additional variables to use in the rendering
+        :return: list of rendered contents, in the same order of template_files
+        :rtype: list
+        :raises ValueError: if both enable_async and executor are given
+        """
+        if enable_async and executor:
+            raise ValueError('enable_async and executor are mutually exclusive')
+        if not template_files:
+            return []
+        self.prefetch_templates(template_files, max_workers=max_workers)
+        if enable_async:
+            return self._render_templates_async(template_files, max_workers, **kwargs)
+        if isinstance(executor, ProcessPoolExecutor):
+            return self._render_templates_snapshot(template_files, executor, **kwargs)
+        if executor:
+            return list(executor.map(lambda template_file: self.render_template(template_file, **kwargs),
+                                     template_files))
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(template_files))) as executor:
+            return list(executor.map(lambda template_file: self.render_template(template_file, **kwargs),
+                                     template_files))
+
+    def _render_templates_snapshot(self, template_files, executor, **kwargs):
+        futures = []
+        for template_file in template_files:
+            tpl = TemplateFile(template_file)
+            if tpl.is_raw_copy(self._s3fs.objects):
+                names = {tpl.get_raw_copy_src()}
+                self._s3fs.get_object(tpl.get_raw_copy_src()).raw()
+            else:
+                names = {s3fsobj.name for s3fsobj in self._get_referenced_objects(tpl)}
+            snapshot = self._s3fs.snapshot(names)
+            futures.append(executor.submit(render_template_snapshot, template_file, snapshot, kwargs))
+        return [future.result() for future in futures]
+
+    def _render_templates_async(self, template_files, max_workers, **kwargs):
+        async def render(template_file, object_loader):
+            tpl = TemplateFile(template_file)
+            if tpl.is_raw_copy(self._s3fs.objects):
+                return await object_loader.load(self._s3fs.get_object(tpl.get_raw_copy_src()))
+            template_renderer = TemplateRenderer(tpl.filename, self._s3fs, enable_async=True)
+            with self._recording_access(tpl):
+                return await template_renderer.render_async(object_loader, **kwargs)
+
+        async def render_all(executor):
+            object_loader = AsyncObjectLoader(executor)
+            return await asyncio.gather(*[render(template_file, object_loader) for template_file in template_files])
+
+        loop = asyncio.new_event_loop()
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                return loop.run_until_complete(render_all(executor))
+        finally:
+            loop.close()
+
+    def prefetch_templates(self, template_files, max_workers=MAX_PREFETCH_WORKERS):
+        """
+        Fetch in parallel the union of the files referenced by the templates
+
+        :param template_files: list of file names to use as templates
+        :param max_workers: maximum number of concurrent downloads
+        :return: list of the prefetched s3fsobjects
+        :rtype: list
+        """
+        referenced = {}
+        for template_file in set(template_files):
+            tpl = TemplateFile(template_file)
+            if tpl.is_raw_copy(self._s3fs.objects):
+                # raw copies are streamed to the destination, never buffered
+                continue
+            for s3fsobj in self._get_referenced_objects(tpl, max_workers=max_workers):
+                referenced[s3fsobj.name] = s3fsobj
+        self.logger.debug('Prefetching {n} files for {t} templates'.format(n=len(referenced), t=len(template_files)))
+        return self._s3fs.prefetch(list(referenced.values()), max_workers=max_workers)
+
+    def stream_template(self, template_file, file_handler, **kwargs):
+        """
+        Renders a template file by streaming the output to a file handler
+
+        :param template_file: file name to use as template
+        :param file_handler: binary file-like object to write to
+        :param kwargs: additional variables to use in the rendering
+        :return: number of bytes written
+        :rtype: int
+        """
+        tpl = TemplateFile(template_file)
+        if tpl.is_raw_copy(self._s3fs.objects):
+            return self._s3fs.get_object(tpl.get_raw_copy_src()).stream_to(file_handler)
+        template_renderer = TemplateRenderer(tpl.filename, self._s3fs)
+        with self._recording_access(tpl):
+            return template_renderer.render_to(file_handler, **kwargs)
+
+    def get_template_objects(self, template_file):
+        """
+        Return the s3fsobjects referenced by a template file
+
+        :param template_file: file name to use as template
+        :return: list of s3fsobjects
+        :rtype: list
+        """
+        return self._get_referenced_objects(TemplateFile(template_file))
+
+    @contextmanager
+    def _recording_access(self, tpl):
+        """
+        Record in the access log the objects accessed while rendering a template
+
+        :param tpl: template
+        :type tpl: TemplateFile
+        """
+        with record_access() as accessed:
+            yield
+        self._access_log.record(tpl.content_hash, accessed)
+
+    def _get_referenced_objects(self, tpl, max_workers=MAX_PREFETCH_WORKERS):
+        return self._get_template_references(tpl, max_workers=max_workers)[0]
+
+    def _get_template_references(self, tpl, max_workers=MAX_PREFETCH_WORKERS):
+        """
+        Return the files and the variables referenced by a template, following the templates it includes
+        or imports from the S3Vault. The included templates are fetched concurrently, one nesting level at a time.
+        The files accessed by the previous renderings of the template are added, so the lookups that static
+        analysis misses are prefetched as well
+
+        :param tpl: template
+        :type tpl: TemplateFile
+        :param max_workers: maximum number of concurrent downloads
+        :return: list of the referenced s3fsobjects and set of the referenced variable names
+        :rtype: tuple
+        """
+        objects = {s3fsobj.name: s3fsobj for s3fsobj in self._s3fs.objects}
+        variables = set(tpl.get_referenced_variables())
+        templates = set(tpl.get_referenced_templates())
+        logged = self._access_log.get(tpl.content_hash)
+        referenced = {name: objects[name] for name in variables | templates | logged if name in objects}
+        parsed = set()
+        while True:
+            includes = [objects[name] for name in templates if name in objects and name not in parsed]
+            if not includes:
+                break
+            parsed.update(s3fsobj.name for s3fsobj in includes)
+            self._s3fs.prefetch(includes, max_workers=max_workers)
+            templates = set()
+            for s3fsobj in includes:
+                source = s3fsobj.raw().decode('utf-8')
+                nested_variables = find_undeclared_variables(source)
+                nested_templates = find_referenced_templates(source)
+                variables.update(nested_variables)
+                templates.update(nested_templates)
+                referenced.update((name, objects[name]) for name in nested_variables | nested_templates
+                                  if name in objects)
+        return list(referenced.values()), variables
+
+    def get_template_fingerprint(self, template_file):
+        """
+        Return a fingerprint of the inputs of a template: its content and the ETag of the referenced files.
+        The fingerprint changes when the rendering could change
+
+        :param template_file: file name to use as template
+        :return: fingerprint
+        :rtype: tuple
+        """
+        tpl = TemplateFile(template_file)
+        objects = sorted((s3fsobj.name, s3fsobj.etag) for s3fsobj in self._get_referenced_objects(tpl))
+        return tpl.content_hash, tuple(objects)
+
     def create_config_property(self, configfile, encryption_key_arn='', key_alias='', role_name=''):
         """
         Create a configuration file in the S3Vault
@@ -153,10 +650,31 @@ class S3Vault(object):
             s3fsobject = self._s3fs.get_object(configfile)  # type: s3fsobject.S3FsObject
         except S3FsObjectNotFoundException:
             s3fsobject = self.create_config_property(configfile, encryption_key_arn, key_alias, role_name)
-        s3fsobject[key] = value
+        content = s3fsobject.raw()
+        s3fsobject.set_value(key, value, canonical=self._canonical_json)
+        # in canonical mode a config written with a different serialization is rewritten once
+        if content == s3fsobject.raw() or (not self._canonical_json and
+                                           S3FsObject.json_equals(content, s3fsobject.raw())):
+            self.logger.info('Property {k} unchanged in config: {c}'.format(k=key, c=configfile))
+            return s3fsobject.metadata
         s3fsobj = self._s3fs.update_s3fsobject(s3fsobject)
         return s3fsobj.metadata
 
+    @contextmanager
+    def batch(self, max_workers=MAX_PREFETCH_WORKERS):
+        """
+        Buffer the writes of set_property, put_file and create_config_property and flush them together on exit.
+        The writes are discarded when the block raises an exception
+
+        :param max_workers: maximum number of concurrent uploads
+        :return: the batch
+        :rtype: S3VaultBatch
+        """
+        batch = S3VaultBatch(self._s3fs, self.resolve_key_arn, canonical_json=self._canonical_json,
+                             max_workers=max_workers)
+        yield batch
+        batch.flush()
+
     def get_property(self, configfile, key):
         """
         Get a configuration property from a config file from the S3Vault
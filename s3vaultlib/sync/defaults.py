@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+SYNC_STATE_FILE = '.s3vault-sync.json'
+DEFAULT_SYNC_WORKERS = 8
+S3_URI_SCHEME = 's3://'
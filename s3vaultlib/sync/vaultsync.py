@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .defaults import SYNC_STATE_FILE, DEFAULT_SYNC_WORKERS, S3_URI_SCHEME
+from .. import __application__
+from ..s3.s3fs import S3Fs
+from ..utils import io
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+DELETE = 'delete'
+
+
+class VaultSyncException(Exception):
+    pass
+
+
+def parse_s3_uri(uri):
+    """
+    Split a s3://bucket/path uri
+
+    :param uri: uri to parse
+    :return: bucket and path, or None when uri is not a s3 uri
+    :rtype: tuple
+    """
+    if not uri.startswith(S3_URI_SCHEME):
+        return None
+    bucket, _, path = uri[len(S3_URI_SCHEME):].partition('/')
+    if not bucket:
+        raise VaultSyncException('Bucket missing in uri: {u}'.format(u=uri))
+    return bucket, path.strip('/')
+
+
+def sha256_file(filename):
+    """
+    Return the sha256 of the content of a file
+
+    :param filename: file name
+    :rtype: basestring
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(io.AtomicFile.CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class VaultSync(object):
+    """
+    Synchronizes the top level files of a local directory with a S3Vault path. The state file in the local
+    directory records the ETag and the sha256 of each file at the last sync, so the unchanged files are
+    detected without downloading them
+    """
+
+    def __init__(self, s3vault, local_dir, max_workers=DEFAULT_SYNC_WORKERS, delete=False, dry_run=False):
+        """
+
+        :param s3vault: the vault to synchronize
+        :type s3vault: S3Vault
+        :param local_dir: local directory
+        :param max_workers: maximum number of concurrent uploads or downloads
+        :param delete: True to delete the files missing on the source side
+        :param dry_run: True to only return the planned operations
+        """
+        self.logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=self.__class__.__name__))
+        self._s3vault = s3vault
+        self._local_dir = local_dir
+        self._max_workers = max_workers
+        self._delete = delete
+        self._dry_run = dry_run
+
+    @property
+    def state_file(self):
+        return os.path.join(self._local_dir, SYNC_STATE_FILE)
+
+    def _load_state(self):
+        try:
+            with open(self.state_file, 'rb') as fh:
+                state = json.loads(fh.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return {}
+        if state.get('bucket') != self._s3vault.bucket or state.get('path') != self._s3vault.path:
+            return {}
+        return state.get('files', {})
+
+    def _save_state(self, files):
+        state = {'bucket': self._s3vault.bucket, 'path': self._s3vault.path, 'files': files}
+        io.write_if_changed(self.state_file, json.dumps(state, indent=2, sort_keys=True).encode('utf-8'))
+
+    def _is_synced(self, name):
+        """
+        Return True if the file is synchronized. The same rule applies to both sides: the hidden files, as the
+        state file, are never synchronized, and the files with . (dot) in the name only when
+        S3VAULTLIB_FORCE_DOT_FILE is enabled
+
+        :param name: file name
+        :rtype: bool
+        """
+        if name.startswith('.'):
+            return False
+        if '.' in name and os.environ.get('S3VAULTLIB_FORCE_DOT_FILE', 'false').lower() != 'true':
+            self.logger.warning('Skipping file with . (dot) in the name: {n}'.format(n=name))
+            return False
+        return True
+
+    def _get_local_files(self):
+        """ top level regular files of the local directory that are synchronized """
+        files = {}
+        if not os.path.isdir(self._local_dir):
+            return files
+        for name in sorted(os.listdir(self._local_dir)):
+            filename = os.path.join(self._local_dir, name)
+            if not os.path.isfile(filename) or not self._is_synced(name):
+                continue
+            files[name] = filename
+        return files
+
+    def _get_remote_files(self):
+        """ files of the vault path that are synchronized """
+        return {s3fsobj.name: s3fsobj for s3fsobj in self._s3vault.iter_files() if self._is_synced(s3fsobj.name)}
+
+    def _run(self, function, names):
+        if not names:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self._max_workers, len(names))) as executor:
+            return list(executor.map(function, names))
+
+    def _get_changed(self, names, local_files, remote_files, hashes, state):
+        """
+        Return the names whose local and remote content differ. The files not matching the state of the last sync
+        are compared by the sha256 stored in the metadata of the vault objects, fetching only their headers
+
+        :return: list of names
+        :rtype: list
+        """
+        unknown = [name for name in names if name in local_files and name in remote_files and
+                   state.get(name) != {'etag': remote_files[name].etag, 'sha256': hashes[name]}]
+        S3Fs.prefetch_headers([remote_files[name] for name in unknown], max_workers=self._max_workers)
+        unchanged = {name for name in unknown if remote_files[name].content_hash == hashes[name]}
+        return [name for name in names
+                if name not in local_files or name not in remote_files or
+                (name in unknown and name not in unchanged)]
+
+    def push(self, encryption_key_arn='', key_alias='', role_name=''):
+        """
+        Upload the local files that changed since the last sync, and delete the extraneous vault files
+        when delete is enabled
+
+        :param encryption_key_arn: KMS Key arn to use
+        :param key_alias: KMS Key alias to use
+        :param role_name: Role from which resolve the key
+        :return: list of the operations, as (operation, name)
+        :rtype: list
+        """
+        if not os.path.isdir(self._local_dir):
+            raise VaultSyncException('Directory not found: {d}'.format(d=self._local_dir))
+        local_files = self._get_local_files()
+        remote_files = self._get_remote_files()
+        state = self._load_state()
+        hashes = dict(zip(local_files, self._run(sha256_file, list(local_files.values()))))
+
+        uploads = self._get_changed(list(local_files), local_files, remote_files, hashes, state)
+        deletes = sorted(set(remote_files) - set(local_files)) if self._delete else []
+        operations = [(UPLOAD, name) for name in uploads] + [(DELETE, name) for name in deletes]
+        if self._dry_run:
+            return operations
+
+        if uploads:
+            # the key is resolved once for all the uploads
+            key_arn = self._s3vault.resolve_key_arn(encryption_key_arn, key_alias=key_alias, role_name=role_name)
+            # the uploads are already known to differ from the vault files
+            self._run(lambda name: self._s3vault.put_file(local_files[name], name, encryption_key_arn=key_arn,
+                                                          refresh=False, skip_unchanged=False), uploads)
+        self._run(lambda name: self._s3vault.delete_file(name, refresh=False), deletes)
+
+        if operations:
+            # a single listing to record the new ETags
+            remote_files = {s3fsobj.name: s3fsobj for s3fsobj in self._s3vault.refresh()}
+        self._save_state({name: {'etag': remote_files[name].etag, 'sha256': hashes[name]}
+                          for name in local_files if name in remote_files})
+        return operations
+
+    def pull(self):
+        """
+        Download the vault files that changed since the last sync, and delete the extraneous local files
+        when delete is enabled
+
+        :return: list of the operations, as (operation, name)
+        :rtype: list
+        """
+        local_files = self._get_local_files()
+        remote_files = self._get_remote_files()
+        state = self._load_state()
+        hashes = dict(zip(local_files, self._run(sha256_file, list(local_files.values()))))
+
+        downloads = self._get_changed(list(remote_files), local_files, remote_files, hashes, state)
+        deletes = sorted(set(local_files) - set(remote_files)) if self._delete else []
+        operations = [(DOWNLOAD, name) for name in downloads] + [(DELETE, name) for name in deletes]
+        if self._dry_run:
+            return operations
+
+        if not os.path.isdir(self._local_dir):
+            if not operations:
+                return operations
+            os.makedirs(self._local_dir)
+
+        def download(name):
+            data = remote_files[name].raw()
+            io.write_if_changed(os.path.join(self._local_dir, name), data)
+            return hashlib.sha256(data).hexdigest()
+
+        hashes.update(zip(downloads, self._run(download, downloads)))
+        for name in deletes:
+            self.logger.info('Deleting file: {f}'.format(f=local_files[name]))
+            os.unlink(local_files[name])
+        self._save_state({name: {'etag': s3fsobj.etag, 'sha256': hashes[name]}
+                          for name, s3fsobj in remote_files.items()})
+        return operations
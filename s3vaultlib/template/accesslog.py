@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+import json
+import logging
+import os
+import threading
+
+from .defaults import DEFAULT_ACCESS_LOG_DIR, ACCESS_LOG_DIR_ENV
+from .. import __application__
+from ..utils.io import atomic_write
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+
+class AccessLog(object):
+    """
+    Persistent log of the vault objects accessed by the renderings of a template, keyed by the template hash.
+    It records the lookups that static analysis cannot detect, so they can be prefetched on the next run
+    """
+
+    def __init__(self, log_dir=None):
+        """
+
+        :param log_dir: directory of the log files (default: the environment or the local cache directory).
+                        An empty string disables the persistence
+        """
+        self.logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=self.__class__.__name__))
+        if log_dir is None:
+            log_dir = os.environ.get(ACCESS_LOG_DIR_ENV, DEFAULT_ACCESS_LOG_DIR)
+        self._log_dir = os.path.expanduser(log_dir) if log_dir else None
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _get_filename(self, content_hash):
+        return os.path.join(self._log_dir, '{h}.json'.format(h=content_hash))
+
+    def _read(self, content_hash):
+        if not self._log_dir:
+            return frozenset()
+        try:
+            with open(self._get_filename(content_hash), 'rb') as fh:
+                return frozenset(json.loads(fh.read().decode('utf-8')))
+        except (IOError, OSError, ValueError, TypeError):
+            return frozenset()
+
+    def get(self, content_hash):
+        """
+        Return the names of the objects accessed by the last rendering of a template
+
+        :param content_hash: sha256 of the template content
+        :return: set of object names
+        :rtype: frozenset
+        """
+        with self._lock:
+            if content_hash not in self._entries:
+                self._entries[content_hash] = self._read(content_hash)
+            return self._entries[content_hash]
+
+    def record(self, content_hash, names):
+        """
+        Record the names of the objects accessed by a rendering of a template.
+        The log file is written only when the accessed objects change
+
+        :param content_hash: sha256 of the template content
+        :param names: names of the accessed objects
+        """
+        names = frozenset(names)
+        if self.get(content_hash) == names:
+            return
+        with self._lock:
+            self._entries[content_hash] = names
+        if not self._log_dir:
+            return
+        try:
+            if not os.path.isdir(self._log_dir):
+                os.makedirs(self._log_dir, 0o700)
+            atomic_write(self._get_filename(content_hash), json.dumps(sorted(names)).encode('utf-8'))
+        except (IOError, OSError) as e:
+            self.logger.warning('Unable to write the access log in: {d}. Error: {e}'.format(d=self._log_dir, e=str(e)))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+import asyncio
+
+import jinja2
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+
+class AsyncObjectLoader(object):
+    """
+    Loads the content of the s3fsobjects on an executor, sharing a single load per object
+    among all the templates rendered on the same event loop
+    """
+
+    def __init__(self, executor=None):
+        """
+
+        :param executor: executor used for the blocking S3 calls (default: the loop default executor)
+        :type executor: concurrent.futures.Executor
+        """
+        self._executor = executor
+        self._futures = {}
+
+    def load(self, s3fsobject):
+        """
+        Return a future resolved when the content of the object is loaded
+
+        :param s3fsobject: object to load
+        :type s3fsobject: S3FsObject
+        :rtype: asyncio.Future
+        """
+        future = self._futures.get(s3fsobject.name)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._futures[s3fsobject.name] = loop.run_in_executor(self._executor, s3fsobject.raw)
+        return future
+
+
+class AsyncS3FsObject(object):
+    """
+    Awaitable proxy of a S3FsObject used by the async rendering: the keys of the object resolve
+    to coroutines, so the load happens on the event loop instead of blocking it. As in the sync rendering,
+    the json keys take precedence over the attributes of the S3FsObject
+    """
+
+    def __init__(self, s3fsobject, loader):
+        """
+
+        :param s3fsobject: proxied object
+        :type s3fsobject: S3FsObject
+        :param loader: loader shared by the templates rendered on the same loop
+        :type loader: AsyncObjectLoader
+        """
+        self._s3fsobject = s3fsobject
+        self._loader = loader
+
+    async def _get_item(self, key):
+        await self._loader.load(self._s3fsobject)
+        try:
+            return self._s3fsobject[key]
+        except KeyError:
+            if not key.startswith('_') and hasattr(self._s3fsobject, key):
+                return getattr(self._s3fsobject, key)
+            return jinja2.Undefined(obj=self._s3fsobject, name=key)
+
+    def __await__(self):
+        return self._loader.load(self._s3fsobject).__await__()
+
+    def __getitem__(self, key):
+        return self._get_item(key)
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return self._get_item(item)
+
+    def __str__(self):
+        # loads synchronously, TemplateRenderer.render_async loads the referenced objects before rendering
+        return str(self._s3fsobject)
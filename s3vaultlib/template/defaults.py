@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+# the bytecode cache on disk is enabled only when the directory is configured
+BYTECODE_CACHE_DIR_ENV = 'S3VAULTLIB_TEMPLATE_CACHE_DIR'
+DEFAULT_ACCESS_LOG_DIR = '~/.s3vaultlib.cache/access'
+ACCESS_LOG_DIR_ENV = 'S3VAULTLIB_ACCESS_LOG_DIR'
+# same size of the jinja2 template cache
+SOURCE_CACHE_SIZE = 400
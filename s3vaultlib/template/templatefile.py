@@ -1,4 +1,10 @@
 #!/usr/bin/env python
+import hashlib
+from functools import lru_cache
+
+from jinja2 import meta
+
+from .templaterenderer import get_environment
 
 __author__ = "Giuseppe Chiesa"
 __copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
@@ -13,6 +19,32 @@ class TemplateFileException(Exception):
     pass
 
 
+@lru_cache(maxsize=256)
+def find_undeclared_variables(template_data):
+    """
+    Return the variables referenced by a template source, parsing it only once per content
+
+    :param template_data: template source
+    :return: set of variable names
+    :rtype: frozenset
+    """
+    return frozenset(meta.find_undeclared_variables(get_environment().parse(template_data)))
+
+
+@lru_cache(maxsize=256)
+def find_referenced_templates(template_data):
+    """
+    Return the names of the templates included or imported by a template source.
+    Dynamic names (e.g. include item) are not detected
+
+    :param template_data: template source
+    :return: set of template names
+    :rtype: frozenset
+    """
+    return frozenset(name for name in meta.find_referenced_templates(get_environment().parse(template_data))
+                     if name is not None)
+
+
 class TemplateFile(object):
     def __init__(self, filename):
         self._filename = filename
@@ -32,6 +64,34 @@ class TemplateFile(object):
             self._get_template_content()
         return self._template_data
 
+    @property
+    def content_hash(self):
+        """
+        Return the sha256 of the template content
+
+        :rtype: basestring
+        """
+        return hashlib.sha256(self.template_data.encode('utf-8')).hexdigest()
+
+    def get_referenced_variables(self):
+        """
+        Return the variables referenced by the template, as detected by static analysis.
+        Dynamic lookups (e.g. vars[item]) are not detected
+
+        :return: set of variable names
+        :rtype: set
+        """
+        return find_undeclared_variables(self.template_data)
+
+    def get_referenced_templates(self):
+        """
+        Return the templates included or imported by the template, as detected by static analysis
+
+        :return: set of template names
+        :rtype: set
+        """
+        return find_referenced_templates(self.template_data)
+
     def _get_raw_copy_filename(self):
         data = self.template_data.strip()
         if data[0:2] != '{{' or data[-2:] != '}}':
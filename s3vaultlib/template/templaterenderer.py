@@ -1,10 +1,22 @@
 #!/usr/bin/env python
 
+import asyncio
+import contextvars
+import hashlib
 import logging
+import os
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import jinja2
 
+from .asyncobject import AsyncObjectLoader, AsyncS3FsObject
+from .defaults import BYTECODE_CACHE_DIR_ENV, SOURCE_CACHE_SIZE
 from .. import __application__
+from ..s3.s3fsobject import S3FsObject
 
 __author__ = "Giuseppe Chiesa"
 __copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
@@ -14,31 +26,305 @@ __maintainer__ = "Giuseppe Chiesa"
 __email__ = "mail@giuseppechiesa.it"
 __status__ = "PerpetualBeta"
 
+_ENVIRONMENTS = {}
+_S3FS_ENVIRONMENTS = {False: weakref.WeakKeyDictionary(), True: weakref.WeakKeyDictionary()}
+_ENVIRONMENT_LOCK = threading.Lock()
+_BYTECODE_CACHE_DISABLED = contextvars.ContextVar('templaterenderer_bytecode_cache_disabled', default=False)
+
+
+@contextmanager
+def disable_bytecode_cache():
+    """
+    Compile in memory only the templates rendered in the current context, e.g. the sources decrypted from
+    an ansible vault, that must never be written to the bytecode cache on disk
+    """
+    token = _BYTECODE_CACHE_DISABLED.set(True)
+    try:
+        yield
+    finally:
+        _BYTECODE_CACHE_DISABLED.reset(token)
+
+
+def _load_in_memory(loader, environment, name, globals=None):
+    """ load a template compiling it in memory, bypassing the bytecode cache """
+    source, filename, uptodate = loader.get_source(environment, name)
+    code = environment.compile(source, name, filename)
+    return environment.template_class.from_code(environment, code, globals or {}, uptodate)
+
+
+class LazyFilters(dict):
+    """
+    Jinja2 filters that load the ansible filters only when a template uses a filter not yet registered
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(LazyFilters, self).__init__(*args, **kwargs)
+        self.logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=self.__class__.__name__))
+        self._ansible_loaded = False
+        self._lock = threading.Lock()
+
+    def _load_ansible_filters(self):
+        with self._lock:
+            if self._ansible_loaded:
+                return
+            try:
+                from ansible.plugins.filter.core import FilterModule
+            except ImportError:
+                self.logger.info('Ansible not present, filter will not be added')
+            else:
+                for name, func in FilterModule().filters().items():
+                    self.setdefault(name, func)
+            # set only once the filters are added, the other threads wait on the lock until then
+            self._ansible_loaded = True
+
+    def __missing__(self, key):
+        if not self._ansible_loaded:
+            self._load_ansible_filters()
+        if key in self.keys():
+            return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class VaultEnvironment(jinja2.Environment):
+    """
+    Jinja2 environment that resolves the attributes of a vault object, e.g. {{ conf.size }}, to the keys of its
+    json content before the attributes of the S3FsObject
+    """
+
+    def getattr(self, obj, attribute):
+        if isinstance(obj, S3FsObject):
+            try:
+                return obj[attribute]
+            except KeyError:
+                pass
+        return super(VaultEnvironment, self).getattr(obj, attribute)
+
+
+class SourceLoader(jinja2.BaseLoader):
+    """
+    Content addressed loader: templates are registered and loaded by the sha256 of their source,
+    so a compiled template never gets stale
+    """
+
+    def __init__(self, max_size=SOURCE_CACHE_SIZE):
+        """
+
+        :param max_size: maximum number of sources kept, the least recently registered are evicted
+        """
+        self._sources = OrderedDict()
+        self._max_size = max_size
+        self._lock = threading.Lock()
+
+    def register(self, source):
+        """
+        Register a template source
+
+        :param source: template source
+        :return: name of the template
+        :rtype: basestring
+        """
+        name = hashlib.sha256(source.encode('utf-8')).hexdigest()
+        with self._lock:
+            self._sources[name] = source
+            self._sources.move_to_end(name)
+            while len(self._sources) > self._max_size:
+                self._sources.popitem(last=False)
+        return name
+
+    def get_source(self, environment, template):
+        with self._lock:
+            source = self._sources.get(template)
+        if source is None:
+            raise jinja2.TemplateNotFound(template)
+        return source, None, lambda: True
+
+    def load(self, environment, name, globals=None):
+        if _BYTECODE_CACHE_DISABLED.get():
+            return _load_in_memory(self, environment, name, globals)
+        return super(SourceLoader, self).load(environment, name, globals)
+
+
+class S3FsLoader(jinja2.BaseLoader):
+    """
+    Loads the templates included or imported by a template from the objects of a S3Fs path.
+    A compiled template is up to date as long as the ETag of its object does not change, and is never
+    written to the bytecode cache. The S3Fs is referenced weakly, so the cached environments do not keep it
+    and the content of its objects alive
+    """
+
+    def __init__(self, s3fs):
+        """
+
+        :param s3fs: S3Fs object
+        :type s3fs: S3Fs
+        """
+        self._s3fs_ref = weakref.ref(s3fs)
+
+    def _get_object(self, template):
+        s3fs = self._s3fs_ref()
+        if s3fs is None:
+            raise jinja2.TemplateNotFound(template)
+        return s3fs.get_object(template)
+
+    def get_source(self, environment, template):
+        try:
+            s3fsobject = self._get_object(template)
+        except Exception:
+            raise jinja2.TemplateNotFound(template)
+        etag = s3fsobject.etag
+
+        def uptodate():
+            try:
+                return self._get_object(template).etag == etag
+            except Exception:
+                return False
+
+        return s3fsobject.raw().decode('utf-8'), None, uptodate
+
+    def load(self, environment, name, globals=None):
+        # the vault objects hold secrets: they are compiled in memory only, bypassing the bytecode cache on disk
+        return _load_in_memory(self, environment, name, globals)
+
+
+class PrivateBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """
+    Bytecode cache whose files are readable only by the owner
+    """
+
+    def dump_bytecode(self, bucket):
+        filename = self._get_cache_filename(bucket)
+        # mkstemp creates the file with mode 0600, then it is renamed so readers never see a partial file
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=os.path.basename(filename),
+                                            suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                bucket.write_bytecode(fh)
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+            raise
+
+
+def _get_bytecode_cache(enable_async=False):
+    cache_dir = os.environ.get(BYTECODE_CACHE_DIR_ENV)
+    if not cache_dir:
+        return None
+    cache_dir = os.path.expanduser(cache_dir)
+    logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=__name__))
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        mode = os.stat(cache_dir).st_mode
+    except OSError as e:
+        logger.warning('Template bytecode cache disabled. Unable to create: {d}. Error: {e}'.format(
+            d=cache_dir, e=str(e)))
+        return None
+    if mode & 0o077:
+        logger.warning('Template bytecode cache disabled. The directory is accessible by other users: {d}'.format(
+            d=cache_dir))
+        return None
+    # sync and async templates compile to different code
+    pattern = '__jinja2_async_%s.cache' if enable_async else '__jinja2_%s.cache'
+    return PrivateBytecodeCache(cache_dir, pattern=pattern)
+
+
+def get_environment(enable_async=False):
+    """
+    Return the jinja2 environment shared by all the renderers, creating it on first use
+
+    :param enable_async: True to return the environment for the async rendering
+    :return: jinja2 environment
+    :rtype: jinja2.Environment
+    """
+    with _ENVIRONMENT_LOCK:
+        if enable_async not in _ENVIRONMENTS:
+            environment = VaultEnvironment(trim_blocks=True, autoescape=False, loader=SourceLoader(),
+                                           bytecode_cache=_get_bytecode_cache(enable_async),
+                                           enable_async=enable_async)
+            environment.filters = LazyFilters(environment.filters)
+            _ENVIRONMENTS[enable_async] = environment
+    return _ENVIRONMENTS[enable_async]
+
+
+def get_s3fs_environment(s3fs, enable_async=False):
+    """
+    Return the jinja2 environment used to render the templates of a S3Fs path. It is an overlay of the shared
+    environment that also resolves the included and imported templates from the S3Fs objects
+
+    :param s3fs: S3Fs object
+    :type s3fs: S3Fs
+    :param enable_async: True to return the environment for the async rendering
+    :return: jinja2 environment
+    :rtype: jinja2.Environment
+    """
+    environment = get_environment(enable_async)
+    with _ENVIRONMENT_LOCK:
+        overlay = _S3FS_ENVIRONMENTS[enable_async].get(s3fs)
+        if overlay is None:
+            overlay = environment.overlay(loader=jinja2.ChoiceLoader([environment.loader, S3FsLoader(s3fs)]))
+            # the templates are cached by loader, so the cache can be shared with the parent environment
+            overlay.cache = environment.cache
+            _S3FS_ENVIRONMENTS[enable_async][s3fs] = overlay
+    return overlay
+
 
 class TemplateRenderer(object):
     """
     Renders a template based on S3Fs location
     """
 
-    def __init__(self, template_file, s3fs):
+    def __init__(self, template_file, s3fs, enable_async=False):
         """
 
         :param template_file: template file to process
         :param s3fs: S3Fs object
         :type s3fs: S3Fs
+        :param enable_async: True to render with the vault objects as awaitable proxies
         """
         self.logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=self.__class__.__name__))
         self._template_file = template_file
-        self._jinja2 = jinja2.Environment(trim_blocks=True, autoescape=False)
-        # load additional ansible filters
-        try:
-            from ansible.plugins.filter.core import FilterModule
-            self._jinja2.filters.update(FilterModule().filters())
-        except ImportError:
-            self.logger.info('Ansible not present, filter will not be added')
+        self._enable_async = enable_async
+        self._jinja2 = get_s3fs_environment(s3fs, enable_async)
         self._s3fs = s3fs
         """ :type : S3Fs """
 
+    def _read_source(self):
+        with open(self._template_file, 'rb') as tpl_file:
+            return tpl_file.read().decode('utf-8')
+
+    def _get_template(self, tpl_data=None):
+        """
+        Return the compiled template, from the in-memory or bytecode cache when available
+
+        :param tpl_data: source of the template (default: read from the template file)
+        :rtype: jinja2.Template
+        """
+        if tpl_data is None:
+            tpl_data = self._read_source()
+        source_loader = get_environment(self._enable_async).loader
+        return self._jinja2.get_template(source_loader.register(tpl_data))
+
+    def _get_variables(self, **kwargs):
+        variables = {obj.name: obj for obj in self._s3fs.objects}
+        variables.update(kwargs)
+        return variables
+
     def render(self, **kwargs):
         """
         Renders the template
@@ -47,10 +333,57 @@ class TemplateRenderer(object):
         :return: content of the rendered template
         :rtype: basestring
         """
-        with open(self._template_file, 'rb') as tpl_file:
-            tpl_data = tpl_file.read().decode('utf-8')
-        template = self._jinja2.from_string(tpl_data)
-        variables = {obj.name: obj for obj in self._s3fs.objects}
-        variables.update(kwargs)
-        result = template.render(**variables)
+        if self._enable_async:
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(self.render_async(**kwargs))
+            finally:
+                loop.close()
+        template = self._get_template()
+        result = template.render(**self._get_variables(**kwargs))
         return result
+
+    async def render_async(self, object_loader=None, **kwargs):
+        """
+        Renders the template on the running event loop. The loads of the vault objects run on an executor,
+        so the loads triggered by templates rendered concurrently on the same loop overlap
+
+        :param object_loader: loader shared among the templates rendered on the same loop
+        :type object_loader: AsyncObjectLoader
+        :param kwargs: additional variables to use in the rendering
+        :return: content of the rendered template
+        :rtype: basestring
+        """
+        if not self._enable_async:
+            raise ValueError('render_async requires a renderer with enable_async=True')
+        object_loader = object_loader or AsyncObjectLoader()
+        tpl_data = self._read_source()
+        template = self._get_template(tpl_data)
+        variables = {obj.name: AsyncS3FsObject(obj, object_loader) for obj in self._s3fs.objects}
+        variables.update(kwargs)
+        # a whole object output, e.g. {{ mycert }}, is converted with str() and would load synchronously on the
+        # event loop, so the objects referenced by the template are loaded concurrently before rendering
+        # templatefile imports this module
+        from .templatefile import find_undeclared_variables
+        referenced = find_undeclared_variables(tpl_data)
+        await asyncio.gather(*[object_loader.load(obj) for obj in self._s3fs.objects
+                               if obj.name in referenced and obj.name not in kwargs])
+        return await template.render_async(**variables)
+
+    def render_to(self, file_handler, **kwargs):
+        """
+        Renders the template by streaming the encoded chunks to a file handler,
+        without building the whole output in memory
+
+        :param file_handler: binary file-like object to write to
+        :param kwargs: additional variables to use in the rendering
+        :return: number of bytes written
+        :rtype: int
+        """
+        template = self._get_template()
+        size = 0
+        for chunk in template.generate(**self._get_variables(**kwargs)):
+            data = chunk.encode('utf-8')
+            file_handler.write(data)
+            size += len(data)
+        return size
@@ -1,4 +1,8 @@
 #!/usr/bin/env python
+import os
+import shutil
+import sys
+import tempfile
 
 __author__ = "Giuseppe Chiesa"
 __copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
@@ -8,9 +12,190 @@ __maintainer__ = "Giuseppe Chiesa"
 __email__ = "mail@giuseppechiesa.it"
 __status__ = "PerpetualBeta"
 
+STDOUT = '-'
+
 
 def write_with_modecheck(file_handler, data):
     if file_handler.mode == 'w':
         file_handler.write(data.decode('utf-8'))
     else:
         file_handler.write(data)
+
+
+def _default_mode():
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+class AtomicFile(object):
+    """
+    File-like object that writes to a temporary file in the same directory of the destination,
+    and renames it over the destination on close. Mode and ownership of an existing destination are preserved
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, filename, only_if_changed=True):
+        """
+
+        :param filename: destination file name
+        :param only_if_changed: True to leave the destination untouched when the content did not change
+        """
+        self.name = os.path.abspath(filename)
+        self.mode = 'wb'
+        self.changed = False
+        self._only_if_changed = only_if_changed
+        fd, self._tmp_filename = tempfile.mkstemp(dir=os.path.dirname(self.name),
+                                                  prefix='.{}.'.format(os.path.basename(self.name)), suffix='.tmp')
+        self._fh = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        return self._fh.write(data)
+
+    def _is_unchanged(self):
+        if not os.path.isfile(self.name) or os.path.getsize(self.name) != os.path.getsize(self._tmp_filename):
+            return False
+        with open(self.name, 'rb') as current, open(self._tmp_filename, 'rb') as new:
+            while True:
+                current_chunk = current.read(self.CHUNK_SIZE)
+                if current_chunk != new.read(self.CHUNK_SIZE):
+                    return False
+                if not current_chunk:
+                    return True
+
+    def _replace(self):
+        if os.path.exists(self.name):
+            shutil.copymode(self.name, self._tmp_filename)
+            stat = os.stat(self.name)
+            try:
+                os.chown(self._tmp_filename, stat.st_uid, stat.st_gid)
+            except OSError:
+                pass
+        else:
+            os.chmod(self._tmp_filename, _default_mode())
+        os.replace(self._tmp_filename, self.name)
+
+    def close(self, discard=False):
+        """
+        Close the temporary file and replace the destination with it
+
+        :param discard: True to drop the written content and leave the destination untouched
+        """
+        if self._fh.closed:
+            return
+        try:
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self._fh.close()
+            if not discard and not (self._only_if_changed and self._is_unchanged()):
+                self._replace()
+                self.changed = True
+        finally:
+            if os.path.exists(self._tmp_filename):
+                os.unlink(self._tmp_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(discard=exc_type is not None)
+        return False
+
+
+class StdoutDestination(object):
+    """
+    File-like object that writes to the stdout, with the same interface of AtomicFile
+    """
+    name = STDOUT
+    mode = 'wb'
+    changed = True
+
+    def __init__(self):
+        self._fh = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    def write(self, data):
+        return self._fh.write(data)
+
+    def close(self, discard=False):
+        self._fh.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+def open_destination(destination):
+    """
+    Open a destination for streaming writes: an AtomicFile written only if the content changes,
+    or the stdout when destination is -
+
+    :param destination: destination file name or -
+    :return: file-like object with a changed attribute
+    """
+    if destination == STDOUT:
+        return StdoutDestination()
+    return AtomicFile(destination)
+
+
+def atomic_write(filename, data):
+    """
+    Write the data to a temporary file in the same directory and rename it over the destination.
+    Mode and ownership of an existing destination are preserved
+
+    :param filename: destination file name
+    :param data: content to write
+    :type data: bytes
+    """
+    with AtomicFile(filename, only_if_changed=False) as fh:
+        fh.write(data)
+
+
+def is_same_content(filename, data):
+    """
+    Return true if the file exists and has exactly the given content
+
+    :param filename: file name
+    :param data: content to compare
+    :type data: bytes
+    :rtype: bool
+    """
+    if not os.path.isfile(filename) or os.path.getsize(filename) != len(data):
+        return False
+    with open(filename, 'rb') as fh:
+        return fh.read() == data
+
+
+def write_if_changed(filename, data):
+    """
+    Atomically write the data to the file, only if the content differs
+
+    :param filename: destination file name
+    :param data: content to write
+    :type data: bytes
+    :return: True if the file has been written
+    :rtype: bool
+    """
+    if is_same_content(filename, data):
+        return False
+    atomic_write(filename, data)
+    return True
+
+
+def write_to_destination(destination, data):
+    """
+    Write the data to the destination file name, or to stdout when destination is -
+
+    :param destination: destination file name or -
+    :param data: content to write
+    :type data: bytes
+    :return: True if the destination has been written
+    :rtype: bool
+    """
+    if destination == STDOUT:
+        with StdoutDestination() as fh:
+            fh.write(data)
+        return True
+    return write_if_changed(destination, data)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+import logging
+import os
+import threading
+import time
+
+import jinja2
+
+from .. import __application__
+from ..connection.connectionmanager import ConnectionManager
+from ..metadata.factory import MetadataFactory
+from ..s3.s3fs import S3Fs
+from ..s3.snapshotfile import SnapshotStore
+from ..s3vaultlib import S3Vault
+from ..template.templatefile import find_undeclared_variables
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+DEFAULT_VAULT_CACHE_TTL = 300
+VAULT_CACHE_TTL_ENV = 'S3VAULTLIB_VAULT_CACHE_TTL'
+
+_VAULT_CACHE = None
+_VAULT_CACHE_LOCK = threading.Lock()
+
+
+class VaultCache(object):
+    """
+    Process level cache of the connections, the vault listings and the object bodies, shared by the tasks
+    executed in the same process. A cached vault refreshes its listing once older than the ttl, keeping the
+    bodies of the objects that did not change
+    """
+
+    def __init__(self, ttl=DEFAULT_VAULT_CACHE_TTL, connection_factory=None, snapshot_store=None):
+        """
+
+        :param ttl: seconds after which the listing of a cached vault is refreshed
+        :param connection_factory: callable returning a connection factory for (region, profile)
+                                   (default: a ConnectionManager)
+        :param snapshot_store: store of the snapshot files shared among processes (default: the local cache)
+        :type snapshot_store: SnapshotStore
+        """
+        self.logger = logging.getLogger('{a}.{m}'.format(a=__application__, m=self.__class__.__name__))
+        self._ttl = ttl
+        self._connection_factory = connection_factory or self._create_connection_manager
+        self._snapshot_store = snapshot_store or SnapshotStore(ttl=ttl)
+        self._connections = {}
+        self._vaults = {}
+        self._ec2_role = None
+        self._lock = threading.RLock()
+
+    @property
+    def ttl(self):
+        return self._ttl
+
+    @staticmethod
+    def _create_connection_manager(region=None, profile=None):
+        return ConnectionManager(region=region, profile_name=profile)
+
+    def get_connection_manager(self, region=None, profile=None):
+        """
+        Return the connection manager for region and profile, creating it on first use
+
+        :param region: aws region
+        :param profile: aws profile
+        :return: connection manager
+        :rtype: ConnectionManager
+        """
+        with self._lock:
+            if (region, profile) not in self._connections:
+                self._connections[(region, profile)] = self._connection_factory(region=region, profile=profile)
+            return self._connections[(region, profile)]
+
+    def get_vault(self, bucket, path, region=None, profile=None):
+        """
+        Return the cached vault for bucket, path, region and profile, refreshing its listing when older than the ttl
+
+        :param bucket: bucket
+        :param path: path
+        :param region: aws region
+        :param profile: aws profile
+        :return: the vault
+        :rtype: S3Vault
+        """
+        key = (bucket, path, region, profile)
+        with self._lock:
+            entry = self._vaults.get(key)
+            if not entry:
+                self.logger.debug('Loading vault: {b}/{p}'.format(b=bucket, p=path))
+                connection_manager = self.get_connection_manager(region=region, profile=profile)
+                entry = self._vaults[key] = {
+                    'vault': S3Vault(bucket, path, connection_factory=connection_manager),
+                    'timestamp': time.time()
+                }
+            elif time.time() - entry['timestamp'] > self._ttl:
+                self.logger.debug('Refreshing vault: {b}/{p}'.format(b=bucket, p=path))
+                entry['vault'].refresh()
+                entry['timestamp'] = time.time()
+            return entry['vault']
+
+    def get_snapshot_vault(self, bucket, path, region=None, profile=None):
+        """
+        Return a read-only vault backed by the encrypted snapshot file shared with the other processes.
+        The snapshot is materialized by the first process that needs it, the others read it without S3 traffic
+
+        :param bucket: bucket
+        :param path: path
+        :param region: aws region
+        :param profile: aws profile
+        :return: the vault
+        :rtype: S3Vault
+        """
+        key = ('snapshot', bucket, path, region, profile)
+        with self._lock:
+            entry = self._vaults.get(key)
+            if not entry or time.time() - entry['timestamp'] > self._ttl:
+                connection_manager = self.get_connection_manager(region=region, profile=profile)
+                snapshot = self._snapshot_store.open((bucket, path, region, profile),
+                                                     lambda: S3Fs(connection_manager, bucket, path),
+                                                     connection_manager.client('kms'))
+                # the mapping of a replaced snapshot is released once the vaults still reading it, e.g. returned
+                # to other threads, are collected
+                entry = self._vaults[key] = {
+                    'vault': S3Vault(bucket, path, connection_factory=connection_manager, s3fs=snapshot.s3fs()),
+                    'timestamp': time.time()
+                }
+            return entry['vault']
+
+    def get_ec2_role(self):
+        """
+        Return the role of the EC2 instance, querying the metadata only once
+
+        :return: role name
+        :rtype: basestring
+        """
+        with self._lock:
+            if self._ec2_role is None:
+                self._ec2_role = MetadataFactory().get_instance(is_ec2=True).role
+            return self._ec2_role
+
+    def resolve_path(self, path, ec2=True):
+        """
+        Render the vault path template. On EC2 the instance metadata is queried only when the path references
+        the role_name variable
+
+        :param path: vault path, e.g. role/{{ role_name }}/encrypted
+        :param ec2: True to render the path with the role of the EC2 instance
+        :return: vault path
+        :rtype: basestring
+        """
+        if not ec2:
+            return path
+        path_vars = {}
+        if 'role_name' in find_undeclared_variables(path):
+            path_vars['role_name'] = self.get_ec2_role()
+        return jinja2.Template(path).render(path_vars)
+
+    def clear(self):
+        with self._lock:
+            self._connections.clear()
+            self._vaults.clear()
+            self._ec2_role = None
+
+
+def get_vault_cache():
+    """
+    Return the vault cache of the current process, creating it on first use
+
+    :return: the vault cache
+    :rtype: VaultCache
+    """
+    global _VAULT_CACHE
+    with _VAULT_CACHE_LOCK:
+        if _VAULT_CACHE is None:
+            _VAULT_CACHE = VaultCache(ttl=int(os.environ.get(VAULT_CACHE_TTL_ENV, DEFAULT_VAULT_CACHE_TTL)))
+        return _VAULT_CACHE
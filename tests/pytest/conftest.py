@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+import pytest
+
+from s3vaultlib.template import templaterenderer
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+
+@pytest.fixture(autouse=True, scope='session')
+def template_cache_dir(tmpdir_factory):
+    """
+    Keep the template caches out of the home directory during the tests
+    """
+    mp = pytest.MonkeyPatch()
+    mp.setenv('S3VAULTLIB_TEMPLATE_CACHE_DIR', str(tmpdir_factory.mktemp('jinja2')))
+    templaterenderer._ENVIRONMENTS.clear()
+    for environments in templaterenderer._S3FS_ENVIRONMENTS.values():
+        environments.clear()
+    yield
+    mp.undo()
+
+
+@pytest.fixture(autouse=True)
+def access_log_dir(tmpdir, monkeypatch):
+    """
+    Give each test its own template access log
+    """
+    log_dir = tmpdir.join('access')
+    monkeypatch.setenv('S3VAULTLIB_ACCESS_LOG_DIR', str(log_dir))
+    return log_dir
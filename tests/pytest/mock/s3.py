@@ -1,5 +1,10 @@
 #!/usr/bin/env python
+import hashlib
 import logging
+import os
+from datetime import datetime
+from io import BytesIO
+
 from ..fixtures import s3 as s3fixtures
 
 __author__ = "Giuseppe Chiesa"
@@ -26,3 +31,98 @@ class S3Mock(object):
 
     def expect_body(self):
         return s3fixtures.S3_OBJECTS[self.mock_id]['_expect_body']
+
+
+class S3PaginatorMock(object):
+    def __init__(self, bucket_mock):
+        self._bucket_mock = bucket_mock
+
+    def paginate(self, **kwargs):
+        page_size = kwargs.get('PaginationConfig', {}).get('PageSize', 1000)
+        prefix = kwargs.get('Prefix', '')
+        keys = sorted(k for k in self._bucket_mock.objects if k.startswith(prefix))
+        if kwargs.get('Delimiter'):
+            # the keys nested under the delimiter are grouped in CommonPrefixes, and not returned
+            keys = [k for k in keys if kwargs['Delimiter'] not in k[len(prefix):]]
+        self._bucket_mock.calls.append(('list_objects_v2', prefix))
+        for idx in range(0, len(keys), page_size):
+            yield {'Contents': [self._bucket_mock.list_entry(k) for k in keys[idx:idx + page_size]]}
+
+
+class S3BucketMock(object):
+    """
+    In memory bucket that records the calls performed against it
+    """
+    def __init__(self, objects=None):
+        self.objects = {}
+        self.calls = []
+        for key, body in (objects or {}).items():
+            self.objects[key] = {'Body': body, 'SSEKMSKeyId': 'arn:aws:kms:test', 'Metadata': {}}
+
+    def list_entry(self, key):
+        return {'Key': key,
+                'LastModified': datetime(2015, 1, 1),
+                'ETag': '"{}"'.format(hashlib.md5(self.objects[key]['Body']).hexdigest()),
+                'Size': len(self.objects[key]['Body'])}
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return S3PaginatorMock(self)
+
+    def head_object(self, Bucket, Key):
+        self.calls.append(('head_object', Key))
+        entry = self.objects[Key]
+        return {'ContentLength': len(entry['Body']),
+                'ETag': self.list_entry(Key)['ETag'],
+                'ServerSideEncryption': 'aws:kms',
+                'SSEKMSKeyId': entry['SSEKMSKeyId'],
+                'Metadata': dict(entry['Metadata'])}
+
+    def get_object(self, Bucket, Key):
+        self.calls.append(('get_object', Key))
+        return {'Body': BytesIO(self.objects[Key]['Body'])}
+
+    def put_object(self, Bucket, Key, Body, SSEKMSKeyId, Metadata=None, **kwargs):
+        self.calls.append(('put_object', Key))
+        self.objects[Key] = {'Body': Body.read(), 'SSEKMSKeyId': SSEKMSKeyId, 'Metadata': Metadata or {}}
+
+    def delete_object(self, Bucket, Key):
+        self.calls.append(('delete_object', Key))
+        del self.objects[Key]
+
+    def count(self, operation):
+        return len([c for c in self.calls if c[0] == operation])
+
+
+class ConnectionManagerMock(object):
+    is_ec2 = False
+    session_info = {}
+
+    def __init__(self, s3_mock, kms_mock=None):
+        self._s3_mock = s3_mock
+        self._kms_mock = kms_mock
+
+    def client(self, resource):
+        if resource == 'kms' and self._kms_mock:
+            return self._kms_mock
+        assert resource == 's3'
+        return self._s3_mock
+
+
+class KMSMock(object):
+    """
+    Wraps the data keys with a fixed prefix instead of a real master key
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def generate_data_key(self, KeyId, KeySpec):
+        self.calls.append(('generate_data_key', KeyId))
+        key = os.urandom(32)
+        return {'Plaintext': key, 'CiphertextBlob': b'wrapped:' + key, 'KeyId': KeyId}
+
+    def decrypt(self, CiphertextBlob):
+        self.calls.append(('decrypt', None))
+        assert CiphertextBlob.startswith(b'wrapped:')
+        return {'Plaintext': CiphertextBlob[len(b'wrapped:'):]}
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+import os
+import threading
+import time
+
+import pytest
+
+from s3vaultlib.agent.client import AgentClient, AgentClientException, AgentObjectNotFoundException, \
+    connection_identity
+from s3vaultlib.agent.server import AgentServer
+from .mock.s3 import S3BucketMock, ConnectionManagerMock
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+
+@pytest.fixture
+def s3_mock():
+    return S3BucketMock({
+        'vault/conf_app': b'{"db": {"password": "secret"}}',
+        'vault/cert_web': b'\x04\xf8\x00P',
+    })
+
+
+@pytest.fixture
+def agent_socket(tmpdir, s3_mock):
+    socket_path = str(tmpdir.join('agent.sock'))
+    identity = connection_identity(region='eu-west-1', profile='vault')
+    agent = AgentServer(socket_path, ConnectionManagerMock(s3_mock), identity=identity)
+    thread = threading.Thread(target=agent.serve_forever)
+    thread.start()
+    for _ in range(100):
+        if os.path.exists(socket_path):
+            break
+        time.sleep(0.01)
+    yield socket_path
+    agent.shutdown()
+    thread.join()
+
+
+@pytest.fixture
+def agent_client(agent_socket):
+    client = AgentClient(agent_socket, identity=connection_identity(region='eu-west-1', profile='vault'))
+    yield client
+    client.close()
+
+
+def test_agent_serves_cached_files(agent_client, s3_mock):
+    assert agent_client.is_available()
+    assert agent_client.get_file('bucket', 'vault', 'cert_web') == b'\x04\xf8\x00P'
+    assert agent_client.get_file('bucket', 'vault', 'cert_web') == b'\x04\xf8\x00P'
+    assert agent_client.get_property('bucket', 'vault', 'conf_app', 'db.password') == 'secret'
+    assert s3_mock.count('list_objects_v2') == 1
+    assert s3_mock.count('get_object') == 2
+
+
+def test_agent_object_not_found(agent_client):
+    with pytest.raises(AgentObjectNotFoundException):
+        agent_client.get_file('bucket', 'vault', 'missing')
+
+
+def test_agent_client_not_available(tmpdir):
+    assert not AgentClient(str(tmpdir.join('missing.sock'))).is_available()
+
+
+def test_agent_rejects_other_identities(agent_socket):
+    client = AgentClient(agent_socket, identity=connection_identity(region='eu-west-1', profile='other'))
+    try:
+        assert not client.is_available()
+        with pytest.raises(AgentClientException):
+            client.get_file('bucket', 'vault', 'cert_web')
+    finally:
+        client.close()
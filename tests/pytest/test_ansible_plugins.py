@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+import importlib.util
+import os
+
+import pytest
+
+from s3vaultlib.utils.vaultcache import VaultCache
+from .mock.s3 import S3BucketMock, ConnectionManagerMock
+
+ansible = pytest.importorskip('ansible')
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+PLUGINS_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 's3vaultlib', '_resources', 'ansible', 's3vault')
+
+
+def load_plugin(plugin_type, name):
+    """ load a plugin of the s3vault role as a standalone module """
+    spec = importlib.util.spec_from_file_location('s3vault_{t}'.format(t=plugin_type),
+                                                  os.path.join(PLUGINS_DIR, plugin_type, '{n}.py'.format(n=name)))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def s3_mock():
+    return S3BucketMock({'vault/conf_app': b'{"db": {"password": "secret", "user": "app"}}',
+                         'vault/cert_web': b'-----BEGIN CERTIFICATE-----'})
+
+
+def patch_vault_cache(mocker, module, s3_mock):
+    vault_cache = VaultCache(connection_factory=lambda region, profile: ConnectionManagerMock(s3_mock))
+    mocker.patch.object(module, 'get_vault_cache', return_value=vault_cache)
+    return vault_cache
+
+
+def test_lookup_plugin(mocker, s3_mock):
+    lookup = load_plugin('lookup_plugins', 's3vault')
+    patch_vault_cache(mocker, lookup, s3_mock)
+    results = lookup.LookupModule().run(['conf_app:db.password', 'conf_app:db.user', 'cert_web'],
+                                        bucket='bucket', path='vault', ec2=False)
+    assert results == ['secret', 'app', '-----BEGIN CERTIFICATE-----']
+    assert s3_mock.count('get_object') == 2
+
+
+def test_lookup_plugin_errors(mocker, s3_mock):
+    from ansible.errors import AnsibleError
+    lookup = load_plugin('lookup_plugins', 's3vault')
+    patch_vault_cache(mocker, lookup, s3_mock)
+    with pytest.raises(AnsibleError, match='bucket is required'):
+        lookup.LookupModule().run(['conf_app:db.password'], path='vault', ec2=False)
+    with pytest.raises(AnsibleError, match='key not found'):
+        lookup.LookupModule().run(['conf_app:db.missing'], bucket='bucket', path='vault', ec2=False)
+
+
+@pytest.fixture
+def vars_factory(mocker, tmpdir, s3_mock):
+    from ansible.parsing.dataloader import DataLoader
+    vars_plugin = load_plugin('vars_plugins', 's3vault')
+    mocker.patch.dict(vars_plugin._CONFIGS, clear=True)
+    vault_cache = patch_vault_cache(mocker, vars_plugin, s3_mock)
+
+    def get_vars(mapping, entities):
+        tmpdir.join(vars_plugin.MAPPING_FILE).write(mapping)
+        return vars_plugin.VarsModule().get_vars(DataLoader(), str(tmpdir), entities)
+
+    return vars_plugin, vault_cache, get_vars
+
+
+def test_vars_plugin(mocker, s3_mock, vars_factory):
+    from ansible.inventory.group import Group
+    from ansible.inventory.host import Host
+    vars_plugin, vault_cache, get_vars = vars_factory
+    resolve_path = mocker.spy(vault_cache, 'resolve_path')
+    wrap_var = mocker.spy(vars_plugin, 'wrap_var')
+    data = get_vars('bucket: bucket\n'
+                    'ec2: "false"\n'
+                    'groups:\n'
+                    '  webservers:\n'
+                    '    path: vault\n'
+                    '    prefix: vault_\n'
+                    '    configs: conf_app\n'
+                    'hosts:\n'
+                    '  web01:\n'
+                    '    path: vault\n'
+                    '    configs: [conf_app]\n',
+                    [Group('webservers'), Host('web01'), Host('db01')])
+    assert sorted(data) == ['conf_app', 'vault_conf_app']
+    assert resolve_path.call_args_list == [mocker.call('vault', ec2=False)] * 2
+    # the configurations are fetched on the first access
+    assert not s3_mock.calls
+    assert data['conf_app']['db']['password'] == 'secret'
+    assert dict(data['vault_conf_app']) == {'db': {'password': 'secret', 'user': 'app'}}
+    # the configurations of a path are loaded once for all the entities
+    assert s3_mock.count('get_object') == 1
+    # the vault values are never templated by ansible
+    wrap_var.assert_called_once_with({'db': {'password': 'secret', 'user': 'app'}})
+    assert get_vars('', [Host('web01')]) == {}
+
+
+def test_vars_plugin_lists_the_path_and_expires(mocker, s3_mock, vars_factory):
+    from ansible.errors import AnsibleError
+    from ansible.inventory.host import Host
+    vars_plugin, vault_cache, get_vars = vars_factory
+    mapping = 'bucket: bucket\nhosts:\n  web01:\n    path: vault\n    ec2: no\n'
+    data = get_vars(mapping, [Host('web01')])
+    assert sorted(data) == ['cert_web', 'conf_app']
+    assert s3_mock.count('get_object') == 0
+    assert data['conf_app']['db']['user'] == 'app'
+    with pytest.raises(AnsibleError, match='cert_web is not a json configuration'):
+        data['cert_web']['key']
+    assert get_vars(mapping, [Host('web01')])['conf_app'] is not None
+    assert s3_mock.count('get_object') == 2
+
+    # the configurations expire with the vault cache
+    s3_mock.objects['vault/conf_app']['Body'] = b'{"db": {"user": "changed"}}'
+    mocker.patch.object(vault_cache, '_ttl', -1)
+    assert get_vars(mapping, [Host('web01')])['conf_app']['db']['user'] == 'changed'
+
+
+@pytest.fixture
+def action_factory(mocker, tmpdir):
+    action_plugin = load_plugin('action_plugins', 's3vault_template')
+
+    def factory(args):
+        task = mocker.Mock(args=args, async_val=0, check_mode=False)
+        connection = mocker.Mock()
+        connection._shell.tmpdir = str(tmpdir)
+        loader = mocker.Mock()
+        loader.get_real_file.side_effect = lambda source: source
+        action = action_plugin.ActionModule(task, connection, mocker.Mock(), loader, mocker.Mock(), mocker.Mock())
+        mocker.patch.object(action, '_find_needle', side_effect=lambda dirname, needle: str(tmpdir.join(needle)))
+        mocker.patch.object(action, '_transfer', side_effect=lambda source, dest, resultant, *args, **kwargs:
+                            dict(changed=True, dest=dest, content=resultant))
+        return action
+
+    tmpdir.join('app.conf.j2').write('password={{ conf_app.db.password }}')
+    tmpdir.join('cert.pem.j2').write('{{ cert_web }}')
+    return action_plugin, factory
+
+
+def test_action_plugin_templates(mocker, s3_mock, action_factory):
+    action_plugin, factory = action_factory
+    vault_cache = patch_vault_cache(mocker, action_plugin, s3_mock)
+    get_snapshot_vault = mocker.spy(vault_cache, 'get_snapshot_vault')
+    action = factory(dict(bucket='bucket', path='vault', ec2=False,
+                          templates=[dict(src='app.conf.j2', dest='/etc/app.conf', mode='0600'),
+                                     dict(src='cert.pem.j2', dest='/etc/cert.pem')]))
+    result = action.run(task_vars=dict())
+    assert 'failed' not in result
+    assert result['changed']
+    assert [(item['src'], item['dest'], item['content']) for item in result['results']] == [
+        ('app.conf.j2', '/etc/app.conf', 'password=secret'),
+        ('cert.pem.j2', '/etc/cert.pem', b'-----BEGIN CERTIFICATE-----')]
+    assert action._transfer.call_args_list[0][1]['item_args'] == dict(mode='0600')
+    assert not get_snapshot_vault.called
+    assert s3_mock.count('get_object') == 2
+
+
+def test_action_plugin_snapshot(mocker, s3_mock, action_factory):
+    action_plugin, factory = action_factory
+    vault_cache = patch_vault_cache(mocker, action_plugin, s3_mock)
+    s3vault = vault_cache.get_vault('bucket', 'vault')
+    get_snapshot_vault = mocker.patch.object(vault_cache, 'get_snapshot_vault', return_value=s3vault)
+    action = factory(dict(bucket='bucket', path='vault', ec2=False, snapshot='yes', src='app.conf.j2',
+                          dest='/etc/app.conf'))
+    result = action.run(task_vars=dict())
+    assert result['content'] == 'password=secret'
+    get_snapshot_vault.assert_called_once_with('bucket', 'vault', region=None, profile=None)
+
+
+def test_action_plugin_vaulted_sources_are_not_cached_on_disk(mocker, s3_mock, action_factory, tmpdir):
+    action_plugin, factory = action_factory
+    patch_vault_cache(mocker, action_plugin, s3_mock)
+    cache_dir = os.environ['S3VAULTLIB_TEMPLATE_CACHE_DIR']
+    before = set(os.listdir(cache_dir))
+    decrypted = tmpdir.join('decrypted.j2')
+    decrypted.write('vaulted={{ conf_app.db.password }}')
+    action = factory(dict(bucket='bucket', path='vault', ec2=False, src='app.conf.j2', dest='/etc/app.conf'))
+    action._loader.get_real_file.side_effect = lambda source: str(decrypted)
+    assert action.run(task_vars=dict())['content'] == 'vaulted=secret'
+    assert set(os.listdir(cache_dir)) == before
+
+
+@pytest.fixture
+def transfer_action(mocker, action_factory, tmpdir):
+    action_plugin, factory = action_factory
+    action = factory(dict(bucket='bucket', path='vault', src='app.conf.j2', dest='/etc/app.conf', mode='preserve',
+                          owner='app', backup=True, force=True, validate='test %s'))
+    tmpdir.join('app.conf.j2').chmod(0o640)
+    action._execute_module = mocker.Mock(return_value=dict(changed=False))
+    action._shared_loader_obj = mocker.Mock()
+    # the unpatched transfer
+    return action, lambda *args, **kwargs: action_plugin.ActionModule._transfer(action, *args, **kwargs)
+
+
+def test_action_plugin_transfer_unchanged(mocker, transfer_action, tmpdir):
+    from ansible.utils.hashing import checksum_s
+    action, transfer = transfer_action
+    mocker.patch.object(action, 'get_checksum', return_value=checksum_s('password=secret'))
+    result = transfer(str(tmpdir.join('app.conf.j2')), '/etc/app.conf', 'password=secret', False, dict(),
+                      item_args=dict(group='app'))
+    assert result == dict(changed=False)
+    # only the file attributes are enforced, the copy only arguments are removed and preserve is resolved
+    action._execute_module.assert_called_once_with(
+        module_name='file', task_vars=dict(),
+        module_args=dict(path='/etc/app.conf', follow=False, mode='0640', owner='app', group='app'))
+    assert not action._shared_loader_obj.action_loader.get.called
+
+
+def test_action_plugin_transfer_changed(mocker, transfer_action, tmpdir):
+    action, transfer = transfer_action
+    mocker.patch.object(action, 'get_checksum', return_value='outdated')
+    copied = {}
+    copy_action = action._shared_loader_obj.action_loader.get.return_value
+
+    def run(task_vars=None):
+        copied['content'] = open(action._task.copy.return_value.args['src'], 'rb').read()
+        return dict(changed=True)
+
+    copy_action.run.side_effect = run
+    result = transfer(str(tmpdir.join('app.conf.j2')), '/etc/app.conf', 'password=secret', False, dict())
+    assert result == dict(changed=True)
+    assert not action._execute_module.called
+    copy_args = action._task.copy.return_value.args
+    assert copied['content'] == b'password=secret'
+    assert not os.path.exists(copy_args.pop('src'))
+    assert copy_args == dict(dest='/etc/app.conf', follow=False, mode='0640', owner='app', backup=True, force=True,
+                             validate='test %s')
+
+
+@pytest.mark.parametrize('args, msg', [
+    (dict(bucket='bucket', src='app.conf.j2'), 'src and dest are required'),
+    (dict(bucket='bucket', src='app.conf.j2', dest='/etc/app.conf', templates=[]),
+     'templates is mutually exclusive with src and dest'),
+    (dict(bucket='bucket', templates=[dict(src='app.conf.j2')]),
+     'templates needs to be a list of dictionaries with src and dest'),
+    (dict(templates=[dict(src='app.conf.j2', dest='/etc/app.conf')]), 'bucket is required'),
+])
+def test_action_plugin_invalid_args(mocker, s3_mock, action_factory, args, msg):
+    action_plugin, factory = action_factory
+    patch_vault_cache(mocker, action_plugin, s3_mock)
+    result = factory(args).run(task_vars=dict())
+    assert result['failed']
+    assert result['msg'] == msg
+    assert not s3_mock.calls
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+import argparse
+import json
+
+import pytest
+
+from s3vaultlib import commands
+from s3vaultlib.commands import format_ls_entry, command_template
+from s3vaultlib.s3vaultlib import S3Vault
+from .mock.s3 import S3BucketMock, ConnectionManagerMock
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+
+@pytest.fixture
+def s3_mock():
+    return S3BucketMock({
+        'vault/conf_app': b'{"db": {"password": "secret"}}',
+    })
+
+
+@pytest.fixture
+def s3vault(s3_mock):
+    return S3Vault('bucket', 'vault', connection_factory=ConnectionManagerMock(s3_mock))
+
+
+def test_format_ls_entry(s3vault, s3_mock):
+    s3fsobject = next(s3vault.iter_files())
+    assert format_ls_entry(s3fsobject) == '2015-01-01 00:00:00    30 bytes  conf_app'
+    assert s3_mock.count('head_object') == 0
+    assert format_ls_entry(s3fsobject, long_format=True) == \
+        '2015-01-01 00:00:00    30 bytes  aws:kms   arn:aws:kms:test  conf_app'
+    assert json.loads(format_ls_entry(s3fsobject, json_lines=True)) == {
+        'name': 'conf_app', 'size': 30, 'last_modified': '2015-01-01T00:00:00'}
+
+
+class StopWatch(Exception):
+    pass
+
+
+def test_command_template_watch_survives_failed_poll(s3_mock, tmpdir, mocker):
+    template = tmpdir.join('conf.tpl')
+    template.write('{{ conf_app.db.password }}')
+    dest = tmpdir.join('conf')
+    args = argparse.Namespace(bucket='bucket', path='vault', batch=['{t}:{d}'.format(t=template, d=dest)],
+                              template_dir=None, watch=True, interval=1, reload_command=None)
+    refresh = S3Vault.refresh
+    polls = []
+
+    def flaky_refresh(s3vault):
+        polls.append(s3vault)
+        if len(polls) == 1:
+            raise Exception('transient error')
+        return refresh(s3vault)
+
+    def sleep(seconds):
+        if len(polls) == 1:
+            # the failed poll keeps the last expanded content and backs off
+            assert dest.read() == 'secret'
+            assert seconds == 2
+            s3_mock.objects['vault/conf_app']['Body'] = b'{"db": {"password": "changed"}}'
+        if len(polls) == 2:
+            raise StopWatch()
+
+    mocker.patch.object(S3Vault, 'refresh', flaky_refresh)
+    mocker.patch.object(commands.time, 'sleep', side_effect=sleep)
+    with pytest.raises(StopWatch):
+        command_template(args, ConnectionManagerMock(s3_mock))
+    assert dest.read() == 'changed'
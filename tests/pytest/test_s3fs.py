@@ -154,3 +154,11 @@ def test_s3fsobject_set_value_add_element():
     assert d == obj._set_value(fixture, 'level1key4.level2key2', {'level3key2': 'v_level3key2'})
 
 
+@pytest.mark.parametrize('pattern, expected', [
+    ('conf_*', 'conf_'),
+    ('conf_app', 'conf_app'),
+    ('*', ''),
+    ('cert_[ab]?', 'cert_'),
+])
+def test_s3fs_glob_prefix(pattern, expected):
+    assert S3Fs.glob_prefix(pattern) == expected
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+
+import pytest
+
+from s3vaultlib.s3.s3fs import S3FsSnapshot
+from s3vaultlib.s3.s3fsobject import S3FsObjectException
+from s3vaultlib.s3vaultlib import S3Vault, S3VaultObjectNotFoundException, render_template_snapshot
+from s3vaultlib.template.templaterenderer import TemplateRenderer
+from .mock.s3 import S3BucketMock, ConnectionManagerMock
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+
+@pytest.fixture
+def s3_mock():
+    return S3BucketMock({
+        'vault/conf_app': b'{"db": {"password": "secret"}}',
+        'vault/conf_web': b'{"server_name": "www.example.com"}',
+        'vault/cert_web': b'-----BEGIN CERTIFICATE-----',
+    })
+
+
+@pytest.fixture
+def s3vault(s3_mock):
+    return S3Vault('bucket', 'vault', connection_factory=ConnectionManagerMock(s3_mock))
+
+
+def test_s3vault_iter_files_uses_glob_prefix(s3vault, s3_mock):
+    names = [s3fsobj.name for s3fsobj in s3vault.iter_files('conf_*')]
+    assert names == ['conf_app', 'conf_web']
+    assert ('list_objects_v2', 'vault/conf_') in s3_mock.calls
+    assert s3_mock.count('get_object') == 0
+
+
+def test_s3vault_iter_files_with_content(s3vault, s3_mock):
+    s3fsobjects = list(s3vault.iter_files(with_content=True, batch_size=2))
+    assert [s3fsobj.name for s3fsobj in s3fsobjects] == ['cert_web', 'conf_app', 'conf_web']
+    assert all(s3fsobj.is_loaded for s3fsobj in s3fsobjects)
+    assert s3_mock.count('get_object') == 3
+
+
+def test_s3vault_iter_files_with_metadata_does_not_fetch_content(s3vault, s3_mock):
+    s3fsobjects = list(s3vault.iter_files('cert_*', with_metadata=True))
+    assert [s3fsobj.metadata['SSEKMSKeyId'] for s3fsobj in s3fsobjects] == ['arn:aws:kms:test']
+    assert s3_mock.count('head_object') == 1
+    assert s3_mock.count('get_object') == 0
+
+
+def test_s3vault_template_fingerprint_tracks_referenced_objects(s3vault, s3_mock, tmpdir):
+    template = tmpdir.join('template.j2')
+    template.write('{{ conf_app.db.password }}')
+    fingerprint = s3vault.get_template_fingerprint(str(template))
+    s3_mock.objects['vault/conf_web']['Body'] = b'{"server_name": "changed"}'
+    s3vault.refresh()
+    assert s3vault.get_template_fingerprint(str(template)) == fingerprint
+    s3_mock.objects['vault/conf_app']['Body'] = b'{"db": {"password": "changed"}}'
+    s3vault.refresh()
+    assert s3vault.get_template_fingerprint(str(template)) != fingerprint
+
+
+def test_s3vault_render_templates_prefetches_union(s3vault, s3_mock, tmpdir):
+    template_app = tmpdir.join('app.j2')
+    template_app.write('{{ conf_app.db.password }}')
+    template_web = tmpdir.join('web.j2')
+    template_web.write('{{ conf_web.server_name }}/{{ conf_app.db.password }}')
+    results = s3vault.render_templates([str(template_app), str(template_web)])
+    assert results == ['secret', 'www.example.com/secret']
+    assert s3_mock.count('list_objects_v2') == 1
+    assert s3_mock.count('get_object') == 2
+
+
+def test_s3vault_stream_template_raw_copy_is_not_buffered(s3vault, s3_mock, tmpdir):
+    s3_mock.objects['vault/cert_web']['Body'] = b'\x04\xf8\x00P' * 100000
+    template = tmpdir.join('cert.j2')
+    template.write('{{ cert_web }}\n')
+    dest = tmpdir.join('cert')
+    s3vault.prefetch_templates([str(template)])
+    with open(str(dest), 'wb') as fh:
+        size = s3vault.stream_template(str(template), fh)
+    assert size == 400000
+    assert dest.read_binary() == b'\x04\xf8\x00P' * 100000
+    assert s3_mock.count('get_object') == 1
+    assert not s3vault._s3fs.get_object('cert_web').is_loaded
+
+
+def test_s3vault_render_templates_async(s3vault, s3_mock, tmpdir):
+    template_app = tmpdir.join('app.j2')
+    template_app.write('{{ conf_app.db.password }}')
+    template_cert = tmpdir.join('cert.j2')
+    template_cert.write('{{ cert_web }}')
+    results = s3vault.render_templates([str(template_app), str(template_cert)], enable_async=True)
+    assert results == ['secret', b'-----BEGIN CERTIFICATE-----']
+
+
+def test_s3vault_render_templates_async_rejects_an_executor(s3vault, tmpdir):
+    template = tmpdir.join('app.j2')
+    template.write('{{ conf_app.db.password }}')
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with pytest.raises(ValueError):
+            s3vault.render_templates([str(template)], enable_async=True, executor=executor)
+
+
+def test_s3vault_render_template_cache(s3vault, s3_mock, tmpdir, mocker):
+    template = tmpdir.join('template.j2')
+    template.write('{{ conf_app.db.password }}-{{ host }}')
+    render = mocker.spy(TemplateRenderer, 'render')
+    assert s3vault.render_template(str(template), host='a', unused=object()) == 'secret-a'
+    assert s3vault.render_template(str(template), host='a', unused=object()) == 'secret-a'
+    assert render.call_count == 1
+    assert s3vault.render_template(str(template), host='b') == 'secret-b'
+    assert render.call_count == 2
+    s3_mock.objects['vault/conf_app']['Body'] = b'{"db": {"password": "changed"}}'
+    s3vault.refresh()
+    assert s3vault.render_template(str(template), host='a') == 'changed-a'
+    assert render.call_count == 3
+
+
+def test_s3vault_render_template_analyzes_the_template_once(s3vault, tmpdir, mocker):
+    template = tmpdir.join('template.j2')
+    template.write('{{ conf_app.db.password }}-{{ host }}')
+    get_template_references = mocker.spy(s3vault, '_get_template_references')
+    assert s3vault.render_template(str(template), host='a') == 'secret-a'
+    assert get_template_references.call_count == 1
+    assert s3vault.render_template(str(template), host='a') == 'secret-a'
+    assert get_template_references.call_count == 2
+
+
+def test_s3vault_render_templates_process_pool(s3vault, s3_mock, tmpdir):
+    template_app = tmpdir.join('app.j2')
+    template_app.write('{{ conf_app.db.password }}-{{ host }}')
+    template_cert = tmpdir.join('cert.j2')
+    template_cert.write('{{ cert_web }}')
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        results = s3vault.render_templates([str(template_app), str(template_cert)], executor=executor, host='a')
+    assert results == ['secret-a', b'-----BEGIN CERTIFICATE-----']
+    assert s3_mock.count('get_object') == 2
+
+
+def test_s3vault_snapshot_without_content_is_offline(s3vault, tmpdir):
+    template = tmpdir.join('web.j2')
+    template.write('{{ conf_web.server_name }}')
+    with pytest.raises(S3FsObjectException):
+        render_template_snapshot(str(template), s3vault._s3fs.snapshot(names=set()), {})
+    s3fs = S3FsSnapshot(s3vault._s3fs.snapshot(names=set()))
+    with pytest.raises(S3FsObjectException):
+        s3fs.get_object('cert_web').stream_to(BytesIO())
+
+
+def test_s3vault_render_template_includes_vault_objects(s3_mock, tmpdir):
+    s3_mock.objects['vault/tpl_header'] = dict(s3_mock.objects['vault/conf_app'],
+                                               Body=b'server {{ conf_web.server_name }}')
+    s3vault = S3Vault('bucket', 'vault', connection_factory=ConnectionManagerMock(s3_mock))
+    template = tmpdir.join('template.j2')
+    template.write('{% include "tpl_header" %} password {{ conf_app.db.password }}')
+    s3vault.prefetch_templates([str(template)])
+    assert s3_mock.count('get_object') == 3
+    assert s3vault.render_template(str(template)) == 'server www.example.com password secret'
+    assert s3_mock.count('get_object') == 3
+    names = [name for name, _ in s3vault.get_template_fingerprint(str(template))[1]]
+    assert names == ['conf_app', 'conf_web', 'tpl_header']
+
+
+def test_s3vault_included_vault_objects_are_not_cached_on_disk(s3_mock, tmpdir):
+    s3_mock.objects['vault/tpl_secret'] = dict(s3_mock.objects['vault/conf_app'], Body=b'include-only-secret')
+    s3vault = S3Vault('bucket', 'vault', connection_factory=ConnectionManagerMock(s3_mock))
+    template = tmpdir.join('template.j2')
+    template.write('{% include "tpl_secret" %}')
+    assert s3vault.render_template(str(template)) == 'include-only-secret'
+    cache_dir = os.environ['S3VAULTLIB_TEMPLATE_CACHE_DIR']
+    assert os.listdir(cache_dir)
+    for filename in os.listdir(cache_dir):
+        with open(os.path.join(cache_dir, filename), 'rb') as fh:
+            assert b'include-only-secret' not in fh.read()
+
+
+def test_s3vault_render_template_prefetches_logged_accesses(s3_mock, tmpdir):
+    template = tmpdir.join('template.j2')
+    template.write('{{ settings[name].server_name }}')
+    s3vault = S3Vault('bucket', 'vault', connection_factory=ConnectionManagerMock(s3_mock))
+    settings = {s3fsobj.name: s3fsobj for s3fsobj in s3vault._s3fs.objects}
+    assert s3vault.render_template(str(template), settings=settings, name='conf_web') == 'www.example.com'
+    assert s3vault.get_template_objects(str(template))[0].name == 'conf_web'
+    s3_mock.calls = []
+    s3vault = S3Vault('bucket', 'vault', connection_factory=ConnectionManagerMock(s3_mock))
+    s3vault.prefetch_templates([str(template)])
+    assert s3_mock.count('get_object') == 1
+    assert [s3fsobj.name for s3fsobj in s3vault._s3fs.objects if s3fsobj.is_loaded] == ['conf_web']
+
+
+def test_s3vault_prefetch_files(s3vault, s3_mock):
+    s3vault.prefetch_files(['conf_app', 'conf_web', 'conf_app'])
+    assert s3_mock.count('get_object') == 2
+    assert s3vault.get_property('conf_web', 'server_name') == 'www.example.com'
+    assert s3_mock.count('get_object') == 2
+    with pytest.raises(S3VaultObjectNotFoundException):
+        s3vault.prefetch_files(['conf_app', 'conf_missing'])
+
+
+def test_s3vault_skips_unchanged_writes(s3vault, s3_mock, tmpdir):
+    s3vault.set_property('conf_app', 'db.password', 'secret', encryption_key_arn='arn:aws:kms:test')
+    assert s3_mock.count('put_object') == 0
+    s3vault.set_property('conf_app', 'db.password', 'changed', encryption_key_arn='arn:aws:kms:test')
+    assert s3_mock.count('put_object') == 1
+
+    src = tmpdir.join('conf_web')
+    src.write_binary(b'{"server_name": "www.example.com"}')
+    s3vault.put_file(str(src), 'conf_web', encryption_key_arn='arn:aws:kms:test')
+    # the object has no content hash in its metadata yet
+    assert s3_mock.count('put_object') == 2
+    s3vault.put_file(str(src), 'conf_web', encryption_key_arn='arn:aws:kms:test')
+    assert s3_mock.count('put_object') == 2
+    s3vault.put_file(str(src), 'conf_web', encryption_key_arn='arn:aws:kms:other')
+    assert s3_mock.count('put_object') == 3
+
+
+def test_s3vault_canonical_json(s3_mock):
+    s3_mock.objects['vault/conf_app']['Body'] = b'{"db": {"user": "app", "password": "secret"}}'
+    s3vault = S3Vault('bucket', 'vault', connection_factory=ConnectionManagerMock(s3_mock), canonical_json=True)
+    # the value does not change but the config is rewritten in canonical form
+    s3vault.set_property('conf_app', 'db.password', 'secret', encryption_key_arn='arn:aws:kms:test')
+    assert s3_mock.objects['vault/conf_app']['Body'] == b'{"db":{"password":"secret","user":"app"}}'
+    s3vault.set_property('conf_app', 'db.password', 'secret', encryption_key_arn='arn:aws:kms:test')
+    assert s3_mock.count('put_object') == 1
+
+
+def test_s3vault_batch(s3vault, s3_mock, tmpdir):
+    src = tmpdir.join('cert_web')
+    src.write_binary(b'-----BEGIN CERTIFICATE-----\nnew')
+    s3vault.refresh()
+    s3_mock.calls = []
+    with s3vault.batch() as batch:
+        batch.set_property('conf_app', 'db.user', 'app')
+        batch.set_property('conf_app', 'db.password', 'changed')
+        batch.set_property('conf_web', 'server_name', 'www.example.com')
+        batch.create_config_property('conf_new', encryption_key_arn='arn:aws:kms:test')
+        batch.set_property('conf_new', 'debug', True)
+        batch.put_file(str(src), 'cert_web', encryption_key_arn='arn:aws:kms:test')
+        assert s3_mock.count('put_object') == 0
+    # one PUT per changed file and a single listing
+    assert sorted(c[1] for c in s3_mock.calls if c[0] == 'put_object') == ['vault/cert_web', 'vault/conf_app',
+                                                                           'vault/conf_new']
+    assert s3_mock.count('list_objects_v2') == 1
+    assert s3vault.get_property('conf_app', 'db') == {'password': 'changed', 'user': 'app'}
+    assert s3vault.get_property('conf_new', 'debug') is True
+
+    with pytest.raises(ValueError):
+        with s3vault.batch() as batch:
+            batch.set_property('conf_app', 'db.user', 'discarded')
+            raise ValueError()
+    assert s3vault.get_property('conf_app', 'db.user') == 'app'
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+import pytest
+
+from s3vaultlib.s3vaultlib import S3Vault
+from s3vaultlib.sync.vaultsync import VaultSync, VaultSyncException, parse_s3_uri
+from .mock.s3 import S3BucketMock, ConnectionManagerMock
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+
+@pytest.fixture
+def s3_mock():
+    return S3BucketMock({
+        'vault/conf_app': b'{"db": {"password": "secret"}}',
+        'vault/conf_old': b'{}',
+    })
+
+
+@pytest.fixture
+def s3vault(s3_mock):
+    return S3Vault('bucket', 'vault', connection_factory=ConnectionManagerMock(s3_mock))
+
+
+def test_parse_s3_uri():
+    assert parse_s3_uri('s3://bucket/vault/path/') == ('bucket', 'vault/path')
+    assert parse_s3_uri('/local/dir') is None
+    with pytest.raises(VaultSyncException):
+        parse_s3_uri('s3:///vault')
+
+
+def test_vault_sync_push(s3vault, s3_mock, tmpdir):
+    tmpdir.join('conf_app').write_binary(b'{"db": {"password": "secret"}}')
+    tmpdir.join('conf_web').write_binary(b'{"server_name": "www.example.com"}')
+    tmpdir.join('README.md').write_binary(b'not pushed')
+    vault_sync = VaultSync(s3vault, str(tmpdir), delete=True, dry_run=True)
+    assert vault_sync.push(encryption_key_arn='arn:aws:kms:test') == [
+        ('upload', 'conf_app'), ('upload', 'conf_web'), ('delete', 'conf_old')]
+    assert s3_mock.count('put_object') == 0
+
+    vault_sync = VaultSync(s3vault, str(tmpdir), delete=True)
+    vault_sync.push(encryption_key_arn='arn:aws:kms:test')
+    assert sorted(s3_mock.objects) == ['vault/conf_app', 'vault/conf_web']
+    assert s3_mock.count('get_object') == 0
+    assert vault_sync.push(encryption_key_arn='arn:aws:kms:test') == []
+
+    tmpdir.join('conf_web').write_binary(b'{"server_name": "changed"}')
+    assert vault_sync.push(encryption_key_arn='arn:aws:kms:test') == [('upload', 'conf_web')]
+    assert s3_mock.objects['vault/conf_web']['Body'] == b'{"server_name": "changed"}'
+
+
+def test_vault_sync_push_checks_each_file_once(s3vault, s3_mock, tmpdir):
+    tmpdir.join('conf_app').write_binary(b'{"db": {"password": "changed"}}')
+    tmpdir.join('conf_web').write_binary(b'{}')
+    assert VaultSync(s3vault, str(tmpdir)).push(encryption_key_arn='arn:aws:kms:test') == [
+        ('upload', 'conf_app'), ('upload', 'conf_web')]
+    assert s3_mock.count('head_object') == 1
+    assert s3_mock.count('put_object') == 2
+    # one listing to compare the files and one to record the new ETags
+    assert s3_mock.count('list_objects_v2') == 2
+    assert s3_mock.objects['vault/conf_app']['Body'] == b'{"db": {"password": "changed"}}'
+
+
+def test_vault_sync_push_delete_keeps_dotted_files(s3vault, s3_mock, tmpdir, monkeypatch):
+    s3_mock.objects['vault/app.conf'] = dict(s3_mock.objects['vault/conf_old'])
+    tmpdir.join('conf_app').write_binary(b'{"db": {"password": "secret"}}')
+    tmpdir.join('app.conf').write_binary(b'{}')
+    vault_sync = VaultSync(s3vault, str(tmpdir), delete=True)
+    assert vault_sync.push(encryption_key_arn='arn:aws:kms:test') == [('upload', 'conf_app'), ('delete', 'conf_old')]
+    assert sorted(s3_mock.objects) == ['vault/app.conf', 'vault/conf_app']
+
+    monkeypatch.setenv('S3VAULTLIB_FORCE_DOT_FILE', 'true')
+    tmpdir.join('app.conf').remove()
+    assert vault_sync.push(encryption_key_arn='arn:aws:kms:test') == [('delete', 'app.conf')]
+
+
+def test_vault_sync_pull(s3vault, s3_mock, tmpdir):
+    local_dir = tmpdir.join('local')
+    vault_sync = VaultSync(s3vault, str(local_dir), delete=True)
+    assert vault_sync.pull() == [('download', 'conf_app'), ('download', 'conf_old')]
+    assert local_dir.join('conf_app').read_binary() == b'{"db": {"password": "secret"}}'
+    s3_mock.calls = []
+    assert vault_sync.pull() == []
+    assert s3_mock.count('get_object') == 0
+
+    local_dir.join('conf_extra').write_binary(b'{}')
+    del s3_mock.objects['vault/conf_old']
+    s3vault.refresh()
+    assert vault_sync.pull() == [('delete', 'conf_extra'), ('delete', 'conf_old')]
+    assert sorted(f.basename for f in local_dir.listdir()) == ['.s3vault-sync.json', 'conf_app']
+
+
+def test_vault_sync_only_synchronizes_the_direct_children(s3vault, s3_mock, tmpdir, monkeypatch):
+    for key in ('vault-staging/conf_stg', 'vault/sub/conf_nested', 'vault/app.conf', 'vault/.s3vault-sync.json'):
+        s3_mock.objects[key] = dict(s3_mock.objects['vault/conf_old'])
+    local_dir = tmpdir.join('local')
+    vault_sync = VaultSync(s3vault, str(local_dir), delete=True)
+    assert vault_sync.pull() == [('download', 'conf_app'), ('download', 'conf_old')]
+    assert sorted(f.basename for f in local_dir.listdir()) == ['.s3vault-sync.json', 'conf_app', 'conf_old']
+    assert vault_sync.pull() == []
+
+    s3_mock.calls = []
+    assert vault_sync.push(encryption_key_arn='arn:aws:kms:test') == []
+    assert s3_mock.count('delete_object') == 0
+
+    monkeypatch.setenv('S3VAULTLIB_FORCE_DOT_FILE', 'true')
+    assert vault_sync.pull() == [('download', 'app.conf')]
+    assert vault_sync.pull() == []
+
+
+def test_vault_sync_content_hash(s3vault, s3_mock, tmpdir):
+    tmpdir.join('conf_web').write_binary(b'{"server_name": "www.example.com"}')
+    VaultSync(s3vault, str(tmpdir)).push(encryption_key_arn='arn:aws:kms:test')
+    tmpdir.join('.s3vault-sync.json').remove()
+    s3_mock.calls = []
+    # without the state the unchanged file is matched by the sha256 in its metadata
+    assert VaultSync(s3vault, str(tmpdir)).push(encryption_key_arn='arn:aws:kms:test') == []
+    assert s3_mock.count('put_object') == 0
+    assert s3_mock.count('get_object') == 0
+    assert s3vault._s3fs.get_object('conf_web').content_hash == s3_mock.objects['vault/conf_web']['Metadata']['sha256']
+
+    local_dir = tmpdir.join('local')
+    local_dir.mkdir()
+    local_dir.join('conf_web').write_binary(b'{"server_name": "www.example.com"}')
+    assert VaultSync(s3vault, str(local_dir)).pull() == [('download', 'conf_app'), ('download', 'conf_old')]
+    assert s3_mock.count('get_object') == 2
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+import asyncio
+import gc
+import os
+import stat
+import sys
+import threading
+import time
+import types
+import weakref
+
+import jinja2
+import pytest
+
+from s3vaultlib.s3.s3fs import S3Fs
+from s3vaultlib.template.asyncobject import AsyncObjectLoader
+from s3vaultlib.template.templaterenderer import TemplateRenderer, get_environment, get_s3fs_environment, \
+    LazyFilters, SourceLoader, PrivateBytecodeCache, disable_bytecode_cache, _get_bytecode_cache
+from .mock.s3 import S3BucketMock, ConnectionManagerMock
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+
+@pytest.fixture
+def s3fs():
+    s3_mock = S3BucketMock({'vault/conf_app': b'{"db": {"password": "secret"}}'})
+    return S3Fs(ConnectionManagerMock(s3_mock), 'bucket', 'vault')
+
+
+def test_template_renderer_shares_environment_and_compiled_templates(s3fs, tmpdir):
+    template = tmpdir.join('template.j2')
+    template.write('{{ conf_app.db.password | upper }}')
+    first = TemplateRenderer(str(template), s3fs)
+    second = TemplateRenderer(str(template), s3fs)
+    assert first.render() == second.render() == 'SECRET'
+    assert first._jinja2 is second._jinja2
+    assert first._jinja2.cache is get_environment().cache
+    assert first._get_template() is second._get_template()
+
+
+def test_s3fs_environment_does_not_keep_the_s3fs_alive(tmpdir):
+    s3_mock = S3BucketMock({'vault/conf_app': b'{"db": {"password": "secret"}}',
+                            'vault/macros': b'{% macro password() %}{{ conf_app.db.password }}{% endmacro %}'})
+    s3fs = S3Fs(ConnectionManagerMock(s3_mock), 'bucket', 'vault')
+    template = tmpdir.join('template.j2')
+    template.write('{% include "macros" %}{{ conf_app.db.password }}')
+    assert TemplateRenderer(str(template), s3fs).render() == 'secret'
+    assert get_s3fs_environment(s3fs) is get_s3fs_environment(s3fs)
+    s3fs_ref = weakref.ref(s3fs)
+    del s3fs
+    gc.collect()
+    assert s3fs_ref() is None
+
+
+@pytest.mark.parametrize('enable_async', [False, True])
+def test_template_renderer_json_keys_take_precedence_over_attributes(tmpdir, enable_async):
+    s3_mock = S3BucketMock({'vault/conf': b'{"size": "XL", "etag": "v1", "name": "web"}',
+                            'vault/cert': b'-----BEGIN CERTIFICATE-----'})
+    s3fs = S3Fs(ConnectionManagerMock(s3_mock), 'bucket', 'vault')
+    template = tmpdir.join('template.j2')
+    template.write('{{ conf.size }} {{ conf.etag }} {{ conf.name }} {{ conf["size"] }} {{ cert.size }} {{ cert.name }}')
+    assert TemplateRenderer(str(template), s3fs, enable_async=enable_async).render() == 'XL v1 web XL 27 cert'
+
+
+def test_template_renderer_unknown_filter(s3fs, tmpdir):
+    template = tmpdir.join('template.j2')
+    template.write('{{ conf_app | not_a_filter }}')
+    with pytest.raises(Exception) as excinfo:
+        TemplateRenderer(str(template), s3fs).render()
+    assert 'not_a_filter' in str(excinfo.value)
+
+
+def test_template_renderer_render_to_streams_chunks(s3fs, tmpdir):
+    template = tmpdir.join('template.j2')
+    template.write(u'{% for i in range(3) %}{{ conf_app.db.password }}-κ\n{% endfor %}')
+    chunks = []
+
+    class Writer(object):
+        def write(self, data):
+            chunks.append(data)
+
+    size = TemplateRenderer(str(template), s3fs).render_to(Writer())
+    assert len(chunks) > 1
+    assert b''.join(chunks) == u'secret-κ\nsecret-κ\nsecret-κ\n'.encode('utf-8')
+    assert size == len(b''.join(chunks))
+
+
+def test_template_renderer_async_matches_sync(s3fs, tmpdir):
+    template = tmpdir.join('template.j2')
+    template.write('{% for key in ["db"] %}{{ conf_app[key].password }}{% endfor %}/{{ conf_app.missing }}/'
+                   '{{ conf_app.name }}')
+    assert TemplateRenderer(str(template), s3fs, enable_async=True).render() == \
+        TemplateRenderer(str(template), s3fs).render() == 'secret//conf_app'
+
+
+def test_template_renderer_async_shares_object_loads(s3fs, tmpdir):
+    template = tmpdir.join('template.j2')
+    template.write('{{ conf_app.db.password }}')
+    renderers = [TemplateRenderer(str(template), s3fs, enable_async=True) for _ in range(5)]
+
+    async def render_all():
+        object_loader = AsyncObjectLoader()
+        return await asyncio.gather(*[renderer.render_async(object_loader) for renderer in renderers])
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(render_all()) == ['secret'] * 5
+    finally:
+        loop.close()
+    assert s3fs.fs.count('get_object') == 1
+
+
+def test_template_renderer_async_whole_object_output_is_not_loaded_on_the_loop(s3fs, tmpdir):
+    template = tmpdir.join('template.j2')
+    template.write('{{ conf_app }}')
+    get_object = s3fs.fs.get_object
+    threads = []
+
+    def record_thread(**kwargs):
+        threads.append(threading.current_thread())
+        return get_object(**kwargs)
+
+    s3fs.fs.get_object = record_thread
+    assert TemplateRenderer(str(template), s3fs, enable_async=True).render() == '{"db": {"password": "secret"}}'
+    assert len(threads) == 1
+    assert threads[0] is not threading.main_thread()
+
+
+def test_lazy_filters_wait_for_the_loading_thread(monkeypatch):
+    class FilterModule(object):
+        def filters(self):
+            time.sleep(0.2)
+            return {'b64encode': lambda value: value}
+
+    filter_module = types.ModuleType('ansible.plugins.filter.core')
+    filter_module.FilterModule = FilterModule
+    monkeypatch.setitem(sys.modules, 'ansible.plugins.filter.core', filter_module)
+    filters = LazyFilters()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append('b64encode' in filters)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [True, True]
+    assert 'missing' not in filters
+
+
+def test_source_loader_is_bounded():
+    loader = SourceLoader(max_size=2)
+    names = [loader.register(source) for source in ('a', 'b', 'a', 'c')]
+    assert loader.get_source(None, names[0])[0] == 'a'
+    assert loader.get_source(None, names[3])[0] == 'c'
+    with pytest.raises(jinja2.TemplateNotFound):
+        loader.get_source(None, names[1])
+
+
+def test_bytecode_cache_is_opt_in_and_private(monkeypatch, tmpdir):
+    monkeypatch.delenv('S3VAULTLIB_TEMPLATE_CACHE_DIR')
+    assert _get_bytecode_cache() is None
+    cache_dir = tmpdir.join('cache')
+    monkeypatch.setenv('S3VAULTLIB_TEMPLATE_CACHE_DIR', str(cache_dir))
+    assert isinstance(_get_bytecode_cache(), PrivateBytecodeCache)
+    assert stat.S_IMODE(os.stat(str(cache_dir)).st_mode) == 0o700
+    cache_dir.chmod(0o755)
+    assert _get_bytecode_cache() is None
+
+
+def test_bytecode_cache_files_are_private(s3fs, tmpdir):
+    cache_dir = os.environ['S3VAULTLIB_TEMPLATE_CACHE_DIR']
+    before = set(os.listdir(cache_dir))
+    template = tmpdir.join('template.j2')
+    template.write('{{ conf_app.db.password }}-private')
+    assert TemplateRenderer(str(template), s3fs).render() == 'secret-private'
+    created = set(os.listdir(cache_dir)) - before
+    assert created
+    for filename in created:
+        assert stat.S_IMODE(os.stat(os.path.join(cache_dir, filename)).st_mode) == 0o600
+
+
+def test_disable_bytecode_cache(s3fs, tmpdir):
+    cache_dir = os.environ['S3VAULTLIB_TEMPLATE_CACHE_DIR']
+    before = set(os.listdir(cache_dir))
+    template = tmpdir.join('template.j2')
+    template.write('{{ conf_app.db.password }}-in-memory')
+    with disable_bytecode_cache():
+        assert TemplateRenderer(str(template), s3fs).render() == 'secret-in-memory'
+    assert set(os.listdir(cache_dir)) == before
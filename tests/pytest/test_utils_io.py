@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+import os
+
+from s3vaultlib.utils import io
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+
+def test_write_if_changed_creates_file(tmpdir):
+    dest = str(tmpdir.join('dest'))
+    assert io.write_if_changed(dest, b'content')
+    with open(dest, 'rb') as fh:
+        assert fh.read() == b'content'
+    assert os.listdir(str(tmpdir)) == ['dest']
+
+
+def test_write_if_changed_skips_identical_content(tmpdir):
+    dest = tmpdir.join('dest')
+    dest.write_binary(b'content')
+    os.chmod(str(dest), 0o640)
+    inode = os.stat(str(dest)).st_ino
+    assert not io.write_if_changed(str(dest), b'content')
+    assert os.stat(str(dest)).st_ino == inode
+
+
+def test_write_if_changed_preserves_mode(tmpdir):
+    dest = tmpdir.join('dest')
+    dest.write_binary(b'content')
+    os.chmod(str(dest), 0o640)
+    assert io.write_if_changed(str(dest), b'new content')
+    assert dest.read_binary() == b'new content'
+    assert os.stat(str(dest)).st_mode & 0o777 == 0o640
+
+
+def test_atomic_file_discards_on_error(tmpdir):
+    dest = tmpdir.join('dest')
+    dest.write_binary(b'content')
+    try:
+        with io.AtomicFile(str(dest)) as fh:
+            fh.write(b'partial')
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+    assert dest.read_binary() == b'content'
+    assert os.listdir(str(tmpdir)) == ['dest']
+
+
+def test_atomic_file_changed_flag(tmpdir):
+    dest = tmpdir.join('dest')
+    dest.write_binary(b'content')
+    with io.AtomicFile(str(dest)) as fh:
+        fh.write(b'cont')
+        fh.write(b'ent')
+    assert not fh.changed
+    with io.AtomicFile(str(dest)) as fh:
+        fh.write(b'other')
+    assert fh.changed
+    assert dest.read_binary() == b'other'
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import gc
+import weakref
+
+import pytest
+
+from s3vaultlib.s3.snapshotfile import SnapshotStore
+from s3vaultlib.utils.vaultcache import VaultCache
+from .mock.s3 import S3BucketMock, ConnectionManagerMock, KMSMock
+
+__author__ = "Giuseppe Chiesa"
+__copyright__ = "Copyright 2017-2021, Giuseppe Chiesa"
+__credits__ = ["Giuseppe Chiesa"]
+__license__ = "BSD"
+__maintainer__ = "Giuseppe Chiesa"
+__email__ = "mail@giuseppechiesa.it"
+__status__ = "PerpetualBeta"
+
+
+def test_vault_cache_reuses_vaults_and_bodies():
+    s3_mock = S3BucketMock({'vault/conf_app': b'{"db": {"password": "secret"}}'})
+    connections = []
+
+    def connection_factory(region=None, profile=None):
+        connections.append((region, profile))
+        return ConnectionManagerMock(s3_mock)
+
+    vault_cache = VaultCache(ttl=300, connection_factory=connection_factory)
+    for _ in range(3):
+        s3vault = vault_cache.get_vault('bucket', 'vault', region='eu-west-1')
+        assert s3vault.get_property('conf_app', 'db.password') == 'secret'
+    assert vault_cache.get_vault('bucket', 'vault', region='eu-west-1') is s3vault
+    assert connections == [('eu-west-1', None)]
+    assert s3_mock.count('list_objects_v2') == 1
+    assert s3_mock.count('get_object') == 1
+    assert vault_cache.get_vault('bucket', 'vault', region='us-east-1') is not s3vault
+
+
+def test_vault_cache_refreshes_after_ttl():
+    s3_mock = S3BucketMock({'vault/conf_app': b'{"db": {"password": "secret"}}'})
+    vault_cache = VaultCache(ttl=-1, connection_factory=lambda region, profile: ConnectionManagerMock(s3_mock))
+    s3vault = vault_cache.get_vault('bucket', 'vault')
+    s3vault.get_file('conf_app')
+    assert vault_cache.get_vault('bucket', 'vault') is s3vault
+    assert s3_mock.count('list_objects_v2') == 2
+    s3vault.get_file('conf_app')
+    assert s3_mock.count('get_object') == 1
+
+
+def test_vault_cache_resolve_path_queries_metadata_only_when_referenced(mocker):
+    vault_cache = VaultCache()
+    get_ec2_role = mocker.patch.object(vault_cache, 'get_ec2_role', return_value='myrole')
+    assert vault_cache.resolve_path('myapp/encrypted') == 'myapp/encrypted'
+    assert not get_ec2_role.called
+    assert vault_cache.resolve_path('role/{{ role_name }}/encrypted', ec2=False) == 'role/{{ role_name }}/encrypted'
+    assert vault_cache.resolve_path('role/{{ role_name }}/encrypted') == 'role/myrole/encrypted'
+
+
+def test_vault_cache_keeps_the_replaced_snapshots_readable(tmpdir):
+    pytest.importorskip('cryptography')
+    s3_mock = S3BucketMock({'vault/conf_app': b'{"db": {"password": "secret"}}'})
+    connection_manager = ConnectionManagerMock(s3_mock, KMSMock())
+    snapshot_store = SnapshotStore(str(tmpdir), ttl=-1)
+    vault_cache = VaultCache(ttl=-1, connection_factory=lambda region, profile: connection_manager,
+                             snapshot_store=snapshot_store)
+    old_vault = vault_cache.get_snapshot_vault('bucket', 'vault')
+    old_snapshot = weakref.ref(old_vault._s3fs.objects[0]._fs)
+    s3_mock.objects['vault/conf_app']['Body'] = b'{"db": {"password": "changed"}}'
+    new_vault = vault_cache.get_snapshot_vault('bucket', 'vault')
+    # a thread still holding the replaced vault keeps reading its snapshot
+    assert old_vault.get_property('conf_app', 'db.password') == 'secret'
+    assert new_vault.get_property('conf_app', 'db.password') == 'changed'
+    vault_cache.clear()
+    assert new_vault.get_property('conf_app', 'db.password') == 'changed'
+    # the mapping is released with the last vault reading it
+    del old_vault
+    gc.collect()
+    assert old_snapshot() is None
+
+
+def test_vault_cache_snapshot_of_an_empty_vault(tmpdir):
+    pytest.importorskip('cryptography')
+    connection_manager = ConnectionManagerMock(S3BucketMock(), KMSMock())
+    vault_cache = VaultCache(connection_factory=lambda region, profile: connection_manager,
+                             snapshot_store=SnapshotStore(str(tmpdir)))
+    s3vault = vault_cache.get_snapshot_vault('bucket', 'vault')
+    assert s3vault._s3fs.objects == []